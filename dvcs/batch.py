@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the same wrapper method over many repositories in parallel.
+
+    from dvcs.batch import run_many
+    heads = run_many([DVCSWrapper(path) for path in paths], 'get_head', kwargs={'branch': 'default'})
+
+Results are in order of ``wrappers``. A repository that failed or timed out gets ``DVCSException`` in place of its
+result (with ``repo_path`` and ``method`` attributes), ``raise_errors=True`` raises one exception for all of them.
+With ``executor='thread'`` calls run in threads and timed out ones are left to finish in background, with
+``executor='process'`` every call runs in a forked process which gets killed on timeout.
+"""
+import threading, multiprocessing, time
+from Queue import Queue, Empty
+
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+logging = settings.APP_LOGGER
+
+
+def _failure(wrapper, method, e):
+    if not isinstance(e, DVCSException):
+        e = DVCSException('%s failed: %s' % (method, e), cause=e)
+    e.repo_path, e.method = wrapper.repo_path, method
+    return e
+
+
+def _call(wrapper, method, args, kwargs):
+    try:
+        return True, getattr(wrapper, method)(*args, **kwargs)
+    except Exception, e:
+        return False, e
+
+
+def _in_thread(wrapper, method, args, kwargs, timeout):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(_call(wrapper, method, args, kwargs)))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return result[0] if result else None
+
+
+def _in_process(wrapper, method, args, kwargs, timeout):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def child():
+        ok, value = _call(wrapper, method, args, kwargs)
+        try:
+            sender.send((ok, value))
+        except Exception, e: #unpicklable result
+            sender.send((False, DVCSException('%s returned unpicklable result: %s' % (method, e))))
+
+    process = multiprocessing.Process(target=child)
+    process.daemon = True
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv() if receiver.poll(timeout) else None
+    except (EOFError, IOError): #child died without sending
+        process.join()
+        result = False, DVCSException('%s died with exit code %s' % (method, process.exitcode),
+                                      code=process.exitcode)
+    if result is None:
+        process.terminate()
+    process.join()
+    receiver.close()
+    return result
+
+
+EXECUTORS = {'thread': _in_thread, 'process': _in_process}
+
+
+def run_many(wrappers, method, args=(), kwargs=None, timeout=None, workers=None, executor=None, raise_errors=False):
+    """
+    calls ``method(*args, **kwargs)`` on every wrapper, ``timeout`` in seconds is per repository
+    returns list of results in order of ``wrappers``
+    """
+    wrappers = list(wrappers)
+    kwargs = kwargs or {}
+    timeout = timeout if timeout is not None else getattr(settings, 'DVCS_BATCH_TIMEOUT', None)
+    workers = workers or getattr(settings, 'DVCS_BATCH_WORKERS', 8)
+    run = EXECUTORS[executor or getattr(settings, 'DVCS_BATCH_EXECUTOR', 'thread')]
+
+    results = [None] * len(wrappers)
+    queue = Queue()
+    for i in range(len(wrappers)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Empty:
+                return
+            wrapper, started = wrappers[i], time.time()
+            try:
+                result = run(wrapper, method, args, kwargs, timeout)
+            except Exception, e: #executor itself failed, the rest of the queue still runs
+                result = False, e
+            if result is None:
+                logging.warning('%s on %s timed out after %.1fs' % (method, wrapper.repo_path, time.time() - started))
+                results[i] = _failure(wrapper, method, DVCSException('%s timed out after %ss' % (method, timeout)))
+            else:
+                ok, value = result
+                results[i] = value if ok else _failure(wrapper, method, value)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(wrappers)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if raise_errors:
+        errors = dict((wrappers[i].repo_path, r) for i, r in enumerate(results) if isinstance(r, DVCSException))
+        if errors:
+            raise DVCSException('%s failed in %d of %d repositories' % (method, len(errors), len(wrappers)),
+                errors=errors, results=results)
+    return results
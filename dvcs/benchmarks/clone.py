@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time and disk taken by clone modes of ``Hg.clone`` from a local mirror.
+
+Generates a repository with given number of changesets and files (kept in temp dir for next runs), then clones
+it in every mode. Disk is what the clone really adds, files hardlinked to the source are not counted.
+
+    python -m dvcs.benchmarks.clone [changesets] [files]
+"""
+import os, sys, time, random, shutil, tempfile
+
+from mercurial import hg, ui, context
+
+from dvcs.hg.wrapper import Hg
+
+MODES = [
+    ('plain', {}),
+    ('noupdate', {'noupdate': True}),
+    ('no hardlink', {'hardlink': False}),
+    ('uncompressed', {'uncompressed': True, 'hardlink': False}),
+    ('share', {'share': True}),
+    ('share noupdate', {'share': True, 'noupdate': True}),
+    ('branch', {'branch': 'default'}),
+]
+
+
+WORDS = ['frobnicate', 'widget', 'parser', 'cache', 'handler', 'request', 'session', 'config', 'module', 'index']
+
+
+def generate(path, changesets, files, branches=1, lines=50):
+    """
+    repository with ``changesets`` commits spread over ``branches`` named branches, each changing a few of
+    ``files`` files of about ``lines`` lines, the same for the same arguments
+    """
+    rnd = random.Random(changesets * 31 + files)
+    repo = hg.repository(ui.ui(), path, create=True)
+    names = ['src/dir%d/file%d.py' % (i % 50, i) for i in range(files)]
+    contents = dict((name, ['%s %d\n' % (rnd.choice(WORDS), i) for i in range(lines)]) for name in names)
+    branch_names = ['default'] + ['branch-%d' % i for i in range(1, branches)]
+    heads = {}
+
+    for rev in xrange(changesets):
+        branch = 'default' if rev == 0 else rnd.choice(branch_names)
+        parent = heads.get(branch, heads.get('default', repo['tip'].node()))
+        changed = names if rev == 0 else rnd.sample(names, min(3, files))
+        for name in changed:
+            lines_of = contents[name]
+            lines_of[rnd.randrange(len(lines_of))] = '%s changed in %d\n' % (rnd.choice(WORDS), rev)
+            lines_of.insert(rnd.randrange(len(lines_of)), 'added in %d\n' % rev)
+        filectx = lambda repo, ctx, name: context.memfilectx(name, ''.join(contents[name]))
+        ctx = context.memctx(repo, (parent, None), '%s: change %d' % (rnd.choice(WORDS), rev), changed, filectx,
+                             'Developer %d <dev%d@example.com>' % (rev % 7, rev % 7), '%d 0' % (1330000000 + rev * 60),
+                             {'branch': branch})
+        heads[branch] = repo.commitctx(ctx)
+    return path
+
+
+def disk_usage(path):
+    """
+    bytes of files under ``path`` that are not hardlinks
+    """
+    total = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            info = os.lstat(os.path.join(root, name))
+            if info.st_nlink == 1:
+                total += info.st_size
+    return total
+
+
+def measure(source, target_dir):
+    results = []
+    for name, kwargs in MODES:
+        target = os.path.join(target_dir, name.replace(' ', '_'))
+        started = time.time()
+        Hg(target).clone(source, **kwargs)
+        results.append((name, time.time() - started, disk_usage(target)))
+        shutil.rmtree(target)
+    return results
+
+
+def main(argv):
+    changesets = int(argv[1]) if len(argv) > 1 else 2000
+    files = int(argv[2]) if len(argv) > 2 else 1000
+    source = os.path.join(tempfile.gettempdir(), 'dvcs-benchmark-%d-%d' % (changesets, files))
+    if not os.path.exists(source):
+        print 'generating %d changesets with %d files in %s' % (changesets, files, source)
+        generate(source, changesets, files)
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        for name, seconds, size in measure(source, target_dir):
+            print '%-16s %7.2f s %10.1f MB' % (name, seconds, size / 1024.0 ** 2)
+    finally:
+        shutil.rmtree(target_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
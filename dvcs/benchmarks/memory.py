@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory taken by log entries, plain dicts vs ``dvcs.changeset.Changeset``.
+
+Entries are made the way the xml log parser makes them (fresh strings for every entry), sizes are summed
+over all objects reachable from the entries, counting shared objects once.
+
+    python -m dvcs.benchmarks.memory [number of entries]
+"""
+import sys, random, hashlib
+
+from dateutil.parser import parse as dateutil_parse
+
+from dvcs.changeset import Changeset
+
+BRANCHES = [u'default'] + [u'feature-%d' % i for i in range(20)]
+AUTHORS = [u'Developer %d <developer%d@example.com>' % (i, i) for i in range(200)]
+DATE = '2012-03-02T15:50:05+01:00'
+
+
+def fields(count):
+    rnd = random.Random(count)
+    for rev in xrange(count):
+        yield dict(rev=rev, node=hashlib.sha1(str(rev)).hexdigest(),
+                   #copies, parser creates new string for every entry
+                   branch=u''.join(rnd.choice(BRANCHES)), author=u''.join(rnd.choice(AUTHORS)),
+                   mess=u'fixed issue #%d in the frobnicator' % rev,
+                   files=[u'src/module%d/file%d.py' % (rnd.randint(0, 50), i) for i in range(3)], tags=[], date=DATE)
+
+
+def as_dict(one):
+    one = dict(one)
+    one.update(short=one['node'][:12], date=dateutil_parse(one['date']))
+    return one
+
+
+def as_changeset(one):
+    return Changeset(date_parser=dateutil_parse, **one)
+
+
+def deep_size(objects):
+    seen, stack, total = set(), list(objects), 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, Changeset):
+            stack.extend(getattr(obj, slot) for slot in Changeset.__slots__)
+    return total
+
+
+def measure(count):
+    results = {}
+    for name, make in (('dict', as_dict), ('changeset', as_changeset)):
+        entries = [make(one) for one in fields(count)]
+        results[name] = deep_size(entries)
+    return results
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    results = measure(count)
+    for name in ('dict', 'changeset'):
+        print '%-10s %10.1f MB per %d entries, %6d B per entry' % (
+            name, results[name] / 1024.0 ** 2, count, results[name] / count)
+    print 'saved      %9.1f %%' % (100 - 100.0 * results['changeset'] / results['dict'])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency and memory of ``Hg`` methods on a generated repository, results saved as JSON for comparing runs.
+
+Repository of given size is generated from a fixed seed (kept in temp dir for next runs), so runs with the
+same parameters measure the same data and need no network. Every benchmark runs in a forked process: settings
+it changes don't leak and its peak memory (including hg processes it started) is reported on its own.
+Diff cache is off, so repeated runs measure the work and not the cache.
+
+    python -m dvcs.benchmarks.suite --changesets 5000 --files 2000 --branches 20 --output after.json
+    python -m dvcs.benchmarks.suite --output after.json --compare before.json
+
+With ``--compare`` the exit status is 1 when median of any benchmark is slower than ``--threshold`` allows.
+"""
+import os, sys, json, math, time, shutil, tempfile, platform, argparse
+
+from mercurial import hg, ui, util
+
+from dvcs import cache
+from dvcs.hg.wrapper import Hg
+from dvcs.benchmarks.clone import generate
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+
+def percentile(values, percent):
+    """
+    nearest rank percentile
+    """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+
+def benchmarks(path, pull_changesets):
+    """
+    [(name, setup, run)], ``setup`` result is passed to ``run`` and isn't timed
+    """
+    wrapper = Hg(path)
+    repo = hg.repository(ui.ui(), path)
+    tip = repo['default']
+    changed = tip.files()[0]
+    tip_node = tip.hex()
+    #working copy is at tip, diff the last changeset
+    last_change = '%s:%s' % (tip.p1().hex(), tip_node)
+    last = len(repo) - 1
+
+    def no_setup():
+        return wrapper
+
+    def fresh_branches():
+        Hg._branches_cache.clear()
+        return wrapper
+
+    def behind():
+        #clone of changeset pull_changesets from the end, pull brings the rest
+        target = tempfile.mkdtemp(prefix='dvcs-suite-pull-')
+        shutil.rmtree(target)
+        Hg(target).clone(path, noupdate=True, revision=str(max(0, last - pull_changesets)))
+        return Hg(target)
+
+    def pull(behind):
+        try:
+            behind.pull()
+        finally:
+            shutil.rmtree(behind.repo_path, ignore_errors=True)
+
+    return [
+        ('log_api', no_setup, lambda h: h.log(backend='api')),
+        ('log_xml', no_setup, lambda h: h.log(backend='xml')),
+        ('status', no_setup, lambda h: h.status()),
+        ('branches', fresh_branches, lambda h: h.branches()),
+        ('diff_unified', no_setup, lambda h: h.diff_unified(changed, identifier=last_change)),
+        ('diff_html', no_setup, lambda h: h.diff_html(changed, identifier=last_change)),
+        ('get_changed_files', no_setup, lambda h: h.get_changed_files(0, tip_node)),
+        ('pull', behind, pull),
+    ]
+
+
+def measure(setup, run, repeat):
+    """
+    runs in forked process, returns dict of timings and peak memory
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        status = 0
+        try:
+            settings.DVCS_DIFF_CACHE = None
+            cache.reset()
+            timings = []
+            run(setup()) #warm up
+            for _ in range(repeat):
+                arg = setup()
+                started = time.time()
+                run(arg)
+                timings.append(time.time() - started)
+            result = dict(timings=timings)
+        except Exception, e:
+            result, status = dict(error='%s: %s' % (e.__class__.__name__, e)), 1
+        with os.fdopen(write, 'w') as f:
+            json.dump(result, f)
+        os._exit(status)
+
+    os.close(write)
+    with os.fdopen(read) as f:
+        result = json.load(f)
+    _, _, usage = os.wait4(pid, 0)
+    if 'error' in result:
+        return result
+    timings = result['timings']
+    return dict(runs=len(timings), min=min(timings), max=max(timings), mean=sum(timings) / len(timings),
+                p50=percentile(timings, 50), p90=percentile(timings, 90), p99=percentile(timings, 99),
+                peak_rss_kb=usage.ru_maxrss)
+
+
+def compare(results, baseline, threshold):
+    """
+    prints changes of medians against ``baseline``, returns names of benchmarks slower than ``threshold``
+    """
+    slower = []
+    for name, one in sorted(results.items()):
+        before = baseline.get('results', {}).get(name)
+        if not before or 'p50' not in before or 'p50' not in one:
+            continue
+        ratio = one['p50'] / before['p50'] if before['p50'] else 1.0
+        print '%-18s %8.4f s -> %8.4f s %+7.1f %%' % (name, before['p50'], one['p50'], (ratio - 1) * 100)
+        if ratio > 1 + threshold:
+            slower.append(name)
+    return slower
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks dvcs.hg.wrapper.Hg on a generated repository.')
+    parser.add_argument('--changesets', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--branches', type=int, default=10)
+    parser.add_argument('--lines', type=int, default=200, help='lines per file')
+    parser.add_argument('--pull', type=int, default=50,
+                        help='pull starts from clone of changeset this far from the end (and its ancestors)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--only', nargs='*', help='names of benchmarks to run')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--compare', help='JSON of previous run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown of median, 0.2 is 20 %%')
+    args = parser.parse_args(argv[1:])
+
+    params = dict(changesets=args.changesets, files=args.files, branches=args.branches, lines=args.lines,
+                  pull=args.pull, repeat=args.repeat)
+    path = os.path.join(tempfile.gettempdir(), 'dvcs-suite-%(changesets)d-%(files)d-%(branches)d-%(lines)d' % params)
+    if not os.path.exists(path):
+        print 'generating %(changesets)d changesets, %(files)d files, %(branches)d branches in' % params, path
+        try:
+            generate(path, args.changesets, args.files, args.branches, args.lines)
+            Hg(path).update(branch='default')
+        except:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+    results = {}
+    for name, setup, run in benchmarks(path, args.pull):
+        if args.only and name not in args.only:
+            continue
+        results[name] = one = measure(setup, run, args.repeat)
+        if 'error' in one:
+            print '%-18s failed: %s' % (name, one['error'])
+        else:
+            print '%-18s p50 %8.4f s  p90 %8.4f s  p99 %8.4f s  peak %7.1f MB' % (
+                name, one['p50'], one['p90'], one['p99'], one['peak_rss_kb'] / 1024.0)
+
+    report = dict(params=params, results=results, created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  environment=dict(python=platform.python_version(), mercurial=util.version(),
+                                   platform=platform.platform()))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print 'warning: %s was measured with %s' % (args.compare, baseline.get('params'))
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print 'slower than %d %%: %s' % (args.threshold * 100, ', '.join(slower))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
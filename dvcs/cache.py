@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Cache for results that never change once computed, f.e. diffs between two changeset nodes.
+
+Values are pickled, so every ``get`` returns a fresh copy and sizes are known. Storage is chosen by
+DVCS_DIFF_CACHE: 'memory' (LRU in process), 'directory' (files in DVCS_DIFF_CACHE_DIR shared by processes, it
+has to be set and be private to the user as cached values are unpickled),
+'django' (django's cache DVCS_DIFF_CACHE_ALIAS) or None to switch caching off. Memory and directory caches
+drop least recently used values when they grow over DVCS_DIFF_CACHE_SIZE bytes.
+"""
+import os, stat, hashlib, tempfile, threading
+import cPickle as pickle
+from collections import OrderedDict
+
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+
+def make_key(*parts):
+    """
+    short key for any tuple of strings and numbers
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+class MemoryCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.values.pop(key, None)
+            if data is None:
+                return None
+            self.values[key] = data
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            old = self.values.pop(key, None)
+            self.size += len(data) - (len(old) if old is not None else 0)
+            self.values[key] = data
+            while self.size > self.max_size:
+                self.size -= len(self.values.popitem(last=False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.size = 0
+
+
+class DirectoryCache(object):
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path, 0700)
+        #anyone who can write there could plant a pickle
+        info = os.stat(path)
+        if info.st_uid != os.getuid() or info.st_mode & 0077:
+            raise DVCSException('Cache directory %s has to be owned by the user and closed to others (0700)' % path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(self._file(key), None) #lru by mtime
+        return value
+
+    def set(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+        #write and rename so that readers never see half written file
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, self._file(key))
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for name in os.listdir(self.path):
+            try:
+                info = os.stat(os.path.join(self.path, name))
+            except OSError: #removed meanwhile
+                continue
+            if stat.S_ISREG(info.st_mode) and not name.startswith('.tmp'):
+                files.append((info.st_mtime, info.st_size, name))
+        size = sum(one[1] for one in files)
+        for mtime, file_size, name in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            size -= file_size
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if os.path.isfile(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+
+
+class DjangoCache(object):
+    def __init__(self, alias='default', prefix='dvcs-diff-'):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.cache.get(self.prefix + key)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, value):
+        self.cache.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def clear(self):
+        self.cache.clear()
+
+
+_cache, _lock = None, threading.Lock()
+
+
+def get_cache():
+    """
+    shared cache configured by DVCS_DIFF_CACHE*, None if caching is off
+    """
+    global _cache
+    backend = getattr(settings, 'DVCS_DIFF_CACHE', 'memory')
+    if not backend:
+        return None
+    with _lock:
+        if _cache is None:
+            size = getattr(settings, 'DVCS_DIFF_CACHE_SIZE', 64 * 1024 * 1024)
+            if backend == 'memory':
+                _cache = MemoryCache(size)
+            elif backend == 'directory':
+                path = getattr(settings, 'DVCS_DIFF_CACHE_DIR', None)
+                if not path:
+                    raise DVCSException('DVCS_DIFF_CACHE = \'directory\' needs DVCS_DIFF_CACHE_DIR')
+                _cache = DirectoryCache(path, size)
+            elif backend == 'django':
+                _cache = DjangoCache(getattr(settings, 'DVCS_DIFF_CACHE_ALIAS', 'default'))
+            else:
+                raise DVCSException('Unknown DVCS_DIFF_CACHE %r' % backend)
+        return _cache
+
+
+def reset():
+    """
+    forgets the shared cache, next ``get_cache`` builds a new one from settings
+    """
+    global _cache
+    with _lock:
+        _cache = None
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Compact changeset record returned by log APIs.
+
+Behaves like the read/write dict the log APIs used to return (``entry['node']``, ``keys()``, comparison with
+dicts...) but keeps fields in slots, shares branch and author strings between records and computes ``short``
+and ``date`` only when asked for.
+"""
+
+_interned = {}
+
+
+def intern_string(string):
+    """
+    ``intern`` for unicode strings too
+    """
+    return _interned.setdefault(string, string)
+
+
+class Changeset(object):
+    KEYS = ('branch', 'mess', 'author', 'date', 'files', 'tags', 'rev', 'node', 'short')
+    __slots__ = ('rev', 'node', 'branch', 'author', 'mess', 'files', 'tags', '_date', '_date_parser')
+    __hash__ = None
+
+    def __init__(self, rev, node, branch, author, mess, date, files=None, tags=None, date_parser=None):
+        """
+        ``date`` is parsed by ``date_parser`` on first access if given
+        """
+        self.rev = rev
+        self.node = node
+        self.branch = intern_string(branch)
+        self.author = intern_string(author)
+        self.mess = mess
+        self.files = files if files is not None else []
+        self.tags = tags if tags is not None else []
+        self._date = date
+        self._date_parser = date_parser
+
+    @property
+    def short(self):
+        return self.node[:12]
+
+    def _get_date(self):
+        if self._date_parser is not None:
+            self._date, self._date_parser = self._date_parser(self._date), None
+        return self._date
+
+    def _set_date(self, date):
+        self._date, self._date_parser = date, None
+
+    date = property(_get_date, _set_date)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS or key == 'short':
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.KEYS else default
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def values(self):
+        return [getattr(self, key) for key in self.KEYS]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.KEYS]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (Changeset, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        return 'Changeset(%r)' % self.to_dict()
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        state.pop('short', None)
+        self.__init__(**state)
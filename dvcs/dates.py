@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Cheap conversions of dates coming from DVCS to timezone aware datetimes.
+"""
+import re
+from datetime import datetime, timedelta
+
+from dateutil.parser import parse as dateutil_parse
+from dateutil.tz import tzoffset
+
+RE_ISO_DATE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:([+-])(\d\d):?(\d\d)|Z)$')
+EPOCH = datetime(1970, 1, 1)
+
+_timezones = {}
+
+
+def timezone(offset):
+    """
+    tzinfo for offset in seconds east of UTC, instances are shared
+    """
+    tz = _timezones.get(offset)
+    if tz is None:
+        tz = _timezones[offset] = tzoffset(None, offset)
+    return tz
+
+
+def parse_iso(date):
+    """
+    parses ``2012-03-02T15:50:05+01:00`` like dates, anything else is left to dateutil
+    """
+    match = RE_ISO_DATE.match(date)
+    if match is None:
+        return dateutil_parse(date)
+    year, month, day, hour, minute, second, sign, tz_hours, tz_minutes = match.groups()
+    offset = 0
+    if sign:
+        offset = int(tz_hours) * 3600 + int(tz_minutes) * 60
+        offset = -offset if sign == '-' else offset
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=timezone(offset))
+    except ValueError:
+        return dateutil_parse(date)
+
+
+def from_timestamp(unixtime, offset):
+    """
+    datetime from mercurial's (unixtime, offset) where offset is in seconds west of UTC
+    """
+    #no fromtimestamp, it can't go before epoch on some platforms
+    return (EPOCH + timedelta(seconds=int(unixtime) - offset)).replace(tzinfo=timezone(-offset))
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Non blocking variant of ``Hg``.
+
+Methods of ``AsyncHg`` start hg in background and return ``Call`` right away. Output of all running calls is
+collected by ``Scheduler`` with ``select`` from a single thread, so many commands can run at once without
+a thread per command::
+
+    calls = [AsyncHg(path).get_head() for path in paths]
+    default_scheduler.wait(calls)
+    heads = [call.result() for call in calls]
+
+``call.result()`` returns the same value or raises the same ``DVCSException`` as the ``Hg`` method would.
+Calls for one repository are queued so that no more than HG_ASYNC_REPO_CONCURRENCY of them run at the same
+time, hg would only fight over the repository lock otherwise. To plug into another event loop watch
+``default_scheduler.filenos()`` and call ``default_scheduler.poll()`` when any of them is readable.
+
+Methods without hg command behind them (``diff_html`` with the api backend, ``diff_changeset``, ``diff_range``,
+``get_changed_paths``, ``get_remote``, ``log_api``, ``log_index``) read the repository in process, they block
+while computing and return already finished ``Call``. Generators ``iter_log``, ``iter_diff`` and
+``iter_changed_files`` are left as in ``Hg``, they stream results and are not async.
+
+Scheduler is not thread safe, drive it from one thread.
+"""
+import os, fcntl, select, time
+from collections import defaultdict, deque
+
+from dvcs import utils, instrument
+from dvcs.hg.wrapper import Hg
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+logging = settings.APP_LOGGER
+
+
+class Call(object):
+    """
+    hg command running in background (or waiting for its turn)
+    """
+
+    def __init__(self, scheduler, repo_path, argv, ignore_return_code=False, env=None, label=None):
+        self.scheduler = scheduler
+        self.label = label or 'hg'
+        self.repo_key = os.path.realpath(repo_path)
+        self.argv = argv
+        self.cmd = utils.command_line(argv)
+        self.env = env
+        self.ignore_return_code = ignore_return_code
+        self.process = None
+        self.streams = {}
+        self.out, self.err = [], []
+        self.callbacks = []
+        self.finished = False
+        self.value = self.error = None
+
+    def then(self, callback=None, errback=None):
+        """
+        ``callback`` gets result of the previous one, ``errback`` gets exception and may return value instead
+        """
+        self.callbacks.append((callback, errback))
+        if self.finished:
+            self._run_callbacks([self.callbacks[-1]])
+        return self
+
+    def start(self):
+        logging.debug('Executing async %s' % self.cmd)
+        self.started = time.time()
+        self.process = utils.popen(self.argv, True, env=self.env)
+        for stream, chunks in ((self.process.stdout, self.out), (self.process.stderr, self.err)):
+            fd = stream.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.streams[fd] = (stream, chunks)
+
+    def filenos(self):
+        return self.streams.keys()
+
+    def read(self, fd):
+        """
+        reads available output, returns True when the process has finished
+        """
+        stream, chunks = self.streams[fd]
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            return False
+        if data:
+            chunks.append(data)
+            return False
+
+        stream.close()
+        del self.streams[fd]
+        if self.streams:
+            return False
+        self._finish(self.process.wait())
+        return True
+
+    def _finish(self, code):
+        if instrument.hooks:
+            #cpu time of one of the processes running at once is not known
+            instrument.record(dict(kind='command', name=self.label, cmd=self.cmd, code=code, cpu=None,
+                                   bytes=sum(map(len, self.out + self.err)), wall=time.time() - self.started))
+        try:
+            self.value = utils.check_output(self.cmd, code, ''.join(self.out).strip(), ''.join(self.err).strip(),
+                                            self.ignore_return_code)
+        except DVCSException, e:
+            self.error = e
+        self.finished = True
+        self._run_callbacks(self.callbacks)
+
+    def _run_callbacks(self, callbacks):
+        for callback, errback in callbacks:
+            try:
+                if self.error is None:
+                    if callback is not None:
+                        self.value = callback(self.value)
+                elif errback is not None:
+                    self.value, self.error = errback(self.error), None
+            except Exception, e:
+                self.value, self.error = None, e
+
+    def done(self):
+        return self.finished
+
+    def result(self, timeout=None):
+        if not self.finished:
+            self.scheduler.wait([self], timeout)
+        if not self.finished:
+            raise DVCSException('Executing %s timed out' % self.cmd, cmd=self.cmd)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Finished(Call):
+    """
+    ``Call`` of in process computation, finished once created
+    """
+
+    def __init__(self, scheduler, repo_path, compute, label=None):
+        super(Finished, self).__init__(scheduler, repo_path, [], label=label)
+        try:
+            self.value = compute()
+        except DVCSException, e:
+            self.error = e
+        self.finished = True
+
+
+class Scheduler(object):
+    def __init__(self, concurrency=None):
+        """
+        ``concurrency`` is max number of running commands per repository
+        """
+        self.concurrency = concurrency or getattr(settings, 'HG_ASYNC_REPO_CONCURRENCY', 1)
+        self.pending = defaultdict(deque)
+        self.running = defaultdict(int)
+        self.fds = {}
+
+    def submit(self, call):
+        self.pending[call.repo_key].append(call)
+        self._start_pending(call.repo_key)
+        return call
+
+    def _start_pending(self, key):
+        queue = self.pending[key]
+        while queue and self.running[key] < self.concurrency:
+            call = queue.popleft()
+            try:
+                call.start()
+            except OSError, e:
+                call.error, call.finished = DVCSException('Executing %s failed: %s' % (call.cmd, e)), True
+                continue
+            self.running[key] += 1
+            for fd in call.filenos():
+                self.fds[fd] = call
+        if not queue:
+            del self.pending[key]
+
+    def filenos(self):
+        return self.fds.keys()
+
+    def poll(self, timeout=0):
+        """
+        reads whatever output is ready, waiting ``timeout`` seconds at most, returns list of finished calls
+        """
+        if not self.fds:
+            return []
+        readable = select.select(self.fds.keys(), [], [], timeout)[0]
+        finished = []
+        for fd in readable:
+            call = self.fds.pop(fd)
+            if call.read(fd):
+                finished.append(call)
+                self.running[call.repo_key] -= 1
+                self._start_pending(call.repo_key)
+            elif fd in call.streams:
+                self.fds[fd] = call
+        return finished
+
+    def wait(self, calls, timeout=None):
+        """
+        drives all running calls until ``calls`` are finished or ``timeout`` seconds passed
+        returns list of the finished ones
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while not all(call.done() for call in calls) and self.fds:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            self.poll(remaining)
+        return [call for call in calls if call.done()]
+
+
+default_scheduler = Scheduler()
+
+
+class AsyncHg(Hg):
+    """
+    ``Hg`` returning ``Call`` instead of results, log always comes from xml
+    """
+
+    def __init__(self, repo_path, scheduler=None):
+        self.repo_path = repo_path
+        self.scheduler = scheduler or default_scheduler
+
+    def _command(self, command, *args, **kwargs):
+        argv = self._command_line(command, *args, **kwargs)
+        return self.scheduler.submit(Call(self.scheduler, self.repo_path, argv, env=self._environ(),
+                                          ignore_return_code=kwargs.get('ignore_return_code', False),
+                                          label='hg.%s' % command))
+
+    def _finished(self, name, compute):
+        return Finished(self.scheduler, self.repo_path, compute, label='hg.%s' % name)
+
+    def status(self, *args):
+        return self._command('status', *args).then(self._parse_status)
+
+    def changed_between_nodes(self, start, end):
+        return self.status(*self._changed_between_nodes_args(start, end))
+
+    def diff_unified(self, path, identifier=None, **kwargs):
+        #not cached, the call isn't finished yet
+        return self._command('diff', *self._diff_unified_args(path, identifier))
+
+    def diff_html(self, path, identifier=None, **kwargs):
+        if getattr(settings, 'HG_DIFF_HTML_BACKEND', 'api') == 'extdiff':
+            return self.diff_html_extdiff(path, identifier=identifier)
+        return self._finished('diff_html', lambda: super(AsyncHg, self).diff_html(path, identifier=identifier,
+                                                                                 **kwargs))
+
+    def diff_changeset(self, rev, paths=None, html=False):
+        return self._finished('diff_changeset', lambda: super(AsyncHg, self).diff_changeset(rev, paths, html))
+
+    def diff_range(self, start, end=None, paths=None, html=False):
+        return self._finished('diff_range', lambda: super(AsyncHg, self).diff_range(start, end, paths, html))
+
+    def get_changed_paths(self, start_node, end_node):
+        return self._finished('get_changed_paths',
+                              lambda: super(AsyncHg, self).get_changed_paths(start_node, end_node))
+
+    def get_remote(self, name='default'):
+        return self._finished('get_remote', lambda: super(AsyncHg, self).get_remote(name))
+
+    def log_api(self, branch=None, **filters):
+        return self._finished('log_api', lambda: super(AsyncHg, self).log_api(branch=branch, **filters))
+
+    def log_index(self, branch=None):
+        return self._finished('log_index', lambda: super(AsyncHg, self).log_index(branch=branch))
+
+    def branches(self, heads=False, **kwargs):
+        return self._command('branches', '-c', '--debug' if heads else None).then(
+            lambda out: self._sort_branches(self._parse_branches(out, heads=heads)))
+
+    def push(self, **kwargs):
+        return self._command('push', '--new-branch' if kwargs.get('new_branch', False) else None).then(
+            self._parse_push_pull_out, self._push_pull_failed)
+
+    def pull(self, branch=None, *args):
+        if branch:
+            args = list(args) + ['--branch', branch]
+        return self._command('pull', *args).then(self._parse_push_pull_out, self._push_pull_failed)
+
+    def log(self, branch=None, backend=None, **filters):
+        return self.log_xml(branch=branch, **filters)
+
+    def log_xml(self, branch=None, **filters):
+        return self._command('log', *self._log_xml_args(branch=branch, **filters)).then(self._parse_log_page)
+
+    def user_commits(self, user, limit=None, **kwargs):
+        args = self._user_commits_args(user, limit=limit, **self._log_filters(kwargs))
+        return self._command('log', *args).then(lambda out: self._parse_log_page(out)[0])
+
+    def branch_revisions(self, branch, **kwargs):
+        args = self._branch_revisions_args(branch, **self._log_filters(kwargs))
+        return self._command('log', *args).then(lambda out: self._parse_log_page(out)[0])
+
+    def get_head(self, branch=None):
+        return self._command('log', *self._get_head_args(branch)).then(lambda out: self._parse_log(out)[0][0])
+
+    def get_heads(self, branches=None):
+        return self._command('log', *self._get_heads_args(branches)).then(
+            lambda out: self._newest_heads(self._parse_log_page(out)[1]))
+
+    def _no_incoming(self, e):
+        if e.code != 1: #no changesets
+            raise e
+
+    def has_new_changesets(self, branch=None):
+        return self._command('incoming', *(['--branch', branch] if branch else [])).then(
+            bool, lambda e: self._no_incoming(e) or False)
+
+    def get_new_changesets(self, branch=None):
+        return self._command('incoming', '--style', 'xml', *(['-b', branch] if branch else [])).then(
+            lambda out: self._parse_log(''.join(out.splitlines()[2:]))[0], self._no_incoming)
+
+    def get_changed_files(self, start_node, end_node):
+        revs = '%s:%s' % (start_node or '', end_node)
+        return self._command('log', '--verbose', '--style', 'xml', '--rev', revs).then(
+            lambda out: [(one['node'], one['files']) for one in self._parse_log(out)[0]])
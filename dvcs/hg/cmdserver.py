@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Client for mercurial's command server (``hg serve --cmdserver pipe``).
+
+A command server is a long-lived hg process bound to one repository. Commands are sent over its stdin
+and answered with framed chunks on its stdout, so every call saves a full python + mercurial startup.
+See http://mercurial.selenic.com/wiki/CommandServer for the protocol.
+"""
+import os, select, struct, subprocess, tempfile, threading, time
+
+from dvcs import utils
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+logging = settings.APP_LOGGER
+
+
+class CommandServer(object):
+    HEADER = struct.Struct('>cI')
+    RESULT = struct.Struct('>i')
+
+    def __init__(self, repo_path, hg_binary='hg'):
+        self.repo_path = repo_path
+        self.hg_binary = hg_binary
+        self.capabilities, self.encoding = [], None
+        self.lock = threading.Lock()
+        self.process = self.stderr = None
+        self.cmd = utils.command_line([hg_binary, '-R', repo_path, 'serve', '--cmdserver', 'pipe'])
+        self.started = self.last_used = None
+        self.start()
+
+    def start(self):
+        logging.debug('Starting command server for %s' % self.repo_path)
+        #stderr of the server goes to a file, a pipe nobody reads could fill up and block it
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen([self.hg_binary, '-R', self.repo_path, 'serve', '--cmdserver', 'pipe'],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr,
+                                            close_fds=True,
+                                            env=utils.environ(HGENCODING=getattr(settings, 'HG_ENCODING', None)))
+        except OSError, e:
+            self.stderr.close()
+            self.stderr = None
+            raise DVCSException('Executing %s failed: %s' % (self.cmd, e), cmd=self.cmd, code=127, stdout=u'',
+                                stderr=unicode(e))
+        self.started = self.last_used = time.time()
+        channel, hello = self._read_chunk()
+        if channel != 'o':
+            self._fail('Command server for %s sent unexpected greeting on channel %r' % (self.repo_path, channel))
+
+        for line in hello.splitlines():
+            key, _, value = line.partition(': ')
+            if key == 'capabilities':
+                self.capabilities = value.split()
+            elif key == 'encoding':
+                self.encoding = value
+
+        if 'runcommand' not in self.capabilities:
+            self._fail('Command server for %s does not support runcommand' % self.repo_path)
+
+    def restart(self):
+        self.close()
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+        self.process = None
+        self.stderr.close()
+        self.stderr = None
+
+    def _fail(self, message):
+        """
+        stops the server and raises ``DVCSException`` with what it wrote to stderr, like failed ``utils.run``
+        """
+        code, stderr = None, u''
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            code = self.process.wait()
+            self.stderr.seek(0)
+            stderr = self.stderr.read().strip().decode('utf8', 'replace')
+            self.close()
+        #killed by signal or still running when it broke the protocol is a failure too
+        code = code if code > 0 else 255
+        raise DVCSException('%s: %s failed %d stderr: %s' % (message, self.cmd, code, stderr), cmd=self.cmd,
+                            code=code, stdout=u'', stderr=stderr)
+
+    def _timed_out(self, cmd, timeout):
+        """
+        kills the server stuck in a command, the pool restarts it on next lease
+        """
+        try:
+            self.process.kill()
+        except OSError: #already gone
+            pass
+        self.close()
+        raise DVCSException('Executing %s timed out after %ss' % (cmd, timeout), cmd=cmd, code=None, stdout=u'',
+                            stderr=u'', timeout=True)
+
+    def _read(self, size, deadline=None):
+        chunks, fd = [], self.process.stdout.fileno()
+        while size:
+            if deadline is not None and not select.select([fd], [], [], max(0, deadline - time.time()))[0]:
+                return None
+            data = os.read(fd, size)
+            if not data:
+                self._fail('Command server for %s died unexpectedly' % self.repo_path)
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+    def _read_chunk(self, deadline=None):
+        """
+        (channel, data), None if ``deadline`` passed
+        """
+        header = self._read(self.HEADER.size, deadline)
+        if header is None:
+            return None
+        channel, length = self.HEADER.unpack(header)
+        if channel in 'IL':
+            #input request, length is the requested size and no data follows
+            return channel, length
+        data = self._read(length, deadline) if length else ''
+        return (channel, data) if data is not None else None
+
+    def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (IOError, OSError), e:
+            self._fail('Command server for %s died unexpectedly (%s)' % (self.repo_path, e))
+
+    def runcommand(self, args, timeout=None):
+        """
+        runs hg command given as argument list (without the ``hg`` itself)
+        returns (return code, stdout, stderr), the server is killed when the command runs over ``timeout`` seconds
+        """
+        args = [a.encode('utf8') if isinstance(a, unicode) else a for a in args]
+        data = '\0'.join(args)
+        out, err = [], []
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with self.lock:
+            if not self.is_alive():
+                self._fail('Command server for %s is not running' % self.repo_path)
+            self.last_used = time.time()
+            self._write('runcommand\n' + struct.pack('>I', len(data)) + data)
+            while True:
+                read = self._read_chunk(deadline)
+                if read is None:
+                    self._timed_out(utils.command_line([self.hg_binary] + args), timeout)
+                channel, chunk = read
+                if channel == 'o':
+                    out.append(chunk)
+                elif channel == 'e':
+                    err.append(chunk)
+                elif channel == 'r':
+                    return self.RESULT.unpack(chunk)[0], ''.join(out), ''.join(err)
+                elif channel in 'IL':
+                    #we're never interactive, answer every prompt with EOF
+                    self._write(struct.pack('>I', 0))
+                elif channel.isupper():
+                    self._fail('Command server for %s requested unknown channel %r' % (self.repo_path, channel))
+                #lowercase channels (debug etc.) are optional and safe to ignore
+
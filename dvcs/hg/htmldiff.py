@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Side by side html diff of two file versions, rendered in process.
+
+Lines are matched by mercurial's bdiff (C, the same matcher ``hg diff`` uses) instead of difflib, which is
+quadratic on big files. The table uses ``difflib.HtmlDiff`` css classes (diff, diff_header, diff_add, diff_chg,
+diff_sub), so existing styles keep working. Long files show only changed lines with context, binary files and
+files over the size limit get a one line notice instead of the diff.
+"""
+from cgi import escape
+
+from mercurial import bdiff
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+TABLE = u'<table class="diff" cellspacing="0" cellpadding="0" rules="groups">\n%s</table>\n'
+ROW = (u'<tr><td class="diff_header">%s</td><td nowrap="nowrap">%s</td>'
+       u'<td class="diff_header">%s</td><td nowrap="nowrap">%s</td></tr>\n')
+NOTICE = u'<tbody><tr><td class="diff_header" colspan="4">%s</td></tr></tbody>\n'
+
+
+def notice(text):
+    """
+    table with just one message
+    """
+    return TABLE % (NOTICE % escape(text))
+
+
+def split_lines(text):
+    """
+    lines the way bdiff counts them (last one may lack newline)
+    """
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def opcodes(old, new):
+    """
+    difflib like opcodes (tag, i1, i2, j1, j2) for lines of ``old`` and ``new`` texts
+    """
+    i = j = 0
+    for i1, i2, j1, j2 in bdiff.blocks(old, new):
+        if i < i1 and j < j1:
+            yield 'replace', i, i1, j, j1
+        elif i < i1:
+            yield 'delete', i, i1, j, j1
+        elif j < j1:
+            yield 'insert', i, i1, j, j1
+        if i1 < i2:
+            yield 'equal', i1, i2, j1, j2
+        i, j = i2, j2
+
+
+def groups(codes, numlines):
+    """
+    opcodes grouped into hunks with ``numlines`` of context, like ``SequenceMatcher.get_grouped_opcodes``
+    """
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            if not group:
+                i1, j1 = max(i1, i2 - numlines), max(j1, j2 - numlines)
+            elif i2 - i1 > 2 * numlines:
+                group.append((tag, i1, i1 + numlines, j1, j1 + numlines))
+                yield group
+                group = []
+                i1, j1 = i2 - numlines, j2 - numlines
+            if i1 < i2:
+                group.append((tag, i1, i2, j1, j2))
+        else:
+            group.append((tag, i1, i2, j1, j2))
+    if group and not all(code[0] == 'equal' for code in group):
+        if group[-1][0] == 'equal':
+            tag, i1, i2, j1, j2 = group[-1]
+            group[-1] = (tag, i1, min(i2, i1 + numlines), j1, min(j2, j1 + numlines))
+        yield group
+
+
+def _text(line):
+    line = line.rstrip(u'\r').expandtabs(8)
+    return escape(line).replace(u' ', u'&nbsp;')
+
+
+def _span(cls, line):
+    return u'<span class="%s">%s</span>' % (cls, _text(line)) if line else u''
+
+
+def _intraline(old, new):
+    """
+    marks the part of a changed line between common prefix and suffix
+    """
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    mark = lambda line: u'%s<span class="diff_chg">%s</span>%s' % (
+        _text(line[:prefix]), _text(line[prefix:len(line) - suffix]), _text(line[len(line) - suffix:]))
+    return mark(old), mark(new)
+
+
+def _rows(code, old, new, old_start=1, new_start=1):
+    tag, i1, i2, j1, j2 = code
+    for k in xrange(max(i2 - i1, j2 - j1)):
+        i, j = i1 + k, j1 + k
+        left = (i + old_start, old[i]) if i < i2 else (u'', None)
+        right = (j + new_start, new[j]) if j < j2 else (u'', None)
+        if tag == 'equal':
+            cells = _text(left[1]), _text(right[1])
+        elif left[1] is not None and right[1] is not None:
+            cells = _intraline(left[1], right[1])
+        else:
+            cells = (_span('diff_sub', left[1]) if left[1] is not None else u'',
+                     _span('diff_add', right[1]) if right[1] is not None else u'')
+        yield ROW % (left[0], cells[0], right[0], cells[1])
+
+
+def make_table(old, new, context=None, numlines=None, max_size=None):
+    """
+    html table diffing ``old`` and ``new`` (byte strings)
+    ``context`` shows only changes with ``numlines`` lines around them, by default for files longer than
+    HG_DIFF_HTML_CONTEXT_THRESHOLD lines
+    """
+    max_size = max_size if max_size is not None else getattr(settings, 'HG_DIFF_HTML_MAX_SIZE', None)
+    size = max(len(old), len(new))
+    if max_size and size > max_size:
+        return notice(u'File too large to diff (%d bytes)' % size)
+    if '\0' in old or '\0' in new:
+        return notice(u'Binary files differ')
+
+    old_lines = [line.decode('utf8', 'replace') for line in split_lines(old)]
+    new_lines = [line.decode('utf8', 'replace') for line in split_lines(new)]
+    if context is None:
+        threshold = getattr(settings, 'HG_DIFF_HTML_CONTEXT_THRESHOLD', 1000)
+        context = max(len(old_lines), len(new_lines)) > threshold
+    numlines = numlines if numlines is not None else getattr(settings, 'HG_DIFF_HTML_CONTEXT_LINES', 5)
+
+    codes = list(opcodes(old, new))
+    hunks = groups(codes, numlines) if context else [codes]
+    body = []
+    for hunk in hunks:
+        body.append(u'<tbody>\n')
+        for code in hunk:
+            body.extend(_rows(code, old_lines, new_lines))
+        body.append(u'</tbody>\n')
+    return TABLE % u''.join(body)
+
+
+def _change(i1, i2, j1, j2):
+    if i1 < i2 and j1 < j2:
+        return [('replace', i1, i2, j1, j2)]
+    elif i1 < i2:
+        return [('delete', i1, i2, j1, j2)]
+    elif j1 < j2:
+        return [('insert', i1, i2, j1, j2)]
+    return []
+
+
+def hunk_opcodes(lines):
+    """
+    opcodes and old and new lines for lines of unified diff hunk
+    """
+    old, new, codes = [], [], []
+    i = j = 0
+    for line in lines:
+        kind, text = line[:1] or u' ', line[1:]
+        if kind == u'-':
+            old.append(text)
+        elif kind == u'+':
+            new.append(text)
+        else:
+            codes.extend(_change(i, len(old), j, len(new)))
+            codes.append(('equal', len(old), len(old) + 1, len(new), len(new) + 1))
+            old.append(text)
+            new.append(text)
+            i, j = len(old), len(new)
+    codes.extend(_change(i, len(old), j, len(new)))
+    return codes, old, new
+
+
+def hunks_table(hunks):
+    """
+    html table from parsed unified diff hunks (see ``dvcs.hg.udiff``), only changes with their context
+    """
+    body = []
+    for hunk in hunks:
+        codes, old, new = hunk_opcodes(hunk['lines'])
+        body.append(u'<tbody>\n')
+        for code in codes:
+            body.extend(_rows(code, old, new, hunk['old_start'], hunk['new_start']))
+        body.append(u'</tbody>\n')
+    return TABLE % u''.join(body)
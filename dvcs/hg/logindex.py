@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent revision indexed copy of the changelog kept in sqlite.
+
+The index is brought up to date before every query: only changesets added since the last indexed tip
+are read from the changelog. When history was rewritten (strip, rollback) the highest revision whose node
+still matches is found by bisection and everything above it is reindexed.
+"""
+import os, sqlite3
+from collections import defaultdict
+from hashlib import sha1
+
+from mercurial.node import bin
+from mercurial.templatefilters import person, email
+
+from dvcs import dates
+from dvcs.changeset import Changeset
+from dvcs.hg import repocache
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+
+def _decode(string):
+    return string.decode('utf8', 'replace')
+
+
+class LogIndex(object):
+    SCHEMA_VERSION = 1
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS changesets (rev INTEGER PRIMARY KEY, node TEXT NOT NULL, branch TEXT NOT NULL, '
+        'user TEXT NOT NULL, time REAL NOT NULL, tz INTEGER NOT NULL, description TEXT NOT NULL, files TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS changesets_branch ON changesets (branch, rev)',
+    )
+    COLUMNS = 'rev, node, branch, user, time, tz, description, files'
+
+    def __init__(self, repo_path, index_path=None, record=Changeset, date_parser=None):
+        """
+        entries are made by ``record`` from log fields, ``date_parser`` turns hg (unixtime, offset) to datetime
+        """
+        self.repo_path = repo_path
+        self.record = record
+        self.date_parser = date_parser or (lambda date: dates.from_timestamp(*date))
+        self.index_path = index_path or self.default_path(repo_path)
+        self.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.conn.text_factory = str
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        with self.conn:
+            if version != self.SCHEMA_VERSION:
+                self.conn.execute('DROP TABLE IF EXISTS changesets')
+                self.conn.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    @staticmethod
+    def default_path(repo_path):
+        """
+        index lives inside .hg unless HG_LOG_INDEX_DIR is set
+        """
+        index_dir = getattr(settings, 'HG_LOG_INDEX_DIR', None)
+        if index_dir:
+            return os.path.join(index_dir, '%s.sqlite' % sha1(os.path.realpath(repo_path)).hexdigest())
+        return os.path.join(repo_path, '.hg', 'dvcs-logindex.sqlite')
+
+    def close(self):
+        self.conn.close()
+
+    def _indexed_node(self, rev):
+        row = self.conn.execute('SELECT node FROM changesets WHERE rev = ?', (rev,)).fetchone()
+        return row[0] if row else None
+
+    def _common_rev(self, repo, last_rev):
+        """
+        highest revision indexed with the same node as in repo, -1 if none
+        """
+        cl = repo.changelog
+        matches = lambda rev: cl.node(rev).encode('hex') == self._indexed_node(rev)
+        hi = min(last_rev, len(repo) - 1)
+        if hi == last_rev and matches(hi):
+            return hi
+        #revisions below stripped one keep their nodes, bisect for the highest match
+        lo = -1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if matches(mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def update(self, repo=None):
+        """
+        indexes changesets added since last update, returns the repository
+        """
+        repo = repo or repocache.get(self.repo_path)
+        cl = repo.changelog
+
+        def rows(start):
+            for rev in xrange(start, len(repo)):
+                node = cl.node(rev)
+                _, user, (time, tz), files, description, extra = cl.read(node)
+                yield (rev, node.encode('hex'), extra.get('branch', 'default'), user, time, tz, description,
+                       '\0'.join(files))
+
+        with self.conn:
+            last = self.conn.execute('SELECT MAX(rev) FROM changesets').fetchone()[0]
+            start = 0 if last is None else self._common_rev(repo, last) + 1
+            self.conn.execute('DELETE FROM changesets WHERE rev >= ?', (start,))
+            self.conn.executemany('INSERT INTO changesets (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)' % self.COLUMNS,
+                                  rows(start))
+        return repo
+
+    def _entry(self, repo, row):
+        rev, node, branch, user, time, tz, description, files = row
+        return self.record(branch=_decode(branch), mess=_decode(description),
+                           author=_decode('%s <%s>' % (person(user), email(user))),
+                           date=(time, tz), date_parser=self.date_parser,
+                           files=map(_decode, files.split('\0')) if files else [],
+                           tags=repo.nodetags(bin(node)), rev=rev, node=node)
+
+    def _select(self, where='', params=(), limit=None, branch=None):
+        repo = self.update()
+        if branch is not None:
+            branch = branch.encode('utf8') if isinstance(branch, unicode) else branch
+            if branch not in repo.branchmap():
+                raise DVCSException("unknown branch '%s'" % branch)
+            where, params = 'WHERE branch = ?', (branch,)
+        query = 'SELECT %s FROM changesets %s ORDER BY rev DESC' % (self.COLUMNS, where)
+        if limit:
+            query += ' LIMIT %d' % int(limit)
+        return [self._entry(repo, row) for row in self.conn.execute(query, params)]
+
+    def log(self, branch=None):
+        as_list = self._select(branch=branch or None)
+        as_dict = defaultdict(list)
+        for one in as_list:
+            as_dict[one['branch']].append(one)
+        return as_list, dict(as_dict)
+
+    def branch_revisions(self, branch):
+        return self._select(branch=branch)
+
+    def user_commits(self, user, limit=None):
+        #case insensitive substring match, same as ``hg log -u``
+        return self._select('WHERE instr(lower(user), ?)', (user.lower(),), limit=limit)
+
+    def get_head(self, branch=None):
+        heads = self._select(limit=1, branch=branch or None)
+        if not heads:
+            raise DVCSException('Repository %s is empty' % self.repo_path)
+        return heads[0]
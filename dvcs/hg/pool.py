@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded pool of command servers shared by all ``Hg`` instances in the process.
+
+Servers are keyed by repository path and kept in LRU order. The pool never runs more than ``max_size``
+processes: the least recently used idle server is stopped to make room, servers idle for longer than
+``idle_timeout`` seconds are stopped on the next pool access and dead servers are restarted on lease.
+Servers are started outside of the pool lock, their slot is reserved (``None`` in ``servers``) meanwhile.
+"""
+import os, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from dvcs import utils, instrument
+from dvcs.hg.cmdserver import CommandServer
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+logging = settings.APP_LOGGER
+
+
+class CommandServerPool(object):
+    def __init__(self, max_size=32, idle_timeout=300, wait_timeout=60):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.servers = OrderedDict() #key -> server, least recently used first
+        self.leases = {} #key -> number of running commands
+        self.starting = set() #keys of servers being started or restarted
+        self.stats = {'hits': 0, 'spawns': 0, 'evictions': 0, 'restarts': 0}
+        self.cond = threading.Condition()
+
+    def _key(self, repo_path, hg_binary):
+        return os.path.realpath(repo_path), hg_binary
+
+    def _stop(self, key):
+        server = self.servers.pop(key)
+        self.leases.pop(key, None)
+        self.stats['evictions'] += 1
+        if server is not None:
+            logging.debug('Evicting command server for %s' % server.repo_path)
+            server.close()
+
+    def _evict_idle(self):
+        if not self.idle_timeout:
+            return
+        deadline = time.time() - self.idle_timeout
+        for key, server in self.servers.items():
+            if not self.leases.get(key) and server.last_used < deadline:
+                self._stop(key)
+
+    def _make_room(self, wanted=None):
+        """
+        waits until one more server fits or another thread has started (is starting) the ``wanted`` one
+        """
+        started = time.time()
+        while len(self.servers) >= self.max_size and wanted not in self.servers:
+            idle = [key for key in self.servers if not self.leases.get(key)]
+            if idle:
+                self._stop(idle[0])
+                continue
+            remaining = self.wait_timeout - (time.time() - started)
+            if remaining <= 0:
+                raise DVCSException('No command server available, all %d are busy' % self.max_size)
+            self.cond.wait(remaining)
+
+    def acquire(self, repo_path, hg_binary='hg'):
+        """
+        returns running command server for ``repo_path``, it has to be given back by ``release``
+        """
+        key = self._key(repo_path, hg_binary)
+        with self.cond:
+            self._evict_idle()
+            started = time.time()
+            while True:
+                while key in self.starting:
+                    remaining = self.wait_timeout - (time.time() - started)
+                    if remaining <= 0:
+                        raise DVCSException('Command server for %s is still starting' % repo_path)
+                    self.cond.wait(remaining)
+                if key in self.servers or len(self.servers) < self.max_size:
+                    break
+                #another thread may start the same server while this one waits for room, check again
+                self._make_room(key)
+            server = self.servers.pop(key, None)
+            if server is not None:
+                self.stats['hits'] += 1
+                start = not server.is_alive()
+                if start:
+                    logging.warning('Command server for %s crashed, restarting' % server.repo_path)
+                    self.stats['restarts'] += 1
+            else:
+                self.stats['spawns'] += 1
+                start = True
+            self.servers[key] = server
+            self.leases[key] = self.leases.get(key, 0) + 1
+            if not start:
+                return server
+            self.starting.add(key)
+
+        #spawning takes a while, other repositories must not wait for it
+        try:
+            if server is None:
+                server = CommandServer(repo_path, hg_binary)
+            else:
+                server.restart()
+        except:
+            with self.cond:
+                self.starting.discard(key)
+                if key in self.servers and self.servers[key] in (None, server):
+                    del self.servers[key]
+                    self.leases.pop(key, None)
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.starting.discard(key)
+            if self.servers.get(key) is None:
+                #shut down meanwhile, the pool takes it back
+                self.servers[key] = server
+                self.leases.setdefault(key, 1)
+            self.cond.notify_all()
+        return server
+
+    def release(self, server):
+        key = self._key(server.repo_path, server.hg_binary)
+        with self.cond:
+            if self.servers.get(key) is server:
+                self.leases[key] -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def lease(self, repo_path, hg_binary='hg'):
+        server = self.acquire(repo_path, hg_binary)
+        try:
+            yield server
+        finally:
+            self.release(server)
+
+    def evict_idle(self):
+        with self.cond:
+            self._evict_idle()
+
+    def shutdown(self):
+        with self.cond:
+            for key in self.servers.keys():
+                self._stop(key)
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.servers)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    returns process wide pool configured by HG_CMDSERVER_POOL_SIZE and HG_CMDSERVER_IDLE_TIMEOUT
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = CommandServerPool(max_size=getattr(settings, 'HG_CMDSERVER_POOL_SIZE', 32),
+                                      idle_timeout=getattr(settings, 'HG_CMDSERVER_IDLE_TIMEOUT', 300))
+        return _pool
+
+
+def shutdown():
+    """
+    stops all servers in the process wide pool
+    """
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+
+
+def run(repo_path, args, cmd=None, hg_binary='hg', ignore_return_code=False, label=None, timeout=None):
+    """
+    runs hg command through the repo's command server, returns the same as ``dvcs.utils.shell``
+    """
+    cmd = cmd or ' '.join([hg_binary] + list(args))
+    logging.debug('Executing cmdserver %s' % cmd)
+    with instrument.command(label or 'hg', cmd, cpu=False) as event:
+        with get_pool().lease(repo_path, hg_binary) as server:
+            code, out, err = server.runcommand(args, timeout=timeout)
+        #same as the exit status of hg process
+        code &= 0xff
+        event.update(code=code, bytes=len(out) + len(err))
+    return utils.check_output(cmd, code, out.strip(), err.strip(), ignore_return_code)
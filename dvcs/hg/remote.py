@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Cheap questions about the remote a repository pulls from.
+
+``has_incoming`` asks the remote only for its branch heads (one round trip, no changesets are transferred) and
+checks whether all of them are known locally, which is exactly when ``hg incoming`` would find nothing.
+Remote heads are kept for HG_REMOTE_HEADS_TTL seconds, so polling many times in a row costs one request.
+"""
+import threading, time
+
+from mercurial import hg, error
+
+from dvcs.hg import repocache
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+_heads, _lock = {}, threading.Lock()
+
+
+def _repo(repo_path):
+    try:
+        return repocache.get(repo_path)
+    except error.RepoError, e:
+        raise DVCSException('Opening repository %s failed: %s' % (repo_path, e))
+
+
+def _source(repo, source=None):
+    return repo.ui.expandpath(source or 'default')
+
+
+def remote_branchmap(repo, source=None):
+    """
+    {branch: [head nodes]} of the remote, possibly from cache
+    """
+    source = _source(repo, source)
+    with _lock:
+        cached = _heads.get(source)
+    if cached is not None and time.time() - cached[0] < getattr(settings, 'HG_REMOTE_HEADS_TTL', 30):
+        return cached[1]
+
+    try:
+        branchmap = hg.peer(repo, {}, source).branchmap()
+    except (error.RepoError, error.Abort, EnvironmentError), e:
+        raise DVCSException('Reading heads of %s failed: %s' % (source, e), source=source)
+    with _lock:
+        _heads[source] = (time.time(), branchmap)
+    return branchmap
+
+
+def has_incoming(repo_path, branch=None, source=None):
+    """
+    True if the remote has changesets (on ``branch``) the repository doesn't
+    """
+    repo = _repo(repo_path)
+    branchmap = remote_branchmap(repo, source)
+    if branch:
+        #branchmap has names in HG_ENCODING (see dvcs.hg.repocache)
+        heads = branchmap.get(branch.encode('utf8') if isinstance(branch, unicode) else branch, [])
+    else:
+        heads = [node for nodes in branchmap.values() for node in nodes]
+    return not all(repo.known(heads))
+
+
+def forget(repo_path=None, source=None):
+    """
+    drops cached heads of repository's remote (all of them without ``repo_path``), f.e. after push
+    """
+    if repo_path is None:
+        with _lock:
+            _heads.clear()
+        return
+    source = _source(_repo(repo_path), source)
+    with _lock:
+        _heads.pop(source, None)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Repository objects shared by all ``Hg`` instances in the process.
+
+Opening a repository reads its config, requirements and changelog index, so API backed methods reuse one
+object per path. Before it is handed out, inode, size and mtime of changelog, dirstate, bookmarks and phases are
+compared with what they were last time (store files of ``hg share`` working copies are in the shared
+repository); when something changed the object drops its file caches (only the changed files are read again),
+when config or requirements changed the repository is opened anew.
+``forget`` makes the next ``get`` revalidate regardless, wrappers call it after commands changing the repository.
+
+Repository objects are not thread safe, every thread gets its own. At most HG_REPO_CACHE_SIZE of them are
+kept, least recently used are dropped.
+
+Mercurial in process converts branch names, users and messages to the encoding of the process locale (ascii
+for daemons without one), ``get`` sets it to HG_ENCODING, the same hg processes get as HGENCODING.
+"""
+import os, threading
+from collections import OrderedDict
+
+from mercurial import hg, ui, encoding
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+STATE_FILES = ('store/00changelog.i', 'dirstate', 'bookmarks', 'store/phaseroots', 'branch')
+CONFIG_FILES = ('hgrc', 'requires', 'sharedpath')
+
+_repos, _lock = OrderedDict(), threading.Lock() #(path, thread) -> [repo, config stamp, state stamp]
+
+
+def _shared_dir(path):
+    """
+    .hg directory holding the store, of the shared repository for ``hg share`` working copies
+    """
+    try:
+        with open(os.path.join(path, '.hg', 'sharedpath')) as f:
+            return os.path.join(path, '.hg', f.read().strip())
+    except IOError:
+        return os.path.join(path, '.hg')
+
+
+def _stamp(path, names, shared=None):
+    stamp = []
+    for name in names:
+        try:
+            info = os.stat(os.path.join(shared if name.startswith('store/') else os.path.join(path, '.hg'), name))
+            stamp.append((info.st_ino, info.st_size, info.st_mtime))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def get(repo_path):
+    """
+    up to date repository object for ``repo_path``
+    """
+    if getattr(settings, 'HG_ENCODING', None):
+        encoding.encoding = settings.HG_ENCODING
+    path = os.path.realpath(repo_path)
+    key = path, threading.current_thread().ident
+    config, state = _stamp(path, CONFIG_FILES), _stamp(path, STATE_FILES, _shared_dir(path))
+    with _lock:
+        cached = _repos.pop(key, None)
+    if cached is None or cached[1] != config:
+        cached = [hg.repository(ui.ui(), path), config, state]
+    elif cached[2] != state:
+        cached[0].invalidate()
+        cached[0].invalidatedirstate()
+        cached[2] = state
+    with _lock:
+        _repos[key] = cached
+        while len(_repos) > getattr(settings, 'HG_REPO_CACHE_SIZE', 64):
+            _repos.popitem(last=False)
+    return cached[0]
+
+
+def forget(repo_path=None):
+    """
+    next ``get`` of ``repo_path`` (of all repositories without it) revalidates its object
+    """
+    path = os.path.realpath(repo_path) if repo_path is not None else None
+    with _lock:
+        for key, cached in _repos.items():
+            if path is None or key[0] == path:
+                cached[2] = None
+
+
+def clear():
+    """
+    drops all repository objects
+    """
+    with _lock:
+        _repos.clear()
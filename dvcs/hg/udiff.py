@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Parses unified diffs (``hg diff``, with or without ``--git``) into ``FileDiff`` and ``Hunk`` objects.
+
+Nothing is copied out of the diff text up front: a ``FileDiff`` keeps offsets into the buffer and parses only
+its header, hunks are found when first asked for and their lines are split only when ``lines`` is read.
+Added/removed counts are counted right in the buffer, so stats of a huge diff cost no per line objects.
+
+``FileDiff`` and ``Hunk`` also behave like the dicts earlier versions returned (``one['path']``).
+"""
+import re
+
+RE_HUNK = re.compile(r'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+FILE_HEADER = 'diff '
+GIT_HEADER = 'diff --git '
+
+
+def _decode(string):
+    return string.decode('utf8', 'replace')
+
+
+class _Record(object):
+    """
+    read only dict interface over ``KEYS`` attributes
+    """
+    __slots__ = ()
+    KEYS = ()
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.KEYS else default
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.KEYS)
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, _Record)):
+            return self.to_dict() == (other if isinstance(other, dict) else other.to_dict())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.to_dict())
+
+
+class Hunk(_Record):
+    __slots__ = ('buffer', 'start', 'body', 'end', 'old_start', 'old_lines', 'new_start', 'new_lines')
+    KEYS = ('old_start', 'old_lines', 'new_start', 'new_lines', 'lines')
+
+    def __init__(self, buffer, start, end):
+        """
+        ``buffer[start:end]`` is the hunk starting with its @@ line
+        """
+        self.buffer, self.start, self.end = buffer, start, end
+        newline = buffer.find('\n', start, end)
+        self.body = newline + 1 if newline != -1 else end
+        old_start, old_lines, new_start, new_lines = RE_HUNK.match(buffer, start).groups()
+        self.old_start, self.new_start = int(old_start), int(new_start)
+        self.old_lines = int(old_lines) if old_lines is not None else 1
+        self.new_lines = int(new_lines) if new_lines is not None else 1
+
+    @property
+    def lines(self):
+        """
+        lines without newlines, first character is ' ', '-' or '+'
+        """
+        return [_decode(line.rstrip('\r')) for line in self.buffer[self.body:self.end].split('\n')
+                if line[:1] in (' ', '-', '+')]
+
+    @property
+    def added(self):
+        return self.buffer.count('\n+', self.body - 1, self.end)
+
+    @property
+    def removed(self):
+        return self.buffer.count('\n-', self.body - 1, self.end)
+
+    def __getstate__(self):
+        #own part of the buffer only
+        return dict(buffer=self.buffer[self.start:self.end], start=0, body=self.body - self.start,
+                    end=self.end - self.start, old_start=self.old_start, old_lines=self.old_lines,
+                    new_start=self.new_start, new_lines=self.new_lines)
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+class FileDiff(_Record):
+    __slots__ = ('buffer', 'start', 'end', 'hunks_start', 'path', 'old_path', 'status', 'binary', '_hunks', 'html')
+    KEYS = ('path', 'old_path', 'status', 'binary', 'added', 'removed', 'hunks', 'unified')
+
+    def __init__(self, buffer, start=0, end=None):
+        """
+        ``buffer[start:end]`` is diff of one file starting with its ``diff`` line
+        """
+        self.buffer, self.start = buffer, start
+        self.end = end if end is not None else len(buffer)
+        self._hunks, self.html = None, None
+        self.status, self.binary = 'modified', False
+        first = buffer.find('\n@@', start, self.end)
+        self.hunks_start = first + 1 if first != -1 else self.end
+        self._parse_header(buffer[start:self.hunks_start].split('\n'))
+
+    def _parse_header(self, lines):
+        old_path, path = self._header_paths(lines[0])
+        for line in lines[1:]:
+            line = line.rstrip('\r')
+            if line.startswith('new file mode'):
+                self.status = 'added'
+            elif line.startswith('deleted file mode'):
+                self.status = 'removed'
+            elif line.startswith('rename from ') or line.startswith('copy from '):
+                self.status = 'renamed' if line.startswith('rename') else 'copied'
+                old_path = line.split(' from ', 1)[1]
+            elif line.startswith('rename to ') or line.startswith('copy to '):
+                path = line.split(' to ', 1)[1]
+            elif line.startswith('GIT binary patch') or line.startswith('Binary file'):
+                self.binary = True
+            elif line.startswith('--- ') or line.startswith('+++ '):
+                name = line[4:].split('\t')[0]
+                if name == '/dev/null':
+                    self.status = 'added' if line[0] == '-' else 'removed'
+                elif line[0] == '-':
+                    old_path = name[2:] if name.startswith('a/') else name
+                else:
+                    path = name[2:] if name.startswith('b/') else name
+        self.path, self.old_path = _decode(path), _decode(old_path)
+        if self.binary:
+            self.hunks_start = self.end
+
+    def _header_paths(self, line):
+        """
+        paths from ``diff --git a/x b/y`` (ambiguous with spaces, --- and +++ lines win) or ``diff -r 1 -r 2 x``
+        """
+        line = line.rstrip('\r')
+        if not line.startswith(GIT_HEADER):
+            path = line.split(' ')[-1]
+            return path, path
+        rest = line[len(GIT_HEADER):]
+        half = (len(rest) - 1) // 2
+        if rest[half:half + 1] == ' ' and rest[2:half] == rest[half + 3:]:
+            return rest[2:half], rest[half + 3:]
+        old, _, new = rest.partition(' b/')
+        return old[2:], new
+
+    @property
+    def hunks(self):
+        if self._hunks is None:
+            self._hunks, start = [], self.hunks_start
+            while start < self.end:
+                found = self.buffer.find('\n@@', start, self.end)
+                end = found + 1 if found != -1 else self.end
+                self._hunks.append(Hunk(self.buffer, start, end))
+                start = end
+        return self._hunks
+
+    @property
+    def added(self):
+        return self.buffer.count('\n+', self.hunks_start - 1, self.end) if self.hunks_start < self.end else 0
+
+    @property
+    def removed(self):
+        return self.buffer.count('\n-', self.hunks_start - 1, self.end) if self.hunks_start < self.end else 0
+
+    @property
+    def unified(self):
+        return _decode(self.buffer[self.start:self.end])
+
+    def __getitem__(self, key):
+        if key == 'html' and self.html is not None:
+            return self.html
+        return super(FileDiff, self).__getitem__(key)
+
+    def to_dict(self):
+        one = super(FileDiff, self).to_dict()
+        if self.html is not None:
+            one['html'] = self.html
+        return one
+
+    def __getstate__(self):
+        return dict(buffer=self.buffer[self.start:self.end], start=0, end=self.end - self.start,
+                    hunks_start=self.hunks_start - self.start, path=self.path, old_path=self.old_path,
+                    status=self.status, binary=self.binary, _hunks=None, html=self.html)
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+def parse(data):
+    """
+    ``FileDiff`` for every file of diff text, all sharing ``data``
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    starts = [0] if data.startswith(FILE_HEADER) else []
+    start = data.find('\n' + FILE_HEADER)
+    while start != -1:
+        starts.append(start + 1)
+        start = data.find('\n' + FILE_HEADER, start + 1)
+    return [FileDiff(data, start, end) for start, end in zip(starts, starts[1:] + [len(data)])]
+
+
+def iter_parse(lines):
+    """
+    ``FileDiff`` for every file of diff coming as lines, f.e. from a running command
+    """
+    current = []
+    for line in lines:
+        if line.startswith(FILE_HEADER) and current:
+            yield FileDiff(''.join(current))
+            current = []
+        current.append(line)
+    if current:
+        yield FileDiff(''.join(current))
@@ -1,12 +1,16 @@
-import re, os
+import re, os, glob, shlex, hashlib, time, itertools
 from collections import defaultdict
 from xml.etree import ElementTree
 
-from dateutil.parser import parse as dateutil_parse
-from mercurial import hg, ui
-from mercurial.util import datestr
+from mercurial import error, scmutil, util
+from mercurial.node import hex
+from mercurial.revset import formatspec
 
-from dvcs import utils
+from dvcs import utils, dates, instrument
+from dvcs.cache import get_cache, make_key
+from dvcs.changeset import Changeset
+from dvcs.hg import pool, htmldiff, udiff, remote, repocache
+from dvcs.hg.logindex import LogIndex
 from dvcs.wrapper import DVCSWrapper, DVCSException
 
 try:
@@ -14,6 +18,7 @@ try:
 except ImportError:
     import dvcs.settings as settings
 
+logging = settings.APP_LOGGER
 DIR_SCRIPT = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -24,64 +29,135 @@ class Hg(DVCSWrapper):
     RE_PUSH_PULL_OUT = re.compile(
         r'added (?P<changesets>\d+) changesets with (?P<changes>\d+) changes to (?P<files>\d+) files')
     NO_PUSH_PULL = {'files': 0, 'changesets': 0, 'changes': 0}
+    LOG_FILTERS = ('offset', 'limit', 'date', 'paths', 'revset')
+    CHANGING_COMMANDS = ('add', 'branch', 'commit', 'merge', 'pull', 'update') #cached repository is revalidated
+    _branches_cache = {} #repo path -> ((number of changesets, tip), branches)
 
-    #TODO rename ``use_repo_path``
-    def _command(self, command, *args, **kwargs):
+    def _hg_binary(self, command):
         hg_binary = getattr(settings, 'HG_BINARY', 'hg')
         '''
             this allows to override default hg binary for certain commands. f.e if you need to log remote repo
             HG_COMMANDS_WITH_OTHER_BINARY = ['log']
             HG_OTHER_BINARY = 'ssh -C remote.server hg'
         '''
-
         if command in getattr(settings, 'HG_COMMANDS_WITH_OTHER_BINARY', []):
             hg_binary = getattr(settings, 'HG_OTHER_BINARY', hg_binary)
+        return hg_binary
+
+    def _config(self, extra=()):
+        """
+        --config arguments for HG_CONFIG plus ``extra`` (f.e. extensions enabled for one command)
+        """
+        argv = []
+        for config in shlex.split(getattr(settings, 'HG_CONFIG', '')) + list(extra):
+            argv.extend(['--config', config])
+        return argv
+
+    #TODO rename ``use_repo_path``
+    def _command_argv(self, command, *args, **kwargs):
+        """
+        hg arguments without the binary, ``None`` args are left out
+        """
+        argv = ['-R', self.repo_path] if kwargs.get('use_repo_path', True) else []
+        argv.extend(self._config(kwargs.get('config', ())))
+        argv.append(command)
+        argv.extend(arg if isinstance(arg, basestring) else str(arg) for arg in args if arg is not None)
+        return argv
 
-        use_repo_path = kwargs.get('use_repo_path', True)
-        repo_path = '-R %s' % self.repo_path if use_repo_path else ''
-        config = getattr(settings, 'HG_CONFIG', '')
-        cmd = '%(prepend)s %(hg_binary)s %(repo_path)s %(config)s %(command)s %(args)s' % dict(
-            prepend=kwargs.get('prepend', ''),
-            hg_binary=hg_binary,
-            repo_path=repo_path,
-            config='--config %s' % config if config else '',
-            command=command,
-            args=' '.join(args))
-        return utils.shell(cmd, ignore_return_code=kwargs.get('ignore_return_code', False))
+    def _command_line(self, command, *args, **kwargs):
+        """
+        argument list to execute, ``prepend`` makes it go through shell
+        """
+        argv = shlex.split(self._hg_binary(command)) + self._command_argv(command, *args, **kwargs)
+        if kwargs.get('prepend'):
+            return ['/bin/sh', '-c', '%s %s' % (kwargs['prepend'], utils.command_line(argv))]
+        return argv
 
+    def _environ(self):
+        return utils.environ(HGENCODING=getattr(settings, 'HG_ENCODING', None))
+
+    def _command(self, command, *args, **kwargs):
+        argv = self._command_line(command, *args, **kwargs)
+        ignore_return_code = kwargs.get('ignore_return_code', False)
+
+        '''
+            HG_COMMAND_BACKEND = 'cmdserver' runs commands through a pooled persistent command server per repo,
+            anything the command server can't do the same way as a new process (other binary, prepend, commands
+            not bound to the repo, extensions enabled on the fly) still runs hg binary
+        '''
+        hg_binary = getattr(settings, 'HG_BINARY', 'hg')
+        timeout = kwargs.get('timeout', getattr(settings, 'HG_COMMAND_TIMEOUT', None))
+        try:
+            if (getattr(settings, 'HG_COMMAND_BACKEND', 'shell') == 'cmdserver' and kwargs.get('use_repo_path', True)
+                and self._hg_binary(command) == hg_binary and not kwargs.get('prepend') and not kwargs.get('config')):
+                return pool.run(self.repo_path, self._command_argv(command, *args, use_repo_path=False),
+                                cmd=utils.command_line(argv), hg_binary=hg_binary,
+                                ignore_return_code=ignore_return_code, label='hg.%s' % command, timeout=timeout)
+            return utils.run(argv, ignore_return_code=ignore_return_code, env=self._environ(), timeout=timeout,
+                             label='hg.%s' % command)
+        finally:
+            if command in self.CHANGING_COMMANDS:
+                repocache.forget(self.repo_path)
+
+    @instrument.timed('parse_date')
     def _parse_date(self, date):
-        return dateutil_parse(date)
+        return dates.parse_iso(date)
+
+    def _api_date(self, date):
+        return dates.from_timestamp(*date)
 
+    def _changeset(self, **fields):
+        """
+        log entry, plain dict if HG_LOG_RECORD = 'dict'
+        """
+        changeset = Changeset(**fields)
+        if getattr(settings, 'HG_LOG_RECORD', 'changeset') == 'dict':
+            return changeset.to_dict()
+        return changeset
+
+    def _parse_log_entry(self, one):
+        branch = one.find('branch')
+        item = dict(branch=unicode(branch.text) if branch is not None else u'default', files=[],
+                    rev=int(one.attrib['revision']), node=one.attrib['node'], tags=[],
+                    mess=None, author=None, date=None, date_parser=self._parse_date)
+
+        for el in one:
+            if el.tag == 'branch':
+                item['branch'] = unicode(el.text)
+            elif el.tag == 'msg':
+                item['mess'] = unicode(el.text)
+            elif el.tag == 'author':
+                item['author'] = unicode('%s <%s>' % (el.text, el.attrib['email']))
+            elif el.tag == 'date':
+                item['date'] = el.text
+            elif el.tag == 'paths':
+                item['files'] = [f.text for f in el.findall('path')]
+            elif el.tag == 'tag':
+                item['tags'] = [el.text]
+        return self._changeset(**item)
+
+    @instrument.timed('parse_log')
     def _parse_log(self, xml):
         try:
-            tree = ElementTree.XML(xml)
+            #ElementTree wants bytes for anything non ascii
+            tree = ElementTree.XML(xml.encode('utf8') if isinstance(xml, unicode) else xml)
             as_list, as_dict = [], defaultdict(list)
 
             for one in tree.findall('logentry'):
-                branch = one.find('branch')
-                item = dict(branch=unicode(branch.text) if branch is not None else u'default', files=[],
-                            rev=int(one.attrib['revision']),
-                            node=one.attrib['node'], short=one.attrib['node'][:12], tags=[])
-
-                for el in one:
-                    if el.tag == 'branch':
-                        item['branch'] = unicode(el.text)
-                    elif el.tag == 'msg':
-                        item['mess'] = unicode(el.text)
-                    elif el.tag == 'author':
-                        item['author'] = unicode('%s <%s>' % (el.text, el.attrib['email']))
-                    elif el.tag == 'date':
-                        item['date'] = self._parse_date(el.text)
-                    elif el.tag == 'paths':
-                        item['files'] = [f.text for f in el.findall('path')]
-                    elif el.tag == 'tag':
-                        item['tags'] = [el.text]
+                item = self._parse_log_entry(one)
                 as_list.append(item)
                 as_dict[item['branch']].append(item)
         except Exception, e:
             raise DVCSException('Log parsing failed: %s' % e)
         return as_list, dict(as_dict)
 
+    def _parse_log_page(self, out):
+        '''
+            hg log -r prints nothing at all (not even empty xml) when the revset selects no changesets
+        '''
+        return self._parse_log(out) if out.strip() else ([], {})
+
+    @instrument.timed('parse_push_pull_out')
     def _parse_push_pull_out(self, out):
         search = re.search(self.RE_PUSH_PULL_OUT, out)
         if search is None:
@@ -92,88 +168,147 @@ class Hg(DVCSWrapper):
         return counts
 
 
-    def clone(self, remote_path):
-        return self._command('clone', remote_path, self.repo_path, use_repo_path=False)
+    def clone(self, remote_path, noupdate=False, hardlink=True, uncompressed=False, share=False, revision=None,
+              branch=None, update=None):
+        """
+        ``noupdate`` leaves working directory empty, ``update`` checks out given revision
+        ``hardlink=False`` copies local store instead of hardlinking it (hg clone --pull)
+        ``uncompressed`` streams the store as is, fast over LAN
+        ``share`` makes working directory using store of local ``remote_path`` (hg share)
+        ``revision`` and ``branch`` (one or list) clone only part of history
+        """
+        if share:
+            if revision or branch or uncompressed:
+                raise DVCSException('Shared repository has whole history of its source.')
+            return self._command('share', '-U' if noupdate else None, remote_path, self.repo_path,
+                                 use_repo_path=False, config=['extensions.share='])
+
+        args = ['-U' if noupdate else None,
+                '--pull' if not hardlink else None,
+                '--uncompressed' if uncompressed else None]
+        for option, values in (('-r', revision), ('-b', branch), ('-u', update)):
+            for value in (values if isinstance(values, (list, tuple)) else [values]):
+                args.extend([option, value] if value is not None else [])
+        return self._command('clone', *(args + [remote_path, self.repo_path]), use_repo_path=False)
 
     def branch(self, name):
-        return self._command('branch', name)
+        return self._command('branch', name or None)
 
     def add(self, *args):
         if not args:
-            args = ['%s' % os.path.join(self.repo_path, '*'), ]
+            pattern = os.path.join(self.repo_path, '*')
+            args = sorted(glob.glob(pattern)) or [pattern]
         return self._command('add', *args)
 
 
     #TODO conflict handling
     def commit(self, message, user=None, addremove=True, files=None):
-        files = files if files else []
-        args = ['-m "%s"' % message,
-                '%s' % '--addremove' if addremove else '',
-                '%s' % '--user %s' % user if user else '',
-                ' '.join(files)
-        ]
+        args = ['-m', message, '--addremove' if addremove else None]
+        if user:
+            args.extend(['--user', user])
+        args.extend(files or [])
         return self._command('commit', *args)
 
 
     def merge(self, branch=None, revision=None, **kwargs):
         if revision and branch:
             raise DVCSException('If revision is specified, branch cannot be set.')
-        args = ['%s' % branch if branch else '',
-                '%s' % '--rev %s' % revision if revision else '',
-                "--config merge-tools.e.args='$base $local $other $output'",
-                "--config merge-tools.e.priority=1000",
-                "--config merge-tools.e.executable=%s" % os.path.join(DIR_SCRIPT, 'mergetool.py'),
-                "--config merge-tools.e.premerge=True",
-                "--noninteractive",
-                "--preview" if kwargs.get('preview', False) else '',
+        args = [branch or None,
+                '--rev' if revision else None, revision or None,
+                '--config', 'merge-tools.e.args=$base $local $other $output',
+                '--config', 'merge-tools.e.priority=1000',
+                '--config', 'merge-tools.e.executable=%s' % os.path.join(DIR_SCRIPT, 'mergetool.py'),
+                '--config', 'merge-tools.e.premerge=True',
+                '--noninteractive',
+                '--preview' if kwargs.get('preview', False) else None,
         ]
 
         return self._command('merge', *args)
 
 
+    def _push_pull_failed(self, e):
+        if e.code == 1 and 'no changes found' in e.stdout:
+            return self.NO_PUSH_PULL
+        raise e
+
     def push(self, **kwargs):
         """
         HG specific command `new_branch` set to True
         """
         try:
             out = self._command('push',
-                                '--new-branch' if kwargs.get('new_branch', False) else ''
+                                '--new-branch' if kwargs.get('new_branch', False) else None
             )
         except DVCSException, e:
-            if e.code == 1 and 'no changes found' in e.stdout:
-                return self.NO_PUSH_PULL
-            raise e
+            return self._push_pull_failed(e)
+        remote.forget(self.repo_path) #remote heads have changed
         return self._parse_push_pull_out(out)
 
 
     def pull(self, branch=None, *args):
+        counts = self._pull_incoming_bundle(branch) if not args else None
         if branch:
-            args = list(args)
-            args.append('--branch \'%s\'' % branch)
+            args = list(args) + ['--branch', branch]
         try:
             out = self._command('pull', *args)
         except DVCSException, e:
-            if e.code == 1 and 'no changes found' in e.stdout:
-                return self.NO_PUSH_PULL
-            raise e
-        return self._parse_push_pull_out(out)
+            out = None
+            result = self._push_pull_failed(e)
+        if out is not None:
+            result = self._parse_push_pull_out(out)
+        if counts:
+            result = dict((k, v + counts[k]) for k, v in result.items())
+        return result
+
+    def get_remote(self, name='default'):
+        try:
+            return self._repo().ui.config('paths', name)
+        except error.RepoError, e:
+            raise DVCSException('Reading paths of %s failed: %s' % (self.repo_path, e))
+
+    def _incoming_bundle(self, branch=None):
+        branch = branch.encode('utf8') if isinstance(branch, unicode) else branch or ''
+        return os.path.join(self.repo_path, '.hg', 'dvcs-incoming-%s.hg' % hashlib.sha1(branch).hexdigest()[:12])
+
+    def _pull_incoming_bundle(self, branch=None):
+        '''
+            changesets get_new_changesets has already downloaded are pulled from its bundle,
+            the following pull from remote then transfers only what came after
+        '''
+        bundle = self._incoming_bundle(branch)
+        if not os.path.exists(bundle):
+            return None
+        try:
+            if time.time() - os.path.getmtime(bundle) < getattr(settings, 'HG_INCOMING_BUNDLE_TTL', 600):
+                return self._parse_push_pull_out(self._command('pull', bundle))
+        except DVCSException, e:
+            logging.warning('Pulling from %s failed: %s' % (bundle, e))
+        finally:
+            os.remove(bundle)
 
 
     def update(self, branch=None, revision=None, clean=True, **kwargs):
         if revision and branch:
             raise DVCSException('If revision is specified, branch cannot be set.')
-        args = ['%s' % branch if branch else '',
-                '%s' % '--rev %s' % revision if revision else '',
-                '-C' if clean else '',
+        args = [branch or None,
+                '--rev' if revision else None, revision or None,
+                '-C' if clean else None,
         ]
         return self._command('update', *args)
 
+    def purge(self, all=False):
+        """
+        removes files hg doesn't track, with ``all`` also the ignored ones
+        """
+        return self._command('purge', '--all' if all else None, config=['extensions.purge='])
+
 
     def init_repo(self):
         return self._command('init', self.repo_path, use_repo_path=False)
 
-    def status(self, *args):
-        out = self._command('status', *args).strip()
+    @instrument.timed('parse_status')
+    def _parse_status(self, out):
+        out = out.strip()
         map = {'A': 'added', '!': 'missing', 'M': 'modified', 'R': 'removed', '?': 'not_versioned'}
         #default empty set
         changes = {'added': [], 'modified': [], 'missing': [], 'not_versioned': [], 'removed': []}
@@ -186,75 +321,274 @@ class Hg(DVCSWrapper):
             changes.setdefault(map[change], []).append(path)
         return changes
 
-    def log_xml(self, branch=None):
-        args = ['--style xml', '--verbose']
-        if branch:
-            args.append('--branch \'%s\'' % branch)
-        out = self._command('log', *args)
-        log = self._parse_log(out)
+    def _repo(self):
+        '''
+            repository object shared in process, see dvcs.hg.repocache
+        '''
+        try:
+            return repocache.get(self.repo_path)
+        except error.RepoError, e:
+            raise DVCSException('Opening repository %s failed: %s' % (self.repo_path, e))
 
-        return log
+    def _use_status_api(self):
+        '''
+            HG_STATUS_BACKEND = 'api' serves status (without arguments) and changed_between_nodes
+            by repo.status() in process, 'command' runs hg status
+        '''
+        return getattr(settings, 'HG_STATUS_BACKEND', 'api') == 'api'
 
-    def log_api(self, branch=None):
-        def enc(string):
-            try:
-                for e in ('utf8', 'latin1', 'windows-1250', 'windows-1252'):
-                    return string.decode(e)
-            except UnicodeError:
-                return string.decode('ascii', 'ignore')
+    def _status_api(self, start=None, end=None):
+        try:
+            repo = self._repo()
+            if start is None:
+                st = repo.status(unknown=True)
+            else:
+                st = repo.status(repo[str(start)], repo[str(end)])
+        except (error.RepoError, error.LookupError, error.Abort), e:
+            raise DVCSException('Status failed: %s' % e)
+        decode = lambda paths: [path.decode('utf8', 'replace') for path in paths]
+        modified, added, removed, missing, not_versioned = map(decode, st[:5])
+        return {'added': added, 'modified': modified, 'missing': missing, 'not_versioned': not_versioned,
+                'removed': removed}
+
+    def status(self, *args):
+        if not args and self._use_status_api():
+            return self._status_api()
+        return self._parse_status(self._command('status', *args))
 
+    def _log_filters(self, kwargs):
+        return dict((k, v) for k, v in kwargs.items() if k in self.LOG_FILTERS and v)
 
-        repo = hg.repository(ui.ui(), self.repo_path)
-        as_list, as_dict = [], defaultdict(list)
+    def _log_revset(self, branch=None, user=None, offset=None, limit=None, date=None, paths=None, revset=None):
+        """
+        builds revset selecting one page of log from the newest, so hg does the filtering and paging
+        ``date`` is hg date spec (see hg help dates), ``paths`` are relative to repo root
+        """
+        spec = lambda expr, arg: formatspec(expr, arg.encode('utf8') if isinstance(arg, unicode) else arg)
+        conds = ['(%s)' % revset] if revset else []
+        if branch:
+            conds.append(spec('branch(%s)', branch))
+        if user:
+            conds.append(spec('user(%s)', user))
+        if date:
+            conds.append(spec('date(%s)', date))
+        if paths:
+            conds.append('(%s)' % ' or '.join(spec('file(%s)', 'path:%s' % path) for path in paths))
+
+        expr = 'reverse(%s)' % (' and '.join(conds) or 'all()')
+        if offset:
+            return '%s - limit(%s, %d)' % ('limit(%s, %d)' % (expr, offset + limit) if limit else expr, expr, offset)
+        if limit:
+            return 'limit(%s, %d)' % (expr, limit)
+        return expr
+
+    def _log_xml_args(self, branch=None, **filters):
+        args = ['--style', 'xml', '--verbose']
+        filters = self._log_filters(filters)
+        if filters:
+            args.extend(['-r', self._log_revset(branch=branch, **filters)])
+        elif branch:
+            args.extend(['--branch', branch])
+        return args
+
+    def log_xml(self, branch=None, **filters):
+        out = self._command('log', *self._log_xml_args(branch=branch, **filters))
+        log = self._parse_log_page(out)
+
+        return log
 
-        for rev in repo:
+    def _decode_path(self, string):
+        try:
+            for e in ('utf8', 'latin1', 'windows-1250', 'windows-1252'):
+                return string.decode(e)
+        except UnicodeError:
+            return string.decode('ascii', 'ignore')
+
+    def _api_entry(self, rev_obj):
+        return self._changeset(branch=rev_obj.branch(), mess=rev_obj.description(), author=rev_obj.user(),
+                               date=rev_obj.date(), date_parser=self._api_date,
+                               files=map(self._decode_path, rev_obj.files()), tags=rev_obj.tags(), rev=rev_obj.rev(),
+                               node=rev_obj.hex())
+
+    def iter_log(self, branch=None, since=None, limit=None, backend=None):
+        """
+        walks the changelog from tip down, ``since`` is revision (number, node, tag...) where to stop
+        ``backend='xml'`` streams ``hg log`` output instead of opening the repository in process
+        """
+        if backend == 'xml':
+            return self._iter_log_xml(branch=branch, since=since, limit=limit)
+        return self._iter_log_api(branch=branch, since=since, limit=limit)
+
+    def _iter_log_api(self, branch=None, since=None, limit=None):
+        try:
+            repo = self._repo()
+            stop = repo[since].rev() if since is not None else -1
+        except (error.RepoError, error.LookupError), e:
+            raise DVCSException('Log failed: %s' % e)
+        count = 0
+
+        for rev in xrange(len(repo) - 1, stop, -1):
+            if limit and count >= limit:
+                break
             rev_obj = repo[rev]
-            branch_ = rev_obj.branch()
-            if branch and branch != branch_:
+            if branch and branch != rev_obj.branch():
                 continue
+            count += 1
+            yield self._api_entry(rev_obj)
+
+    def _iter_log_xml(self, branch=None, since=None, limit=None):
+        revset = formatspec('(%s:) - %s', str(since), str(since)) if since is not None else None
+        args = self._log_xml_args(branch=branch, revset=revset, limit=limit)
+        chunks = utils.stream(self._command_line('log', *args), timeout=getattr(settings, 'HG_COMMAND_TIMEOUT', None),
+                              env=self._environ(), label='hg.log')
+        try:
+            #no output at all when nothing matches
+            first = next(chunks, None)
+            if first is None:
+                return
+            for event, el in ElementTree.iterparse(utils.StreamReader(itertools.chain([first], chunks))):
+                if el.tag == 'logentry':
+                    yield self._parse_log_entry(el)
+                    el.clear()
+        except SyntaxError, e:
+            #hg failed half way, its error says more than the broken xml
+            for chunk in chunks:
+                pass
+            raise DVCSException('Log parsing failed: %s' % e)
+        finally:
+            chunks.close()
 
-            node = rev_obj.hex()
-            date = self._parse_date(datestr(rev_obj.date()))
-            one = dict(branch=branch_, mess=rev_obj.description(), author=rev_obj.user(),
-                       date=date, files=map(enc, rev_obj.files()), tags=rev_obj.tags(),
-                       rev=rev, node=node, short=node[:12]
-            )
+    def log_api(self, branch=None, **filters):
+        as_list, as_dict = [], defaultdict(list)
 
-            as_list.insert(0, one)
-            as_dict[branch_].insert(0, one)
+        filters = self._log_filters(filters)
+        if filters:
+            try:
+                repo = self._repo()
+                revs = repo.revs('%r', self._log_revset(branch=branch, **filters))
+            except (error.RepoError, error.ParseError, error.Abort), e:
+                raise DVCSException('Log failed: %s' % e)
+            log = (self._api_entry(repo[rev]) for rev in revs)
+        else:
+            log = self.iter_log(branch=branch)
+
+        for one in log:
+            as_list.append(one)
+            as_dict[one['branch']].append(one)
 
         return as_list, dict(as_dict)
 
+    def _use_log_index(self):
+        '''
+            HG_LOG_BACKEND = 'index' serves log, branch_revisions, user_commits and get_head
+            from persistent log index updated incrementally on every call
+        '''
+        return getattr(settings, 'HG_LOG_BACKEND', 'api') == 'index'
 
-    def log(self, branch=None, backend=None):
+    def _get_log_index(self):
+        if getattr(self, '_log_index', None) is None:
+            self._log_index = LogIndex(self.repo_path, record=self._changeset, date_parser=self._api_date)
+        return self._log_index
+
+    def log_index(self, branch=None):
+        return self._get_log_index().log(branch=branch)
+
+    def log(self, branch=None, backend=None, **filters):
+        """
+        filters: offset, limit, date, paths, revset (see ``_log_revset``)
+        """
         backend = backend or getattr(settings, 'HG_LOG_BACKEND', 'api')
+        filters = self._log_filters(filters)
+        if backend == 'index' and filters:
+            #index has no revsets, let hg filter it
+            backend = 'api'
+
         if backend == 'api':
-            return self.log_api(branch=branch)
+            return self.log_api(branch=branch, **filters)
+        elif backend == 'index':
+            return self.log_index(branch=branch)
         else:
-            return self.log_xml(branch=branch)
+            return self.log_xml(branch=branch, **filters)
 
     def user_commits(self, user, limit=None, **kwargs):
-        args = ['-u %s' % user, '--style xml']
-        if limit:
-            args.append('-l %s' % str(limit))
+        filters = self._log_filters(kwargs)
+        if self._use_log_index() and not filters:
+            return self._get_log_index().user_commits(user, limit=limit)
 
-        out = self._command('log', *args)
-        return self._parse_log(out)[0]
+        out = self._command('log', *self._user_commits_args(user, limit=limit, **filters))
+        return self._parse_log_page(out)[0]
+
+    def _user_commits_args(self, user, limit=None, **filters):
+        args = ['--style', 'xml']
+        if filters:
+            args.extend(['-r', self._log_revset(user=user, limit=limit, **filters)])
+        else:
+            args.extend(['-u', user])
+            if limit:
+                args.extend(['-l', str(limit)])
+        return args
 
     def changed_between_nodes(self, start, end):
-        return self.status(*['--rev', '%s:%s' % (str(start), str(end))])
+        if self._use_status_api():
+            return self._status_api(start, end)
+        return self.status(*self._changed_between_nodes_args(start, end))
 
-    def branches(self, **kwargs):
-        out = self._command('branches', '-c')
-        branches = self._parse_branches(out)
+    def _changed_between_nodes_args(self, start, end):
+        return ['--rev', '%s:%s' % (str(start), str(end))]
 
+    def branches(self, backend=None, heads=False, **kwargs):
+        """
+        ``heads`` adds {branch: node of its newest open head (newest head of closed branch)} as 'heads'
+        HG_BRANCHES_BACKEND = 'api' reads repository's branchmap, cached until tip changes, 'command' runs hg
+        """
+        backend = backend or getattr(settings, 'HG_BRANCHES_BACKEND', 'api')
+        if backend == 'api':
+            branches = self._branches_api()
+            branches = dict((k, list(v) if isinstance(v, list) else dict(v)) for k, v in branches.items()
+                            if heads or k != 'heads')
+            return branches
+        out = self._command('branches', '-c', '--debug' if heads else None)
+        return self._sort_branches(self._parse_branches(out, heads=heads))
+
+    def _branches_api(self):
+        path = os.path.realpath(self.repo_path)
+        try:
+            repo = self._repo()
+            tip = len(repo), repo.changelog.tip()
+            cached = self._branches_cache.get(path)
+            if cached is None or cached[0] != tip:
+                cached = self._branches_cache[path] = (tip, self._sort_branches(self._read_branchmap(repo)))
+        except (error.RepoError, error.RevlogError, error.Abort), e:
+            raise DVCSException('Reading branches of %s failed: %s' % (self.repo_path, e))
+        return cached[1]
+
+    def _read_branchmap(self, repo):
+        branches = {'active': [], 'inactive': [], 'closed': [], 'all': [], 'opened': [], 'heads': {}}
+        #same as hg branches, active branch has a repository head
+        active = set(repo[node].branch() for node in repo.heads())
+        for name, nodes in repo.branchmap().iteritems():
+            opened = [node for node in nodes if not repo[node].closesbranch()]
+            status = 'closed' if not opened else 'active' if name in active else 'inactive'
+            name = name.decode('utf8', 'replace')
+            branches[status].append(name)
+            branches['all'].append(name)
+            if status in ('active', 'inactive'):
+                branches['opened'].append(name)
+            branches['heads'][name] = hex((opened or nodes)[-1])
+        return branches
+
+    def _sort_branches(self, branches):
         #sort'em
         for k, v in branches.iteritems():
-            branches[k] = sorted(v)
+            if isinstance(v, list):
+                branches[k] = sorted(v)
         return branches
 
-    def _parse_branches(self, out):
+    @instrument.timed('parse_branches')
+    def _parse_branches(self, out, heads=False):
         branches = {'active': [], 'inactive': [], 'closed': [], 'all': [], 'opened':[]}
+        if heads:
+            branches['heads'] = {}
         re_line = re.compile(r'(?P<name>.*)\s+(?P<head>[a-z:0-9]+)(\s+\((?P<status>.*?)\))?')
         for line in out.splitlines():
             match = re.match(re_line, line)
@@ -266,64 +600,242 @@ class Hg(DVCSWrapper):
             branches['all'].append(name)
             if status in ('active', 'inactive'):
                 branches['opened'].append(name)
+            if heads:
+                branches['heads'][name] = line['head'].split(':')[-1]
 
 
         return branches
 
 
     def branch_revisions(self, branch, **kwargs):
-        out = self._command('log', '-b \'%s\'' % branch, '--style xml')
-        return self._parse_log(out)[0]
+        """
+        kwargs: offset, limit, date, paths, revset (see ``_log_revset``)
+        """
+        filters = self._log_filters(kwargs)
+        if self._use_log_index() and not filters:
+            return self._get_log_index().branch_revisions(branch)
 
-    def diff_unified(self, path, identifier=None, **kwargs):
-        args = [os.path.join(self.repo_path, path)]
-        if identifier:
-            args.append('-r %s' % str(identifier))
-        out = self._command('diff', *args)
-        return out
+        out = self._command('log', *self._branch_revisions_args(branch, **filters))
+        return self._parse_log_page(out)[0]
+
+    def _branch_revisions_args(self, branch, **filters):
+        if filters:
+            return ['-r', self._log_revset(branch=branch, **filters), '--style', 'xml']
+        return ['-b', branch, '--style', 'xml']
+
+    def _revpair(self, repo, revs):
+        """
+        (old, new) nodes for revisions as given to hg diff -r, new is None for working directory
+        """
+        try:
+            return scmutil.revpair(repo, [str(rev) for rev in revs])
+        except (error.RepoError, error.Abort), e:
+            raise DVCSException('Diff failed: %s' % e)
 
-    def diff_html(self, path, identifier=None, **kwargs):
+    def _cached_diff(self, nodes, key, compute):
+        '''
+            diffs between two nodes never change, they are kept in dvcs.cache (DVCS_DIFF_CACHE)
+            working directory diffs (new node is None) are always computed
+        '''
+        cache = get_cache()
+        if cache is None or None in nodes:
+            return compute()
+        key = make_key(os.path.realpath(self.repo_path), hex(nodes[0]), hex(nodes[1]),
+                       getattr(settings, 'HG_CONFIG', ''), *key)
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            if self._cacheable(value):
+                cache.set(key, value)
+        return value
+
+    def _cacheable(self, value):
+        #finished diffs only, never f.e. a running AsyncHg call
+        return isinstance(value, basestring) or (isinstance(value, list) and
+                                                 all(isinstance(one, udiff.FileDiff) for one in value))
+
+    def _diff_unified_args(self, path, identifier=None):
         args = [os.path.join(self.repo_path, path)]
+        return args + (['-r', str(identifier)] if identifier else [])
+
+    def diff_unified(self, path, identifier=None, **kwargs):
+        args = self._diff_unified_args(path, identifier)
+        if not identifier:
+            return self._command('diff', *args)
+        nodes = self._revpair(self._repo(), [identifier])
+        return self._cached_diff(nodes, ('unified', path), lambda: self._command('diff', *args))
+
+    def _file_data(self, ctx, path):
+        try:
+            return ctx[path].data()
+        except (error.LookupError, IOError): #not in that revision
+            return ''
+
+    def diff_html(self, path, identifier=None, context=None, numlines=None, max_size=None, **kwargs):
+        """
+        ``identifier`` as for extdiff: ``rev`` compares rev to working directory, ``rev1:rev2`` two revisions
+        ``context``, ``numlines`` and ``max_size`` see ``htmldiff.make_table``
+        HG_DIFF_HTML_BACKEND = 'extdiff' runs hg extdiff, without opening the repository in process or caching
+        """
+        if getattr(settings, 'HG_DIFF_HTML_BACKEND', 'api') == 'extdiff':
+            return self.diff_html_extdiff(path, identifier=identifier)
+        repo = self._repo()
+        old, new = self._revpair(repo, [identifier] if identifier else [])
+
+        def compute():
+            repo_path = util.pconvert(os.path.relpath(os.path.join(self.repo_path, path), self.repo_path))
+            old_data, new_data = self._file_data(repo[old], repo_path), self._file_data(repo[new], repo_path)
+            if old_data == new_data:
+                return u''
+            return htmldiff.make_table(old_data, new_data, context=context, numlines=numlines, max_size=max_size)
+
+        return self._cached_diff((old, new), ('html', path, context, numlines, max_size), compute)
+
+    def diff_html_extdiff(self, path, identifier=None):
+        args = ['-p', os.path.join(DIR_SCRIPT, 'difftool.py'), os.path.join(self.repo_path, path)]
         if identifier:
-            args.append('-r %s' % str(identifier))
-        out = self._command(
-            '--config extensions.hgext.extdiff="" extdiff -p %s' % os.path.join(DIR_SCRIPT, 'difftool.py'), *args,
+            args.extend(['-r', str(identifier)])
+        out = self._command('extdiff', *args, config=['extensions.hgext.extdiff='],
             ignore_return_code=True) #@FIXME more sexy
         return out
 
+    def diff_changeset(self, rev, paths=None, html=False):
+        repo = self._repo()
+        try:
+            ctx = repo[str(rev)]
+        except (error.RepoError, error.LookupError), e:
+            raise DVCSException('Diff failed: %s' % e)
+        return self._cached_diff((ctx.p1().node(), ctx.node()), ('changeset', paths, html),
+                                 lambda: list(self.iter_diff(rev=rev, paths=paths, html=html)))
+
+    def diff_range(self, start, end=None, paths=None, html=False):
+        compute = lambda: list(self.iter_diff(start=start, end=end, paths=paths, html=html))
+        if end is None:
+            return compute()
+        nodes = self._revpair(self._repo(), [start, end])
+        return self._cached_diff(nodes, ('range', paths, html), compute)
+
+    def iter_diff(self, start=None, end=None, rev=None, paths=None, html=False):
+        """
+        ``FileDiff`` per file (see ``dvcs.hg.udiff``) from one ``hg diff``, streamed as they come for huge diffs
+        ``rev`` is changeset against its parent, otherwise ``start`` to ``end`` (None is working directory)
+        ``html`` adds side by side ``html`` table of the hunks
+        """
+        args = ['--git']
+        if rev is not None:
+            args.extend(['-c', str(rev)])
+        else:
+            args.extend(['-r', str(start)] if start is not None else [])
+            args.extend(['-r', str(end)] if end is not None else [])
+        args.extend(os.path.join(self.repo_path, path) for path in paths or [])
+
+        chunks = utils.stream(self._command_line('diff', *args), timeout=getattr(settings, 'HG_COMMAND_TIMEOUT', None),
+                              env=self._environ(), label='hg.diff')
+        try:
+            for one in udiff.iter_parse(utils.StreamReader(chunks)):
+                if html:
+                    one.html = (htmldiff.notice(u'Binary files differ') if one['binary']
+                                   else htmldiff.hunks_table(one['hunks']))
+                yield one
+        finally:
+            chunks.close()
+
     def has_new_changesets(self, branch=None):
+        '''
+            compares remote heads with local changesets (see dvcs.hg.remote), if incoming runs
+            through other binary (HG_COMMANDS_WITH_OTHER_BINARY), hg incoming has to do
+        '''
+        if 'incoming' in getattr(settings, 'HG_COMMANDS_WITH_OTHER_BINARY', []):
+            return self._has_new_changesets_incoming(branch)
+        return remote.has_incoming(self.repo_path, branch=branch)
+
+    def _has_new_changesets_incoming(self, branch=None):
         ret = False
         try:
-            ret = bool(self._command('incoming', '--branch \'%s\'' % branch if branch else ''))
+            ret = bool(self._command('incoming', *(['--branch', branch] if branch else [])))
         except DVCSException, e:
             if e.code != 1:
                 raise
         return ret
 
     def get_new_changesets(self, branch=None):
-        revs = []
+        bundle = self._incoming_bundle(branch)
         try:
-            out = self._command('incoming', '--style xml', '-b \'%s\'' % branch if branch else '')
+            #bundle is reused by the next pull
+            out = self._command('incoming', '--style', 'xml', '--bundle', bundle, *(['-b', branch] if branch else []))
             return self._parse_log(''.join(out.splitlines()[2:]))[0]
         except DVCSException, e:
             if e.code != 1: #no changsets
                 raise
 
     def get_changed_files(self, start_node, end_node):
+        if getattr(settings, 'HG_LOG_BACKEND', 'api') == 'xml':
+            out = self._command('log', '--verbose', '--style', 'xml', '--rev', '%s:%s' % (start_node or '', end_node))
+            return [(one['node'], one['files']) for one in self._parse_log(out)[0]]
+        return list(self.iter_changed_files(start_node, end_node))
+
+    def iter_changed_files(self, start_node, end_node):
+        '''
+            reads only node and files of changesets from changelog, nothing else of them is parsed
+            files are as stored in changeset (sorted, of a merge those differing from both parents)
+        '''
+        repo = self._repo()
         try:
-            out = self._command('log', '--verbose', '--style xml', '--rev %s:%s' % (start_node or '', end_node))
-            log = self._parse_log(out)[0]
-            return [(one['node'], one['files']) for one in log]
-        except DVCSException:
-            raise
+            revs = scmutil.revrange(repo, ['%s:%s' % (start_node or '', end_node)])
+        except (error.RepoLookupError, error.ParseError), e:
+            raise DVCSException('Unknown revision range %s:%s: %s' % (start_node, end_node, e))
+        cl = repo.changelog
+        for rev in revs:
+            node = cl.node(rev)
+            yield hex(node), map(self._decode_path, cl.read(node)[3])
+
+    def get_changed_paths(self, start_node, end_node):
+        counts = defaultdict(int)
+        for node, files in self.iter_changed_files(start_node, end_node):
+            for path in files:
+                counts[path] += 1
+        return dict(counts)
 
     def get_head(self, branch=None):
-        args = ['-l1', '--style xml']
-        if branch:
-            args.append('-b \'%s\'' % branch)
+        if self._use_log_index():
+            return self._get_log_index().get_head(branch=branch)
 
         try:
-            out = self._command('log', *args)
+            out = self._command('log', *self._get_head_args(branch))
             return self._parse_log(out)[0][0]
         except DVCSException:
-            raise
\ No newline at end of file
+            raise
+
+    def _get_head_args(self, branch=None):
+        args = ['-l1', '--style', 'xml']
+        if branch:
+            args.extend(['-b', branch])
+        return args
+
+    def get_heads(self, branches=None):
+        '''
+            unknown branches are left out
+        '''
+        if self._use_log_index():
+            index, known = self._get_log_index(), self.branches()['all']
+            decode = lambda name: name.decode('utf8') if isinstance(name, str) else name
+            branches = [branch for branch in branches if decode(branch) in known] if branches else known
+            return dict((branch, index.get_head(branch=branch)) for branch in branches)
+
+        out = self._command('log', *self._get_heads_args(branches))
+        return self._newest_heads(self._parse_log_page(out)[1])
+
+    def _get_heads_args(self, branches=None):
+        '''
+            newest changeset of branch is always one of its heads, so one log of heads is enough
+            branches are matched as regexps, plain name of unknown branch would be looked up as revision
+        '''
+        revset = 'head()'
+        if branches:
+            encode = lambda arg: arg.encode('utf8') if isinstance(arg, unicode) else arg
+            spec = lambda arg: formatspec('branch(%s)', 're:^%s$' % re.escape(encode(arg)))
+            revset = 'head() and (%s)' % ' or '.join(map(spec, branches))
+        return ['--style', 'xml', '-r', revset]
+
+    def _newest_heads(self, log):
+        return dict((branch, max(heads, key=lambda head: head['rev'])) for branch, heads in log.items())
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of commands and output parsing, reported to pluggable hooks.
+
+    from dvcs import instrument
+    histogram = instrument.Histogram()
+    instrument.add_hook(histogram)
+    instrument.add_hook(instrument.Statsd(statsd_client))
+    instrument.add_hook(instrument.log_event)
+
+Every hook is called with an event dict: ``kind`` ('command' or 'parse'), ``name`` (f.e. 'hg.log' or
+'parse_log') and ``wall`` seconds. Commands also have ``cmd``, ``code`` (exit code, None if it timed out or was
+abandoned), ``bytes`` of output and ``cpu`` seconds the process spent (user + sys of waited children, so it is
+approximate when commands run in parallel threads, None for commands run by the command server).
+
+Without hooks nothing is measured, instrumented code only checks that ``hooks`` is empty.
+"""
+import time, threading, functools, resource
+from collections import defaultdict
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+logging = settings.APP_LOGGER
+
+hooks = []
+
+
+def add_hook(hook):
+    if hook not in hooks:
+        hooks.append(hook)
+
+
+def remove_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+def record(event):
+    for hook in list(hooks):
+        try:
+            hook(event)
+        except Exception, e:
+            logging.warning('Instrumentation hook %r failed: %s' % (hook, e))
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class command(object):
+    """
+    ``with command('hg.log', cmd) as event:`` measures the block, the block fills ``code`` and ``bytes``
+    """
+
+    def __init__(self, name, cmd=None, cpu=True):
+        self.enabled = bool(hooks)
+        self.event = dict(kind='command', name=name, cmd=cmd, code=None, bytes=None, cpu=None, wall=None)
+        self.cpu = cpu
+
+    def __enter__(self):
+        if self.enabled:
+            self.started = time.time()
+            self.started_cpu = _children_cpu() if self.cpu else None
+        return self.event
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return False
+        self.event['wall'] = time.time() - self.started
+        if self.cpu:
+            self.event['cpu'] = _children_cpu() - self.started_cpu
+        if exc_value is not None and self.event['code'] is None:
+            self.event['code'] = getattr(exc_value, 'code', None)
+        record(self.event)
+        return False
+
+
+def timed(name):
+    """
+    decorator recording 'parse' event ``name`` for every call
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not hooks:
+                return func(*args, **kwargs)
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(dict(kind='parse', name=name, wall=time.time() - started))
+        return wrapper
+    return decorator
+
+
+def log_event(event):
+    """
+    hook writing events to APP_LOGGER
+    """
+    if event['kind'] == 'command':
+        logging.debug('%(name)s took %(wall).3fs (cpu %(cpu)s), %(bytes)s bytes, exit %(code)s: %(cmd)s' % event)
+    else:
+        logging.debug('%(name)s took %(wall).6fs' % event)
+
+
+class Statsd(object):
+    """
+    hook sending timings and counters to statsd like ``client`` (with ``timing(name, ms)`` and ``incr(name, n)``)
+    """
+
+    def __init__(self, client, prefix='dvcs'):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, event):
+        name = '%s.%s.%s' % (self.prefix, event['kind'], event['name'])
+        self.client.timing(name, event['wall'] * 1000)
+        if event.get('cpu') is not None:
+            self.client.timing(name + '.cpu', event['cpu'] * 1000)
+        if event.get('bytes'):
+            self.client.incr(name + '.bytes', event['bytes'])
+        if event['kind'] == 'command' and event['code'] != 0:
+            self.client.incr(name + '.failed', 1)
+
+
+class Histogram(object):
+    """
+    hook keeping counts, totals and histogram of wall times (buckets of powers of 2 milliseconds) in memory
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.stats = {}
+
+    def __call__(self, event):
+        bucket = 1
+        while bucket < event['wall'] * 1000:
+            bucket *= 2
+        with self.lock:
+            stats = self.stats.get((event['kind'], event['name']))
+            if stats is None:
+                stats = self.stats[event['kind'], event['name']] = dict(count=0, wall=0.0, cpu=0.0, bytes=0, failed=0,
+                                                                        buckets=defaultdict(int))
+            stats['count'] += 1
+            stats['wall'] += event['wall']
+            stats['cpu'] += event.get('cpu') or 0
+            stats['bytes'] += event.get('bytes') or 0
+            stats['failed'] += event['kind'] == 'command' and event['code'] != 0
+            stats['buckets'][bucket] += 1
+
+    def percentile(self, kind, name, percent):
+        """
+        upper bound in milliseconds of the bucket ``percent`` % of ``name`` events fit in, None if none seen
+        """
+        with self.lock:
+            stats = self.stats.get((kind, name))
+            if stats is None:
+                return None
+            needed, seen = stats['count'] * percent / 100.0, 0
+            for bucket in sorted(stats['buckets']):
+                seen += stats['buckets'][bucket]
+                if seen >= needed:
+                    return bucket
@@ -4,9 +4,40 @@ import logging
 
 #setup your own logger here
 APP_LOGGER = logging
-FABRIC_OUTPUT = False
+COMMAND_OUTPUT = False #let commands print to terminal instead of capturing
 
 #HG_BINARY = '' #set path to your hg binary if not on $PATH
+HG_ENCODING = 'utf-8' #HGENCODING for hg processes, arguments are passed and output is read as utf-8
 HG_CONFIG = 'alias.diff="diff"' #--config commands for hg binary (f.e for disabling merge/diff external tools)
-HG_LOG_BACKEND = 'api'
+HG_LOG_BACKEND = 'api' #'api', 'xml' or 'index' (persistent incremental log index, see dvcs.hg.logindex)
+HG_STATUS_BACKEND = 'api' #status and changed_between_nodes by 'api' in process or by hg 'command'
+HG_BRANCHES_BACKEND = 'api' #branches from repository's branchmap by 'api' or by hg 'command'
+HG_REPO_CACHE_SIZE = 64 #repository objects kept for api backends (see dvcs.hg.repocache)
+HG_LOG_RECORD = 'changeset' #log entries as dvcs.changeset.Changeset, 'dict' for plain dicts
+#HG_LOG_INDEX_DIR = '' #directory for log indexes if they should not be kept in repo's .hg
+HG_DIFF_HTML_BACKEND = 'api' #'extdiff' renders html diffs with dvcs/hg/difftool.py through hg extdiff
+HG_DIFF_HTML_MAX_SIZE = 2 * 1024 * 1024 #bytes, bigger files are not diffed
+HG_DIFF_HTML_CONTEXT_THRESHOLD = 1000 #files with more lines show only changes with context
+HG_DIFF_HTML_CONTEXT_LINES = 5
+HG_REMOTE_HEADS_TTL = 30 #seconds has_new_changesets trusts remote heads it has seen
+HG_INCOMING_BUNDLE_TTL = 600 #seconds pull reuses changesets get_new_changesets has downloaded
+HG_COMMAND_BACKEND = 'shell' #'cmdserver' keeps a persistent `hg serve --cmdserver pipe` process per repo
+#HG_COMMAND_TIMEOUT = 600 #seconds, hg process gets killed after that
+HG_CMDSERVER_POOL_SIZE = 32 #max number of running command servers
+HG_CMDSERVER_IDLE_TIMEOUT = 300 #seconds after which an unused command server is stopped
+HG_ASYNC_REPO_CONCURRENCY = 1 #max number of commands dvcs.hg.asynchronous runs at once in one repository
 
+DVCS_BATCH_EXECUTOR = 'thread' #dvcs.batch.run_many runs calls in 'thread's or forked 'process'es
+DVCS_BATCH_WORKERS = 8
+DVCS_BATCH_TIMEOUT = None #seconds per repository
+DVCS_SYNC_WORKERS = 8 #dvcs.sync.MirrorSync pulls this many mirrors at once
+DVCS_SYNC_HOST_CONCURRENCY = 4 #and at most this many from one remote host
+DVCS_SYNC_BACKOFF = 60 #seconds a failed mirror is skipped, doubles with every failure
+DVCS_SYNC_MAX_BACKOFF = 3600
+DVCS_WORKSPACE_POOL_SIZE = 2 #dvcs.workspace.WorkspacePool keeps this many idle working copies per remote
+DVCS_WORKSPACE_CAPACITY = 16 #and at most this many working copies on disk
+#DVCS_WORKSPACE_ROOT = '' #directory of working copies, temp dir by default
+DVCS_DIFF_CACHE = 'memory' #diffs between two nodes are cached, 'directory', 'django' or None (see dvcs.cache)
+DVCS_DIFF_CACHE_SIZE = 64 * 1024 * 1024 #bytes, for 'memory' and 'directory'
+#DVCS_DIFF_CACHE_DIR = '' #required for 'directory', shared by processes of the user, created 0700
+#DVCS_DIFF_CACHE_ALIAS = 'default' #for 'django'
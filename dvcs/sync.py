@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps many mirrors fresh by pulling them in parallel.
+
+    from dvcs.sync import MirrorSync
+    sync = MirrorSync([DVCSWrapper(path) for path in mirrors])
+    while True:
+        results = sync.run()
+        time.sleep(60)
+
+Every ``run`` pulls all mirrors that are not backing off, at most ``workers`` at once and at most
+``host_concurrency`` from one remote host (mirrors of local paths are limited only by ``workers``). Mirrors that
+changed most recently go first. A mirror whose pull failed is skipped for ``backoff`` seconds, doubled with every
+further failure up to ``max_backoff``.
+
+``run`` returns one dict per mirror in order of ``wrappers``: ``repo_path``, ``host``, ``status`` ('pulled',
+'failed' or 'skipped'), ``counts`` (as returned by ``pull``), ``error`` and ``duration``. Totals of the last run
+are in ``sync.metrics``.
+"""
+import os, threading, time, urlparse
+from collections import defaultdict
+
+from dvcs.wrapper import DVCSException
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+logging = settings.APP_LOGGER
+
+
+def remote_host(remote):
+    """
+    host part of remote url, '' for local paths
+    """
+    if not remote or '://' not in remote:
+        return ''
+    return urlparse.urlsplit(remote).hostname or ''
+
+
+class MirrorSync(object):
+    def __init__(self, wrappers, workers=None, host_concurrency=None, backoff=None, max_backoff=None, branch=None):
+        self.wrappers = list(wrappers)
+        self.workers = workers or getattr(settings, 'DVCS_SYNC_WORKERS', 8)
+        self.host_concurrency = host_concurrency or getattr(settings, 'DVCS_SYNC_HOST_CONCURRENCY', 4)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'DVCS_SYNC_BACKOFF', 60)
+        self.max_backoff = max_backoff or getattr(settings, 'DVCS_SYNC_MAX_BACKOFF', 3600)
+        self.branch = branch
+        self.state = {}
+        self.metrics = {}
+
+    def _state(self, wrapper):
+        state = self.state.get(wrapper.repo_path)
+        if state is None:
+            try:
+                host = remote_host(wrapper.get_remote())
+            except DVCSException:
+                host = ''
+            try:
+                #changelog is written on every new changeset
+                last_change = os.path.getmtime(os.path.join(wrapper.repo_path, '.hg', 'store', '00changelog.i'))
+            except OSError:
+                last_change = 0
+            state = self.state[wrapper.repo_path] = dict(host=host, last_change=last_change, failures=0,
+                                                         retry_at=0)
+        return state
+
+    def _pull(self, wrapper, state):
+        result = dict(repo_path=wrapper.repo_path, host=state['host'], counts=None, error=None)
+        started = time.time()
+        try:
+            result['counts'] = wrapper.pull(self.branch)
+        except Exception, e:
+            state['failures'] += 1
+            delay = min(self.backoff * 2 ** (state['failures'] - 1), self.max_backoff)
+            state['retry_at'] = time.time() + delay
+            result.update(status='failed', error=e)
+            logging.warning('Pulling %s failed %d times, next try in %ds: %s' % (
+                wrapper.repo_path, state['failures'], delay, e))
+        else:
+            state['failures'], state['retry_at'] = 0, 0
+            if result['counts']['changesets']:
+                state['last_change'] = time.time()
+            result['status'] = 'pulled'
+        result['duration'] = time.time() - started
+        return result
+
+    def run(self):
+        """
+        one pass over all mirrors, returns list of results in order of ``wrappers``
+        """
+        started = time.time()
+        results = [None] * len(self.wrappers)
+        pending = []
+        for i, wrapper in enumerate(self.wrappers):
+            state = self._state(wrapper)
+            if state['retry_at'] > started:
+                results[i] = dict(repo_path=wrapper.repo_path, host=state['host'], status='skipped', counts=None,
+                                  error=None, duration=0)
+            else:
+                pending.append(i)
+        #most recently changed first
+        pending.sort(key=lambda i: -self.state[self.wrappers[i].repo_path]['last_change'])
+
+        running = defaultdict(int)
+        condition = threading.Condition()
+
+        def next_job():
+            with condition:
+                while pending:
+                    for i in pending:
+                        host = self.state[self.wrappers[i].repo_path]['host']
+                        #local paths don't share any host
+                        if not host or running[host] < self.host_concurrency:
+                            pending.remove(i)
+                            running[host] += 1
+                            return i, host
+                    condition.wait()
+                return None, None
+
+        def worker():
+            while True:
+                i, host = next_job()
+                if i is None:
+                    return
+                wrapper = self.wrappers[i]
+                try:
+                    results[i] = self._pull(wrapper, self.state[wrapper.repo_path])
+                finally:
+                    with condition:
+                        running[host] -= 1
+                        condition.notify_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.workers, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.metrics = self._metrics(results, time.time() - started)
+        logging.info('Synced %(pulled)d mirrors, %(failed)d failed, %(skipped)d skipped, '
+                     '%(changesets)d changesets in %(duration).1fs' % self.metrics)
+        return results
+
+    def _metrics(self, results, duration):
+        metrics = dict(pulled=0, failed=0, skipped=0, files=0, changesets=0, changes=0, duration=duration)
+        for result in results:
+            metrics[result['status']] += 1
+            for key, value in (result['counts'] or {}).items():
+                metrics[key] += value
+        return metrics
@@ -1,2 +1,11 @@
 from hg import *
-from difftool import *
\ No newline at end of file
+from difftool import *
+from changeset import *
+from dates import *
+from batch import *
+from asynchronous import *
+from runner import *
+from diffcache import *
+from sync import *
+from workspace import *
+from instrumentation import *
@@ -0,0 +1,90 @@
+import os
+from unittest import TestCase
+
+from dvcs.hg.asynchronous import AsyncHg, Call, Scheduler
+from dvcs.wrapper import DVCSException, DVCSWrapper
+from dvcs.tests.hg import TMP, REMOTE_REPO, rmrf, touch
+
+ASYNC_REPO = os.path.join(TMP, 'hgtests', 'async')
+ASYNC_REPO_COPY = ASYNC_REPO + '_copy'
+
+
+class AsyncHgTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rmrf(ASYNC_REPO)
+        DVCSWrapper(ASYNC_REPO).clone(REMOTE_REPO)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmrf(ASYNC_REPO)
+
+    def setUp(self):
+        self.scheduler = Scheduler(concurrency=1)
+        self.hg = AsyncHg(ASYNC_REPO, scheduler=self.scheduler)
+        self.sync = DVCSWrapper(ASYNC_REPO)
+
+    def tearDown(self):
+        rmrf(ASYNC_REPO_COPY)
+
+    def test_same_results(self):
+        calls = [self.hg.status(), self.hg.branches(), self.hg.get_head(branch='closed'), self.hg.log(branch='closed'),
+                 self.hg.branch_revisions('default'), self.hg.user_commits('lahola', limit=1),
+                 self.hg.get_changed_files(1, 5)]
+        #one command per repository at a time, the rest waits
+        self.assertEquals(1, len([call for call in calls if call.process is not None]))
+
+        self.assertEquals(len(calls), len(self.scheduler.wait(calls)))
+        expects = [self.sync.status(), self.sync.branches(), self.sync.get_head(branch='closed'),
+                   self.sync.log(branch='closed', backend='xml'), self.sync.branch_revisions('default'),
+                   self.sync.user_commits('lahola', limit=1), self.sync.get_changed_files(1, 5)]
+        self.assertEquals(expects, [call.result() for call in calls])
+
+    def test_diff_not_cached(self):
+        call = self.hg.diff_unified('one', identifier='6:5')
+        expects = self.sync.diff_unified('one', identifier='6:5')
+        self.assertTrue(isinstance(expects, unicode))
+        self.assertEquals(expects, call.result())
+
+    def test_in_process_calls(self):
+        calls = [self.hg.diff_html('one', identifier='6:5'), self.hg.diff_changeset(6), self.hg.diff_range(5, 6),
+                 self.hg.get_changed_paths(1, 5), self.hg.get_remote()]
+        self.assertTrue(all(isinstance(call, Call) and call.done() for call in calls))
+        expects = [self.sync.diff_html('one', identifier='6:5'), self.sync.diff_changeset(6),
+                   self.sync.diff_range(5, 6), self.sync.get_changed_paths(1, 5), self.sync.get_remote()]
+        self.assertEquals(expects, [call.result() for call in calls])
+        self.assertRaises(DVCSException, self.hg.diff_changeset(2000).result)
+
+    def test_branch_heads(self):
+        branches = self.hg.branches(heads=True).result()
+        self.assertEquals(self.sync.branches(backend='command', heads=True)['heads'], branches['heads'])
+        self.assertFalse('heads' in self.hg.branches().result())
+
+    def test_errors(self):
+        call = self.hg.update(revision=2000)
+        try:
+            call.result()
+        except DVCSException, e:
+            self.assertEquals(255, e.code)
+            self.assertTrue('2000' in e.stderr)
+        else:
+            self.fail('DVCSException not raised')
+        self.assertRaises(DVCSException, self.hg.get_head(branch='nonexistent').result)
+
+    def test_push_pull(self):
+        self.assertEquals({'files': 0, 'changesets': 0, 'changes': 0}, self.hg.pull().result())
+        self.assertFalse(self.hg.has_new_changesets().result())
+        self.assertEquals(None, self.hg.get_new_changesets().result())
+
+        copy = DVCSWrapper(ASYNC_REPO_COPY)
+        copy.clone(ASYNC_REPO)
+        touch(os.path.join(ASYNC_REPO_COPY, 'async'))
+        copy.commit('async', user='brogrammer')
+        async_copy = AsyncHg(ASYNC_REPO_COPY, scheduler=self.scheduler)
+        self.assertEquals({'files': 1, 'changesets': 1, 'changes': 1}, async_copy.push().result())
+        self.assertEquals({'files': 0, 'changesets': 0, 'changes': 0}, async_copy.push().result())
+
+    def test_timeout(self):
+        call = self.hg._command('log', '-r', 'all()')
+        self.assertRaises(DVCSException, call.result, timeout=0)
+        self.assertTrue(call.result())
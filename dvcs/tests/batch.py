@@ -0,0 +1,80 @@
+import os, time
+from unittest import TestCase
+
+from dvcs.batch import run_many
+from dvcs.wrapper import DVCSException, DVCSWrapper
+from dvcs.tests.hg import TMP, REMOTE_REPO, rmrf
+
+BATCH_REPO = os.path.join(TMP, 'hgtests', 'batch')
+
+
+class Sleepy(object):
+    def __init__(self, repo_path, seconds):
+        self.repo_path = repo_path
+        self.seconds = seconds
+
+    def sleep(self):
+        time.sleep(self.seconds)
+        return self.seconds
+
+
+class Dies(object):
+    repo_path = 'dies'
+
+    def go(self):
+        os._exit(3)
+
+
+class Ok(object):
+    repo_path = 'ok'
+
+    def go(self):
+        return 'ok'
+
+
+class BatchTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rmrf(BATCH_REPO)
+        DVCSWrapper(BATCH_REPO).clone(REMOTE_REPO)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmrf(BATCH_REPO)
+
+    def test_ordered_results(self):
+        wrappers = [DVCSWrapper(BATCH_REPO), DVCSWrapper(BATCH_REPO + '_nonexistent'), DVCSWrapper(BATCH_REPO)]
+        for executor in ('thread', 'process'):
+            heads = run_many(wrappers, 'get_head', kwargs={'branch': 'closed'}, executor=executor, workers=2)
+            self.assertEquals(3, len(heads))
+            self.assertEquals('b26fba69aa7b0378bee2a5386f16c14b0f697c18', heads[0]['node'])
+            self.assertEquals(heads[0], heads[2])
+            self.assertTrue(isinstance(heads[1], DVCSException))
+            self.assertEquals((wrappers[1].repo_path, 'get_head', 255),
+                              (heads[1].repo_path, heads[1].method, heads[1].code))
+
+    def test_child_died(self):
+        died, ok = run_many([Dies(), Ok()], 'go', executor='process', workers=1)
+        self.assertTrue(isinstance(died, DVCSException))
+        self.assertEquals(('dies', 3), (died.repo_path, died.code))
+        self.assertEquals('ok', ok)
+
+    def test_timeout(self):
+        wrappers = [Sleepy('fast', 0), Sleepy('slow', 5), Sleepy('fast2', 0)]
+        for executor in ('thread', 'process'):
+            started = time.time()
+            results = run_many(wrappers, 'sleep', timeout=0.5, executor=executor)
+            self.assertTrue(time.time() - started < 2)
+            self.assertEquals(0, results[0])
+            self.assertEquals(0, results[2])
+            self.assertTrue(isinstance(results[1], DVCSException))
+            self.assertEquals('slow', results[1].repo_path)
+
+    def test_raise_errors(self):
+        try:
+            run_many([Sleepy('ok', 0), Sleepy('broken', 'not a number')], 'sleep', raise_errors=True)
+        except DVCSException, e:
+            self.assertEquals(['broken'], e.errors.keys())
+            self.assertEquals(0, e.results[0])
+        else:
+            self.fail('DVCSException not raised')
@@ -0,0 +1,47 @@
+import pickle
+from unittest import TestCase
+
+from dateutil.parser import parse as dateutil_parse
+
+from dvcs.changeset import Changeset
+
+
+class ChangesetTests(TestCase):
+    def _changeset(self, **kwargs):
+        fields = dict(rev=3, node='b26fba69aa7b0378bee2a5386f16c14b0f697c18', branch=u'closed',
+                      author=u'Jan Florian <starenka0@gmail.com>', mess=u'closing', date='2012-03-02T15:50:05+01:00',
+                      date_parser=dateutil_parse)
+        fields.update(kwargs)
+        return Changeset(**fields)
+
+    def test_dict_compat(self):
+        changeset = self._changeset()
+        expects = {'node': 'b26fba69aa7b0378bee2a5386f16c14b0f697c18', 'files': [], 'short': 'b26fba69aa7b',
+                   'mess': u'closing', 'branch': u'closed', 'tags': [],
+                   'date': dateutil_parse('2012-03-02T15:50:05+0100'),
+                   'author': u'Jan Florian <starenka0@gmail.com>', 'rev': 3}
+        self.assertEquals(expects, changeset)
+        self.assertEquals(expects, changeset.to_dict())
+        self.assertEquals(sorted(expects.keys()), sorted(changeset.keys()))
+        self.assertEquals('b26fba69aa7b', changeset['short'])
+        self.assertRaises(KeyError, changeset.__getitem__, 'nonexistent')
+
+        changeset['mess'] = u'reopening'
+        self.assertEquals(u'reopening', changeset.mess)
+        self.assertNotEquals(expects, changeset)
+
+    def test_lazy_date(self):
+        calls = []
+        changeset = self._changeset(date_parser=lambda date: calls.append(date) or dateutil_parse(date))
+        self.assertEquals([], calls)
+        changeset['date'], changeset['date']
+        self.assertEquals(['2012-03-02T15:50:05+01:00'], calls)
+
+    def test_interned(self):
+        one, two = self._changeset(), self._changeset(branch=u''.join([u'clo', u'sed']))
+        self.assertTrue(one.branch is two.branch)
+        self.assertTrue(one.author is two.author)
+
+    def test_pickle(self):
+        changeset = self._changeset()
+        self.assertEquals(changeset, pickle.loads(pickle.dumps(changeset, pickle.HIGHEST_PROTOCOL)))
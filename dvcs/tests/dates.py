@@ -0,0 +1,21 @@
+from unittest import TestCase
+
+from dateutil.parser import parse as dateutil_parse
+from mercurial.util import datestr
+
+from dvcs import dates
+
+
+class DatesTests(TestCase):
+    def test_parse_iso(self):
+        for date in ('2012-03-02T15:50:05+01:00', '2010-12-29T18:19:20-0530', '1969-07-20T20:17:40Z',
+                     '2012-03-02 15:50:05+00:00', 'Fri Mar 02 15:50:05 2012 +0100'):
+            parsed = dates.parse_iso(date)
+            self.assertEquals(dateutil_parse(date), parsed)
+            self.assertEquals(dateutil_parse(date).utcoffset(), parsed.utcoffset())
+
+    def test_from_timestamp(self):
+        for date in ((1330699805.0, -3600), (1293643160.0, 19800), (1341100799.0, 0), (0.0, -7200)):
+            converted = dates.from_timestamp(*date)
+            self.assertEquals(dateutil_parse(datestr(date)), converted)
+            self.assertEquals(dateutil_parse(datestr(date)).utcoffset(), converted.utcoffset())
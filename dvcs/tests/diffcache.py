@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os, tempfile, shutil, time
+from unittest import TestCase
+
+from dvcs import cache
+from dvcs.wrapper import DVCSException
+import dvcs.settings as settings
+
+
+class CacheTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _check(self, storage):
+        key = cache.make_key('repo', 'a' * 40, 'b' * 40, 'path', 'html')
+        self.assertEquals(None, storage.get(key))
+        value = [{'path': u'příliš', 'hunks': []}]
+        storage.set(key, value)
+        self.assertEquals(value, storage.get(key))
+        storage.get(key)[0]['path'] = 'changed' #copies
+        self.assertEquals(value, storage.get(key))
+
+    def test_memory(self):
+        storage = cache.MemoryCache(300)
+        self._check(storage)
+        for key in 'abcd':
+            storage.set(key, key * 60)
+        storage.get('b')
+        storage.set('e', 'e' * 60)
+        self.assertEquals(None, storage.get('a'))
+        self.assertEquals(['b' * 60, 'e' * 60], [storage.get('b'), storage.get('e')])
+        self.assertTrue(storage.size <= 300)
+        storage.set('big', 'x' * 1000)
+        self.assertEquals(None, storage.get('big'))
+
+    def test_directory(self):
+        self._check(cache.DirectoryCache(os.path.join(self.dir, 'check'), 300))
+        storage = cache.DirectoryCache(self.dir, 300)
+        for i, key in enumerate('abcd'):
+            storage.set(key, key * 60)
+            os.utime(os.path.join(self.dir, key), (time.time() - 100 + i, time.time() - 100 + i))
+        storage.get('a')
+        storage.set('e', 'e' * 60)
+        self.assertEquals('a' * 60, storage.get('a'))
+        self.assertEquals(None, storage.get('b'))
+        self.assertTrue(sum(os.path.getsize(os.path.join(self.dir, name)) for name in 'acde') <= 300)
+        self.assertEquals(cache.DirectoryCache(self.dir, 300).get('e'), 'e' * 60) #shared
+
+    def test_directory_private(self):
+        cache.DirectoryCache(os.path.join(self.dir, 'new'), 300)
+        self.assertEquals(0, os.stat(os.path.join(self.dir, 'new')).st_mode & 0077)
+        os.chmod(self.dir, 0777)
+        self.assertRaises(DVCSException, cache.DirectoryCache, self.dir, 300)
+
+        backend, path = settings.DVCS_DIFF_CACHE, getattr(settings, 'DVCS_DIFF_CACHE_DIR', None)
+        settings.DVCS_DIFF_CACHE, settings.DVCS_DIFF_CACHE_DIR = 'directory', None
+        cache.reset()
+        try:
+            self.assertRaises(DVCSException, cache.get_cache)
+        finally:
+            settings.DVCS_DIFF_CACHE, settings.DVCS_DIFF_CACHE_DIR = backend, path
+            cache.reset()
@@ -1,9 +1,127 @@
+# -*- coding: utf-8 -*-
+import difflib, re
+import cPickle as pickle
 from unittest import TestCase
 
+from dvcs.hg import htmldiff, udiff
+
+
 class DifftoolTest(TestCase):
-    @classmethod
-    def setUpClass(cls):
-        pass
+    def _marked(self, table, cls):
+        return re.findall(r'<span class="%s">(.*?)</span>' % cls, table)
+
+    def test_opcodes(self):
+        for old, new in (('a\nb\nc\n', 'a\nx\nc\nd\n'), ('', 'a\n'), ('a\nb', ''), ('a\nb\nc', 'a\nb\nc'),
+                         ('x\na\nb\n', 'a\nb\ny\nz\n')):
+            lines = htmldiff.split_lines(old), htmldiff.split_lines(new)
+            #same changes as difflib
+            changed = lambda codes: [code for code in codes if code[0] != 'equal']
+            self.assertEquals(changed(difflib.SequenceMatcher(None, *lines).get_opcodes()),
+                              changed(htmldiff.opcodes(old, new)))
+
+    def test_make_table(self):
+        table = htmldiff.make_table('a\nb b\nc\n', 'a\nb x b\nc\nd <e>\n')
+        self.assertEquals([u'x&nbsp;'], self._marked(table, 'diff_chg')[1:])
+        self.assertEquals([u'd&nbsp;&lt;e&gt;'], self._marked(table, 'diff_add'))
+        self.assertEquals(4, table.count('<tr>'))
+
+        table = htmldiff.make_table('příliš\n', 'přílišný\n')
+        self.assertTrue(isinstance(table, unicode))
+        self.assertEquals([u'', u'ný'], self._marked(table, 'diff_chg'))
+
+    def test_context(self):
+        old = ''.join('line %d\n' % i for i in range(100))
+        new = old.replace('line 10\n', 'changed 10\n').replace('line 80\n', '')
+        table = htmldiff.make_table(old, new, context=True, numlines=3)
+        self.assertEquals(2, table.count('<tbody>'))
+        self.assertEquals(7 + 7, table.count('<tr>'))
+        self.assertEquals(100, htmldiff.make_table(old, new, context=False).count('<tr>'))
+
+    def test_limits(self):
+        self.assertTrue('Binary files differ' in htmldiff.make_table('a\0b', 'a\0c'))
+        self.assertTrue('too large' in htmldiff.make_table('a' * 100, 'b', max_size=10))
+
+    def test_hunks_table(self):
+        hunks = [dict(old_start=3, new_start=3, lines=[u' a', u'-b', u'+x', u'+y', u' c', u'-d'])]
+        table = htmldiff.hunks_table(hunks)
+        self.assertEquals(5, table.count('<tr>'))
+        self.assertEquals([u'y'], self._marked(table, 'diff_add'))
+        self.assertEquals([u'd'], self._marked(table, 'diff_sub'))
+        self.assertTrue('<td class="diff_header">8</td>' not in table)
+        self.assertTrue('<td class="diff_header">6</td>' in table)
+
+
+DIFF = """diff --git a/one b/one
+--- a/one
++++ b/one
+@@ -1,2 +1,2 @@
+ same
+-old
++new
+\\ No newline at end of file
+diff --git a/with space b/with space
+new file mode 100644
+--- /dev/null
++++ b/with space
+@@ -0,0 +1 @@
++příliš
+diff --git a/gone b/gone
+deleted file mode 100644
+--- a/gone
++++ /dev/null
+@@ -1,1 +0,0 @@
+-bye
+diff --git a/bin b/bin
+new file mode 100644
+index 0000000000000000000000000000000000000000..20b5be91886d0b6f26dc98a225c0dac05fe2c86e
+GIT binary patch
+literal 3
+Kc$`aQNCE%>hycU@
+
+diff --git a/old name b/new name
+rename from old name
+rename to new name
+"""
+
+
+class UdiffTest(TestCase):
+    def test_parse(self):
+        files = udiff.parse(DIFF)
+        self.assertEquals([(u'one', u'one', 'modified'), (u'with space', u'with space', 'added'),
+                           (u'gone', u'gone', 'removed'), (u'bin', u'bin', 'added'),
+                           (u'new name', u'old name', 'renamed')],
+                          [(one.path, one.old_path, one.status) for one in files])
+        self.assertEquals([(1, 1), (1, 0), (0, 1), (0, 0), (0, 0)], [(one.added, one.removed) for one in files])
+        self.assertEquals([False, False, False, True, False], [one.binary for one in files])
+        self.assertEquals([1, 1, 1, 0, 0], [len(one.hunks) for one in files])
+        self.assertEquals(dict(old_start=1, old_lines=2, new_start=1, new_lines=2, lines=[u' same', u'-old', u'+new']),
+                          files[0]['hunks'][0])
+        self.assertEquals(u'+příliš', files[1].hunks[0].lines[0])
+        self.assertEquals(1, files[1].hunks[0].new_lines)
+        self.assertEquals(DIFF.decode('utf8'), u''.join(one.unified for one in files))
+
+        self.assertEquals(files, list(udiff.iter_parse(DIFF.splitlines(True))))
+        self.assertEquals([], udiff.parse(''))
+
+    def test_lazy(self):
+        files = udiff.parse(DIFF)
+        self.assertTrue(all(one.buffer is files[0].buffer for one in files))
+        self.assertEquals(None, files[0]._hunks)
+        self.assertEquals(1, files[0].added)
+        self.assertEquals(None, files[0]._hunks)
+
+        copy = pickle.loads(pickle.dumps(files[1], pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(files[1], copy)
+        self.assertEquals(files[1].unified.encode('utf8'), copy.buffer)
+        hunk = pickle.loads(pickle.dumps(files[0].hunks[0], pickle.HIGHEST_PROTOCOL))
+        self.assertEquals((1, 1), (hunk.added, hunk.removed))
+        self.assertEquals(files[0].hunks[0], hunk)
 
-    def setUp(self):
-        pass
\ No newline at end of file
+    def test_plain_diff(self):
+        one, = udiff.parse("""diff -r 43ada45cd836 -r bc841aa8bbb1 one
+--- a/one\tFri Mar 02 16:31:27 2012 +0100
++++ /dev/null\tThu Jan 01 00:00:00 1970 +0000
+@@ -1,1 +0,0 @@
+-dummy""")
+        self.assertEquals((u'one', 'removed', 0, 1), (one.path, one.status, one.added, one.removed))
+        self.assertEquals([u'-dummy'], one.hunks[0].lines)
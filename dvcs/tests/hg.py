@@ -1,9 +1,14 @@
-import os, tempfile, shutil, re, datetime
+# -*- coding: utf-8 -*-
+import os, tempfile, shutil, re, datetime, types, threading, time
 from unittest import TestCase
 
 from dateutil.parser import parse as dateutil_parse
 
+from dvcs import cache
 from dvcs.wrapper import DVCSException, DVCSWrapper
+from dvcs.hg import pool, repocache
+from dvcs.hg.pool import CommandServerPool
+import dvcs.settings as settings
 
 try:
     import simplejson as json
@@ -68,6 +73,24 @@ class HgTests(TestCase):
         self.assertTrue(out)
         self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO, vcs='hg').clone, remote_path=LOCAL_REPO)
 
+    def test_clone_modes(self):
+        DVCSWrapper(DUMMY_REPO).clone(LOCAL_REPO, noupdate=True, hardlink=False)
+        self.assertEquals([], [name for name in os.listdir(DUMMY_REPO) if name != '.hg'])
+        rmrf(DUMMY_REPO)
+
+        hg = DVCSWrapper(DUMMY_REPO)
+        hg.clone(LOCAL_REPO, branch='closed', update='closed')
+        self.assertEquals(hg.get_head('closed')['node'], DVCSWrapper(LOCAL_REPO).get_head('closed')['node'])
+        self.assertTrue(len(hg.log()[0]) < len(DVCSWrapper(LOCAL_REPO).log()[0]))
+
+        shared = DVCSWrapper(DUMMY_REPO_COPY)
+        shared.clone(DUMMY_REPO, share=True)
+        self.assertEquals(hg.get_head()['node'], shared.get_head()['node'])
+        touch(os.path.join(DUMMY_REPO_COPY, 'shared'))
+        shared.commit('shared', files=[os.path.join(DUMMY_REPO_COPY, 'shared')])
+        self.assertEquals(u'shared', hg.get_head()['mess']) #one store
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY2).clone, DUMMY_REPO, share=True, branch='x')
+
 
     def test_add(self):
         hg = self._init_repo(DUMMY_REPO)
@@ -91,6 +114,15 @@ class HgTests(TestCase):
         self.assertRaises(DVCSException, hg.commit, 'msg', files=['blah']) # file not there
         self.assertRaises(DVCSException, hg.commit, 'msg') # nothing added
 
+    def test_commit_message_quoting(self):
+        hg = self._init_repo(DUMMY_REPO)
+        touch(os.path.join(DUMMY_REPO, TEST_FILE))
+        message = u'it\'s "quoted" $HOME `id` ; příliš'
+        hg.commit(message, user='Joe Dev <joe@example.com>')
+        head = hg.get_head()
+        self.assertEquals(message, head['mess'])
+        self.assertEquals(u'Joe Dev <joe@example.com>', head['author'])
+
     def test_up(self):
         hg = self._init_repo(DUMMY_REPO)
         touch(os.path.join(DUMMY_REPO, TEST_FILE))
@@ -200,6 +232,57 @@ class HgTests(TestCase):
                 {'added': ['asd'], 'missing': [], 'removed': [], 'modified': [], 'not_versioned': ['test_file.txt']},
             st)
 
+    def test_status_backends(self):
+        hg = self._mk_local_repo()
+        hg.status() #cached repository object has to see the changes below
+        touch(os.path.join(DUMMY_REPO, 'asd'))
+        hg.add(os.path.join(DUMMY_REPO, 'asd'))
+        os.remove(os.path.join(DUMMY_REPO, 'buhwawa'))
+        with open(os.path.join(DUMMY_REPO, 'one'), 'a') as f:
+            f.write('changed')
+
+        backend = settings.HG_STATUS_BACKEND
+        try:
+            results = []
+            for settings.HG_STATUS_BACKEND in ('command', 'api'):
+                results.append((hg.status(), hg.changed_between_nodes(0, 2)))
+        finally:
+            settings.HG_STATUS_BACKEND = backend
+        self.assertEquals(results[0], results[1])
+        self.assertEquals({'added': ['asd'], 'missing': ['buhwawa'], 'removed': [], 'modified': ['one'],
+                           'not_versioned': []}, results[1][0])
+
+    def test_repo_cache(self):
+        hg = self._mk_local_repo()
+        repo = hg._repo()
+        self.assertTrue(repo is DVCSWrapper(DUMMY_REPO)._repo())
+        count = len(hg.log(backend='api')[0])
+
+        #changed by another process, seen by stamps
+        hg_copy = DVCSWrapper(DUMMY_REPO_COPY)
+        hg_copy.clone(DUMMY_REPO)
+        touch(os.path.join(DUMMY_REPO_COPY, 'cached'))
+        hg_copy.commit('cached', files=[os.path.join(DUMMY_REPO_COPY, 'cached')])
+        hg_copy.push()
+        self.assertEquals(count + 1, len(hg.log(backend='api')[0]))
+        self.assertTrue(repo is hg._repo())
+
+        others = []
+        thread = threading.Thread(target=lambda: others.append(hg._repo()))
+        thread.start()
+        thread.join()
+        self.assertFalse(others[0] is repo)
+
+        #share has its store in the shared repository
+        shared = DVCSWrapper(DUMMY_REPO_COPY2)
+        shared.clone(DUMMY_REPO, share=True)
+        count, branches = len(shared.log(backend='api')[0]), shared.branches()['all']
+        hg.branch('shared')
+        touch(os.path.join(DUMMY_REPO, 'shared'))
+        hg.commit('shared', files=[os.path.join(DUMMY_REPO, 'shared')])
+        self.assertEquals(count + 1, len(shared.log(backend='api')[0]))
+        self.assertEquals(sorted(branches + [u'shared']), shared.branches()['all'])
+
     def test_user_commits(self):
         hg = self._mk_local_repo()
         hg.update(revision=5)
@@ -221,6 +304,8 @@ class HgTests(TestCase):
         expects = {'added': ['closed', 'meh'], 'missing': [], 'removed': [],
                    'modified': [], 'not_versioned': []}
         self.assertDictEqual(expects, hg.changed_between_nodes(0, 2))
+        self.assertRaises(DVCSException, hg.changed_between_nodes, 0, 'nonexistent')
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).status)
 
     def test_log_api(self):
         hg = self._mk_local_repo()
@@ -249,6 +334,120 @@ class HgTests(TestCase):
         self.assertEquals(expects, hg.log(branch='closed', backend='xml')[0])
 
 
+    def test_iter_log(self):
+        hg = self._mk_local_repo()
+        log = hg.iter_log()
+        self.assertTrue(isinstance(log, types.GeneratorType))
+        expects = hg.log(backend='api')[0]
+        self.assertEquals(expects[0], next(log))
+
+        self.assertEquals(expects[:2], list(hg.iter_log(limit=2)))
+        revs = [one['rev'] for one in hg.iter_log(since=4)]
+        self.assertEquals([6, 5], revs[-2:])
+        revs = [one['rev'] for one in hg.iter_log(branch='closed', since='e0059853920b')]
+        self.assertEquals([3, 2], revs)
+        self.assertRaises(DVCSException, list, hg.iter_log(since='nonexistent'))
+        self.assertRaises(DVCSException, hg.log, backend='api', revset='branch(')
+
+    def test_iter_log_xml(self):
+        hg = self._mk_local_repo()
+        log = hg.iter_log(backend='xml')
+        self.assertTrue(isinstance(log, types.GeneratorType))
+        self.assertEquals(hg.log(backend='xml')[0][:3], [next(log) for _ in range(3)])
+        log.close()
+
+        nodes = lambda log: [one['node'] for one in log]
+        self.assertEquals(nodes(hg.iter_log(limit=2)), nodes(hg.iter_log(limit=2, backend='xml')))
+        self.assertEquals(nodes(hg.iter_log(since=4)), nodes(hg.iter_log(since=4, backend='xml')))
+        revs = [one['rev'] for one in hg.iter_log(branch='closed', since='e0059853920b', backend='xml')]
+        self.assertEquals([3, 2], revs)
+        self.assertEquals([], list(hg.iter_log(since='tip', backend='xml')))
+        self.assertRaises(DVCSException, list, DVCSWrapper(DUMMY_REPO_COPY).iter_log(backend='xml'))
+
+    def test_log_paging(self):
+        hg = self._mk_local_repo()
+        for backend in ('api', 'xml'):
+            full = hg.log(branch='default', backend=backend)[0]
+            page = hg.log(branch='default', backend=backend, offset=1, limit=2)[0]
+            self.assertEquals([one['node'] for one in full[1:3]], [one['node'] for one in page])
+            rest = hg.log(branch='default', backend=backend, offset=2)[0]
+            self.assertEquals([one['node'] for one in full[2:]], [one['node'] for one in rest])
+
+        revs = [one['rev'] for one in hg.branch_revisions('default', paths=['one'])]
+        self.assertEquals([6, 0], revs)
+        revs = [one['rev'] for one in hg.branch_revisions('default', revset='0:5', limit=2)]
+        self.assertEquals([5, 4], revs)
+        revs = [one['rev'] for one in hg.log(backend='xml', date='<2012-03-02 15:49:30 +0100')[0]]
+        self.assertEquals([1, 0], revs)
+        commits = hg.user_commits('lahola', offset=0, limit=1, revset='::5')
+        self.assertEquals([5], [one['rev'] for one in commits])
+        self.assertRaises(DVCSException, hg.branch_revisions, 'nonexistent', limit=1)
+
+        #empty page
+        future = '>2030-01-01'
+        self.assertEquals(([], {}), hg.log(backend='xml', date=future))
+        self.assertEquals(([], {}), hg.log(backend='api', date=future))
+        self.assertEquals([], hg.branch_revisions('default', date=future))
+        self.assertEquals([], hg.user_commits('lahola', limit=1, date=future))
+
+        #revset is already formatted, % in names must not be taken for placeholders
+        hg.branch('a%b')
+        touch(os.path.join(DUMMY_REPO, '100%.txt'))
+        hg.commit('percent', files=[os.path.join(DUMMY_REPO, '100%.txt')])
+        for backend in ('api', 'xml'):
+            self.assertEquals([u'a%b'], [one['branch'] for one in hg.log(branch='a%b', limit=2, backend=backend)[0]])
+            self.assertEquals([u'percent'], [one['mess'] for one in hg.log(paths=['100%.txt'], backend=backend)[0]])
+
+    def test_log_index(self):
+        hg = self._mk_local_repo()
+        log = hg.log(backend='index')[0]
+        self.assertEquals('690216eee7b291ac9dca0164d660576bdba51d47', log[-1]['node'])
+        self.assertEquals(['tip'], log[0]['tags'])
+        expects = [{'node': 'b26fba69aa7b0378bee2a5386f16c14b0f697c18', 'files': [], 'short': 'b26fba69aa7b',
+                    'mess': u'closing', 'branch': u'closed', 'tags': [],
+                    'date': dateutil_parse('2012-03-02T15:50:05+0100')
+            , 'author': u'Jan Florian <starenka0@gmail.com>', 'rev': 3},
+                {'node': 'eda6840416571d21bcf3d37e9d519fafc3e7c31d', 'files': ['closed', 'meh'], 'short': 'eda684041657'
+                , 'mess': u'uuu', 'branch': u'closed', 'tags': [], 'date': dateutil_parse('2012-03-02T15:49:58+0100'),
+                 'author': u'Jan Florian <starenka0@gmail.com>', 'rev': 2}]
+        self.assertEquals(expects, hg.log(branch='closed', backend='index')[0])
+        self.assertRaises(DVCSException, hg.log, branch='nonexistent', backend='index')
+
+    def test_log_index_incremental(self):
+        hg = self._mk_local_repo()
+        count = len(hg.log(backend='index')[0])
+
+        new_file = os.path.join(DUMMY_REPO, TEST_FILE + '5')
+        touch(new_file)
+        hg.commit('indexed', user='brogrammer', files=[new_file])
+        log = hg.log(backend='index')[0]
+        self.assertEquals(count + 1, len(log))
+        self.assertEquals((u'indexed', [TEST_FILE + '5']), (log[0]['mess'], log[0]['files']))
+
+        #rollback replaces the indexed tip
+        hg._command('rollback')
+        hg.update(clean=True)
+        touch(new_file)
+        hg.commit('reindexed', user='brogrammer', files=[new_file])
+        log = hg.log(backend='index')[0]
+        self.assertEquals(count + 1, len(log))
+        self.assertEquals(u'reindexed', log[0]['mess'])
+        self.assertEquals(hg.log(backend='api')[0][0]['node'], log[0]['node'])
+
+    def test_log_index_queries(self):
+        hg = self._mk_local_repo()
+        backend = settings.HG_LOG_BACKEND
+        settings.HG_LOG_BACKEND = 'index'
+        try:
+            head = hg.get_head(branch='closed')
+            self.assertEquals(('b26fba69aa7b0378bee2a5386f16c14b0f697c18', 3), (head['node'], head['rev']))
+            self.assertEquals(0, hg.branch_revisions('default')[-1]['rev'])
+            commits = hg.user_commits('lahola', limit=1)
+            self.assertEquals([(5, u'JUDr.PhDr.Mgr. et Mgr.Henryk Lahola <JUDr.PhDr.Mgr. et Mgr.Henryk Lahola>')],
+                [(one['rev'], one['author']) for one in commits])
+        finally:
+            settings.HG_LOG_BACKEND = backend
+
     def test_list_branches(self):
         hg = self._mk_local_repo()
         branches = hg.branches()
@@ -259,6 +458,30 @@ class HgTests(TestCase):
         self.assertTrue('default' in branches['opened'])
         self.assertTrue('inactive' in branches['opened'])
 
+        #cached until tip changes
+        self.assertEquals(branches, hg.branches(backend='command'))
+        with_heads = hg.branches(heads=True)
+        self.assertEquals(with_heads, hg.branches(backend='command', heads=True))
+        self.assertEquals(hg.get_head('closed')['node'], with_heads['heads']['closed'])
+        branches['all'].append('changed by caller')
+        self.assertFalse('changed by caller' in hg.branches()['all'])
+        hg.branch('new')
+        touch(os.path.join(DUMMY_REPO, 'new'))
+        hg.commit('new branch', files=[os.path.join(DUMMY_REPO, 'new')])
+        self.assertTrue('new' in hg.branches()['active'])
+        self.assertEquals(hg.get_head()['node'], hg.branches(heads=True)['heads']['new'])
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).branches)
+
+        #in process hg uses HG_ENCODING too, not the locale
+        hg.branch(u'příliš')
+        touch(os.path.join(DUMMY_REPO, 'encoded'))
+        hg.commit(u'žluťoučký', files=[os.path.join(DUMMY_REPO, 'encoded')])
+        self.assertEquals(hg.branches(backend='command', heads=True), hg.branches(heads=True))
+        self.assertTrue(u'příliš' in hg.branches()['active'])
+        head = hg.get_head()['node']
+        self.assertEquals([head], [one['node'] for one in hg.log(branch=u'příliš', limit=5, backend='api')[0]])
+        self.assertEquals(head, hg._get_log_index().get_head(branch=u'příliš')['node'])
+
 
     def test_parse_branches(self):
         hg = self._mk_local_repo()
@@ -296,6 +519,67 @@ evil with spaces and 1 digit and 1.0 float! 231:78c04536846d (inactive)
 @@ -1,1 +0,0 @@
 -dummy"""
         self.assertEquals(expects, hg.diff_unified('one', identifier='6:5'))
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).diff_unified, 'one', identifier='6:5')
+
+    def test_html_diff(self):
+        hg = self._mk_local_repo()
+        hg.update(revision=6)
+        out = hg.diff_html('one', identifier='6:5')
+        self.assertTrue('<span class="diff_sub">dummy</span>' in out)
+        self.assertEquals(u'', hg.diff_html('one'))
+        with open(os.path.join(DUMMY_REPO, 'one'), 'a') as f:
+            f.write('more\n')
+        self.assertTrue('<span class="diff_add">more</span>' in hg.diff_html('one'))
+        self.assertRaises(DVCSException, hg.diff_html, 'one', identifier='2000')
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).diff_html, 'one', identifier='6:5')
+
+        backend = settings.HG_DIFF_HTML_BACKEND
+        settings.HG_DIFF_HTML_BACKEND = 'extdiff'
+        repocache.clear()
+        try:
+            self.assertTrue('dummy' in hg.diff_html('one', identifier='6:5'))
+            self.assertEquals({}, repocache._repos)
+        finally:
+            settings.HG_DIFF_HTML_BACKEND = backend
+
+    def test_diff_cache(self):
+        hg = self._mk_local_repo()
+        cache.reset()
+        storage = cache.get_cache()
+        expects = hg.diff_unified('one', identifier='6:5')
+        self.assertEquals(1, len(storage.values))
+        self.assertEquals(expects, hg.diff_unified('one', identifier='6:5'))
+        self.assertEquals(1, len(storage.values))
+        hg.diff_html('one', identifier='6:5')
+        hg.diff_changeset(6)
+        self.assertEquals(3, len(storage.values))
+
+        #working directory is never cached
+        hg.diff_unified('one')
+        hg.diff_html('one', identifier=6)
+        hg.diff_range(6)
+        self.assertEquals(3, len(storage.values))
+
+    def test_diff_changeset(self):
+        hg = self._mk_local_repo()
+        files = hg.diff_range(0, 6)
+        self.assertEquals([u'buhwawa', u'one'], [one['path'] for one in files])
+        self.assertEquals([(1, 0), (1, 0)], [(one['added'], one['removed']) for one in files])
+        self.assertEquals('added', files[0]['status'])
+        self.assertEquals([u'+ahoj'], files[0]['hunks'][0]['lines'])
+
+        files = hg.diff_changeset(6, html=True)
+        self.assertEquals([u'one'], [one['path'] for one in files])
+        self.assertTrue('<span class="diff_add">dummy</span>' in files[0]['html'])
+        self.assertEquals(files, hg.diff_changeset(6, paths=['one'], html=True))
+        self.assertEquals([], hg.diff_range(6, 6))
+
+        log = hg.iter_diff(start=0, end=6)
+        self.assertEquals(u'buhwawa', next(log)['path'])
+        log.close()
+        self.assertRaises(DVCSException, hg.diff_changeset, 2000)
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).diff_changeset, 6)
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).diff_range, 0, 6)
 
     def test_has_new_changesets(self):
         hg = self._mk_local_repo()
@@ -307,6 +591,27 @@ evil with spaces and 1 digit and 1.0 float! 231:78c04536846d (inactive)
         hg2 = self._mk_local_repo(DUMMY_REPO_COPY)
         hg.push()
         self.assertTrue(hg2.has_new_changesets())
+        self.assertTrue(hg2.has_new_changesets(branch='default'))
+        self.assertFalse(hg2.has_new_changesets(branch='closed'))
+        self.assertFalse(hg.has_new_changesets())
+        self.assertRaises(DVCSException, self._init_repo(DUMMY_REPO_COPY2).has_new_changesets)
+        missing = DVCSWrapper(os.path.join(TMP, 'hgtests', 'missing'))
+        self.assertRaises(DVCSException, missing.has_new_changesets)
+        self.assertRaises(DVCSException, missing.push)
+
+    def test_incoming_branch_encoding(self):
+        hg = self._mk_local_repo()
+        #clone of the clone pulls from DUMMY_REPO
+        hg2 = DVCSWrapper(DUMMY_REPO_COPY)
+        hg2.clone(DUMMY_REPO)
+        hg.branch(u'příliš')
+        touch(os.path.join(DUMMY_REPO, 'encoded'))
+        hg.commit('encoded branch', files=[os.path.join(DUMMY_REPO, 'encoded')])
+
+        self.assertTrue(hg2.has_new_changesets(branch=u'příliš'))
+        self.assertEquals([hg.get_head()['node']], [one['node'] for one in hg2.get_new_changesets(branch=u'příliš')])
+        self.assertEquals(1, hg2.pull(branch=u'příliš')['changesets'])
+        self.assertFalse(hg2.has_new_changesets(branch=u'příliš'))
 
     def test_get_new_changesets(self):
         hg = self._mk_local_repo()
@@ -320,6 +625,13 @@ evil with spaces and 1 digit and 1.0 float! 231:78c04536846d (inactive)
         last = hg2.get_new_changesets()[-1]
         self.assertEquals((u'Always look good. Always!', u'brogrammer <brogrammer>'), (last['mess'], last['author']))
 
+        #pull takes it from the bundle incoming left
+        bundle = hg2._incoming_bundle()
+        self.assertTrue(os.path.exists(bundle))
+        self.assertEquals({'files': 1, 'changesets': 1, 'changes': 1}, hg2.pull())
+        self.assertFalse(os.path.exists(bundle))
+        self.assertEquals(last['node'], hg2.get_head()['node'])
+
 
     def test_files(self):
         hg = self._mk_local_repo()
@@ -331,6 +643,19 @@ evil with spaces and 1 digit and 1.0 float! 231:78c04536846d (inactive)
 
         self.assertEquals(expects, hg.get_changed_files(1, 5))
 
+        backend = settings.HG_LOG_BACKEND
+        settings.HG_LOG_BACKEND = 'xml'
+        try:
+            self.assertEquals(expects, hg.get_changed_files(1, 5))
+        finally:
+            settings.HG_LOG_BACKEND = backend
+        self.assertEquals({'closed': 1, 'meh': 1, 'buhwawa': 1}, hg.get_changed_paths(1, 5))
+        self.assertEquals([('690216eee7b291ac9dca0164d660576bdba51d47', ['one'])],
+                          list(hg.iter_changed_files(None, 0)))
+        self.assertRaises(DVCSException, hg.get_changed_files, 1, 'nonexistent')
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).get_changed_files, 0, 1)
+        self.assertRaises(DVCSException, DVCSWrapper(DUMMY_REPO_COPY).get_changed_paths, 0, 1)
+
     def test_head(self):
         #branch head
         hg = self._mk_local_repo()
@@ -358,6 +683,29 @@ evil with spaces and 1 digit and 1.0 float! 231:78c04536846d (inactive)
         tip = hg.get_head()
         self.assertEquals((u'default', 1), (tip['branch'], tip['rev']))
 
+    def test_heads(self):
+        hg = self._mk_local_repo()
+        branches = hg.branches()['all']
+        heads = hg.get_heads()
+        self.assertEquals(sorted(branches), sorted(heads.keys()))
+        for branch in branches:
+            self.assertEquals(hg.get_head(branch), heads[branch])
+        self.assertEquals(['closed', 'default'], sorted(hg.get_heads(['closed', u'default', 'nonexistent']).keys()))
+        self.assertEquals({}, hg.get_heads(['nonexistent']))
+        hg.branch('release 1.0 (x)')
+        touch(os.path.join(DUMMY_REPO, 'release'))
+        hg.commit('release', files=[os.path.join(DUMMY_REPO, 'release')])
+        self.assertEquals(hg.get_head()['node'], hg.get_heads(['release 1.0 (x)'])['release 1.0 (x)']['node'])
+
+        backend = settings.HG_LOG_BACKEND
+        settings.HG_LOG_BACKEND = 'index'
+        try:
+            self.assertEquals(heads['closed']['node'], hg.get_heads(['closed'])['closed']['node'])
+            self.assertEquals(['closed', 'default'], sorted(hg.get_heads(['closed', u'default', 'nonexistent'])))
+            self.assertEquals({}, hg.get_heads(['nonexistent']))
+        finally:
+            settings.HG_LOG_BACKEND = backend
+
     def test_log_parse(self):
         hg = DVCSWrapper('dummy', vcs='hg')
         expects = ([{'node': 'e0829f634208c3d7005783822e92f6aec68924c9',
@@ -376,4 +724,158 @@ evil with spaces and 1 digit and 1.0 float! 231:78c04536846d (inactive)
         with open(os.path.join(FIXTURES_DIR, 'log.xml')) as log:
             self.assertEquals(expects, hg._parse_log(log.read()))
 
-        self.assertRaises(DVCSException, hg._parse_log, '')
\ No newline at end of file
+        self.assertRaises(DVCSException, hg._parse_log, '')
+
+
+class HgCmdserverTests(HgTests):
+    """
+    runs the whole suite again through the command server backend
+    """
+    def setUp(self):
+        super(HgCmdserverTests, self).setUp()
+        self._backend = getattr(settings, 'HG_COMMAND_BACKEND', 'shell')
+        settings.HG_COMMAND_BACKEND = 'cmdserver'
+
+    def tearDown(self):
+        settings.HG_COMMAND_BACKEND = self._backend
+        pool.shutdown()
+        super(HgCmdserverTests, self).tearDown()
+
+    def test_server_reused(self):
+        hg = self._mk_local_repo()
+        stats = dict(pool.get_pool().stats)
+        hg.status('-m') #without arguments it doesn't run hg
+        hg.branches(backend='command')
+        self.assertEquals(stats['spawns'] + 1, pool.get_pool().stats['spawns'])
+        self.assertEquals(stats['hits'] + 1, pool.get_pool().stats['hits'])
+
+    def test_server_error(self):
+        hg = self._mk_local_repo()
+        try:
+            hg.update(revision=2000)
+        except DVCSException, e:
+            self.assertEquals(255, e.code)
+            self.assertTrue('2000' in e.stderr)
+        else:
+            self.fail('DVCSException not raised')
+
+    def test_server_failed_to_start(self):
+        hg = DVCSWrapper(os.path.join(TMP, 'hgtests', 'missing'))
+        for call in (hg.pull, hg._has_new_changesets_incoming):
+            try:
+                call()
+            except DVCSException, e:
+                self.assertEquals(255, e.code)
+                self.assertTrue('repository' in e.stderr)
+                self.assertTrue('cmdserver' in e.cmd)
+            else:
+                self.fail('DVCSException not raised')
+
+
+class CommandServerPoolTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rmrf(DUMMY_REPO)
+        rmrf(DUMMY_REPO_COPY)
+        DVCSWrapper(DUMMY_REPO).init_repo()
+        DVCSWrapper(DUMMY_REPO_COPY).init_repo()
+
+    @classmethod
+    def tearDownClass(cls):
+        rmrf(DUMMY_REPO)
+        rmrf(DUMMY_REPO_COPY)
+
+    def setUp(self):
+        self.pool = CommandServerPool(max_size=1, idle_timeout=None, wait_timeout=0.1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_lru_eviction(self):
+        with self.pool.lease(DUMMY_REPO) as server:
+            self.assertEquals(0, server.runcommand(['root'])[0])
+        with self.pool.lease(DUMMY_REPO_COPY):
+            pass
+        self.assertEquals(1, len(self.pool))
+        self.assertFalse(server.is_alive())
+        self.assertEquals({'hits': 0, 'spawns': 2, 'evictions': 1, 'restarts': 0}, self.pool.stats)
+
+    def test_busy(self):
+        with self.pool.lease(DUMMY_REPO):
+            self.assertRaises(DVCSException, self.pool.acquire, DUMMY_REPO_COPY)
+            #same repo shares the running server
+            with self.pool.lease(DUMMY_REPO):
+                pass
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0.01
+        with self.pool.lease(DUMMY_REPO) as server:
+            pass
+        server.last_used -= 1
+        self.pool.evict_idle()
+        self.assertEquals(0, len(self.pool))
+        self.assertEquals(1, self.pool.stats['evictions'])
+
+    def test_restart_crashed(self):
+        with self.pool.lease(DUMMY_REPO) as server:
+            server.process.kill()
+            server.process.wait()
+        with self.pool.lease(DUMMY_REPO) as restarted:
+            self.assertTrue(restarted.is_alive())
+            self.assertEquals(0, restarted.runcommand(['root'])[0])
+        self.assertEquals(1, self.pool.stats['restarts'])
+
+    def test_spawn_outside_lock(self):
+        self.pool.max_size, self.pool.wait_timeout = 2, 5
+        slow_hg = os.path.join(TMP, 'hgtests', 'slow_hg')
+        with open(slow_hg, 'w') as f:
+            f.write('#!/bin/sh\nsleep 1\nexec hg "$@"\n')
+        os.chmod(slow_hg, 0755)
+        try:
+            spawning = threading.Thread(target=lambda: self.pool.release(self.pool.acquire(DUMMY_REPO, slow_hg)))
+            spawning.start()
+            time.sleep(0.2)
+            started = time.time()
+            with self.pool.lease(DUMMY_REPO_COPY) as server:
+                self.assertEquals(0, server.runcommand(['root'])[0])
+            self.assertTrue(time.time() - started < 0.8)
+            self.assertTrue(spawning.is_alive())
+            #same repository waits for the server being started
+            with self.pool.lease(DUMMY_REPO, slow_hg) as server:
+                self.assertTrue(server.is_alive())
+            spawning.join()
+            self.assertEquals({'hits': 1, 'spawns': 2, 'evictions': 0, 'restarts': 0}, self.pool.stats)
+        finally:
+            os.remove(slow_hg)
+
+    def test_same_repo_waiting_for_room(self):
+        self.pool.wait_timeout = 5
+        servers = []
+        lease = lambda: servers.append(self.pool.acquire(DUMMY_REPO))
+        with self.pool.lease(DUMMY_REPO_COPY):
+            threads = [threading.Thread(target=lease) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+        for thread in threads:
+            thread.join()
+        self.assertTrue(servers[0] is servers[1])
+        self.assertEquals(2, self.pool.stats['spawns'])
+        for server in servers:
+            self.pool.release(server)
+        self.assertEquals(0, self.pool.leases[self.pool._key(DUMMY_REPO, 'hg')])
+
+    def test_timeout(self):
+        started = time.time()
+        with self.pool.lease(DUMMY_REPO) as server:
+            try:
+                server.runcommand(['--config', 'hooks.pre-root=sleep 5', 'root'], timeout=0.3)
+            except DVCSException, e:
+                self.assertTrue(e.timeout)
+            else:
+                self.fail('DVCSException not raised')
+            self.assertFalse(server.is_alive())
+        self.assertTrue(time.time() - started < 4)
+        with self.pool.lease(DUMMY_REPO) as server:
+            self.assertEquals(0, server.runcommand(['root'], timeout=5)[0])
+        self.assertEquals(1, self.pool.stats['restarts'])
@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+from dvcs import instrument, utils
+from dvcs.wrapper import DVCSException, DVCSWrapper
+from dvcs.tests.hg import REMOTE_REPO
+
+
+class Client(object):
+    def __init__(self):
+        self.sent = []
+
+    def timing(self, name, ms):
+        self.sent.append(('timing', name))
+
+    def incr(self, name, count=1):
+        self.sent.append(('incr', name, count))
+
+
+class InstrumentTests(TestCase):
+    def setUp(self):
+        self.events = []
+        instrument.add_hook(self.events.append)
+
+    def tearDown(self):
+        del instrument.hooks[:]
+
+    def test_command(self):
+        utils.run(['echo', 'x'])
+        self.assertRaises(DVCSException, utils.run, ['sh', '-c', 'exit 3'], label='failing')
+        self.assertRaises(DVCSException, utils.run, ['sleep', '10'], timeout=0.1)
+        self.assertEquals([('echo', 0, 2), ('failing', 3, 0), ('sleep', None, None)],
+                          [(event['name'], event['code'], event['bytes']) for event in self.events])
+        self.assertTrue(all(event['kind'] == 'command' and event['wall'] >= 0 for event in self.events))
+
+        del self.events[:]
+        self.assertEquals(['x\n'], list(utils.stream(['echo', 'x'], label='streamed')))
+        self.assertEquals([('streamed', 0, 2)], [(event['name'], event['code'], event['bytes']) for event in self.events])
+
+    def test_hg(self):
+        DVCSWrapper(REMOTE_REPO).log(backend='xml')
+        names = [(event['kind'], event['name']) for event in self.events]
+        self.assertTrue(('command', 'hg.log') in names)
+        self.assertTrue(('parse', 'parse_log') in names)
+
+    def test_disabled(self):
+        instrument.remove_hook(self.events.append)
+        DVCSWrapper(REMOTE_REPO).log(backend='xml')
+        self.assertEquals([], self.events)
+
+    def test_hooks(self):
+        histogram, client = instrument.Histogram(), Client()
+        instrument.add_hook(histogram)
+        instrument.add_hook(instrument.Statsd(client))
+        instrument.add_hook(instrument.log_event)
+        instrument.add_hook(lambda event: 1 / 0) #broken hook doesn't break commands
+        for _ in range(3):
+            utils.run(['true'])
+        utils.run(['false'], ignore_return_code=True)
+
+        self.assertEquals(3, histogram.stats['command', 'true']['count'])
+        self.assertEquals(1, histogram.stats['command', 'false']['failed'])
+        self.assertTrue(histogram.percentile('command', 'true', 50) >= 1)
+        self.assertEquals(None, histogram.percentile('command', 'nothing', 50))
+        self.assertTrue(('timing', 'dvcs.command.true') in client.sent)
+        self.assertTrue(('incr', 'dvcs.command.false.failed', 1) in client.sent)
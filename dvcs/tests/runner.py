@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import time
+from unittest import TestCase
+
+from dvcs import utils
+from dvcs.wrapper import DVCSException
+
+
+class UtilsTests(TestCase):
+    def test_run(self):
+        self.assertEquals(u'a b\'c "d"', utils.run(['echo', 'a b\'c', '"d"']))
+        self.assertEquals(u'příliš', utils.run(['echo', u'příliš']))
+        self.assertEquals(u'x', utils.run('echo x | tr a-z x'))
+
+    def test_run_failure(self):
+        try:
+            utils.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        except DVCSException, e:
+            self.assertEquals((3, u'out', u'err'), (e.code, e.stdout, e.stderr))
+        else:
+            self.fail('DVCSException not raised')
+        self.assertEquals(u'out', utils.run(['sh', '-c', 'echo out; exit 3'], ignore_return_code=True))
+        self.assertRaises(DVCSException, utils.run, ['/nonexistent/binary'])
+
+    def test_run_timeout(self):
+        started = time.time()
+        try:
+            utils.run(['sleep', '10'], timeout=0.2)
+        except DVCSException, e:
+            self.assertTrue(e.timeout)
+        else:
+            self.fail('DVCSException not raised')
+        self.assertTrue(time.time() - started < 5)
+
+    def test_stream(self):
+        self.assertEquals('a\nb\n', ''.join(utils.stream(['printf', 'a\\nb\\n'])))
+        self.assertRaises(DVCSException, list, utils.stream(['sh', '-c', 'echo out; exit 1']))
+        reader = utils.StreamReader(iter(['abc', 'de', 'f']))
+        self.assertEquals(['ab', 'cd', 'ef', ''], [reader.read(2) for _ in range(4)])
+
+    def test_stream_timeout(self):
+        started = time.time()
+        chunks = utils.stream(['sh', '-c', 'echo out; sleep 10'], timeout=0.2)
+        self.assertEquals('out\n', next(chunks))
+        try:
+            list(chunks)
+        except DVCSException, e:
+            self.assertTrue(e.timeout)
+        else:
+            self.fail('DVCSException not raised')
+        self.assertTrue(time.time() - started < 5)
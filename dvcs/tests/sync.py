@@ -0,0 +1,97 @@
+import os, threading, time
+from unittest import TestCase
+
+from dvcs.sync import MirrorSync, remote_host
+from dvcs.wrapper import DVCSException, DVCSWrapper
+from dvcs.tests.hg import TMP, REMOTE_REPO, rmrf, touch
+
+SYNC_REPO = os.path.join(TMP, 'hgtests', 'sync')
+
+
+class Mirror(object):
+    running = {}
+    lock = threading.Lock()
+
+    def __init__(self, repo_path, remote, fail=False):
+        self.repo_path, self.remote, self.fail = repo_path, remote, fail
+        self.pulls = 0
+
+    def get_remote(self, name='default'):
+        return self.remote
+
+    def pull(self, branch=None):
+        host = remote_host(self.remote)
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.running['max ' + host] = max(self.running.get('max ' + host, 0), self.running[host])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[host] -= 1
+        self.pulls += 1
+        if self.fail:
+            raise DVCSException('unreachable')
+        return {'files': 1, 'changesets': 1, 'changes': 2}
+
+
+class SyncTests(TestCase):
+    def tearDown(self):
+        rmrf(SYNC_REPO)
+        rmrf(SYNC_REPO + '_mirror')
+
+    def test_remote_host(self):
+        self.assertEquals(['hg.example.com', 'example.org', ''],
+                          map(remote_host, ['ssh://hg@hg.example.com/repo', 'https://example.org:8000/x', '/srv/hg/x']))
+
+    def test_sync(self):
+        source = DVCSWrapper(SYNC_REPO)
+        source.clone(REMOTE_REPO)
+        mirror = DVCSWrapper(SYNC_REPO + '_mirror')
+        mirror.clone(SYNC_REPO)
+        touch(os.path.join(SYNC_REPO, 'synced'))
+        source.commit('sync me', files=[os.path.join(SYNC_REPO, 'synced')])
+
+        sync = MirrorSync([mirror, DVCSWrapper(SYNC_REPO + '_nonexistent')], backoff=10)
+        results = sync.run()
+        self.assertEquals(['pulled', 'failed'], [result['status'] for result in results])
+        self.assertEquals({'files': 1, 'changesets': 1, 'changes': 1}, results[0]['counts'])
+        self.assertTrue(isinstance(results[1]['error'], DVCSException))
+        self.assertEquals(dict(pulled=1, failed=1, skipped=0, files=1, changesets=1, changes=1),
+                          dict((k, v) for k, v in sync.metrics.items() if k != 'duration'))
+
+        results = sync.run()
+        self.assertEquals(['pulled', 'skipped'], [result['status'] for result in results])
+        self.assertEquals(0, results[0]['counts']['changesets'])
+
+    def test_limits(self):
+        mirrors = [Mirror('/m%d' % i, 'ssh://%s/m%d' % ('a' if i % 2 else 'b', i)) for i in range(8)]
+        mirrors.append(Mirror('/failing', 'ssh://c/x', fail=True))
+        sync = MirrorSync(mirrors, workers=6, host_concurrency=2, backoff=0.1, max_backoff=0.15)
+        sync.run()
+        self.assertEquals((2, 2), (Mirror.running['max a'], Mirror.running['max b']))
+        self.assertEquals([1] * 9, [mirror.pulls for mirror in mirrors])
+
+        #backoff doubles up to max_backoff
+        self.assertEquals('skipped', sync.run()[-1]['status'])
+        time.sleep(0.11)
+        self.assertEquals('failed', sync.run()[-1]['status'])
+        self.assertEquals(2, sync.state['/failing']['failures'])
+        self.assertTrue(sync.state['/failing']['retry_at'] - time.time() <= 0.15)
+
+    def test_local_not_limited(self):
+        Mirror.running.clear()
+        mirrors = [Mirror('/local%d' % i, '/srv/hg/local%d' % i) for i in range(4)]
+        MirrorSync(mirrors, workers=4, host_concurrency=1).run()
+        self.assertEquals(4, Mirror.running['max '])
+
+    def test_priority(self):
+        mirrors = [Mirror('/old', ''), Mirror('/new', '')]
+        sync = MirrorSync(mirrors, workers=1)
+        sync._state(mirrors[0])['last_change'] = 10
+        sync._state(mirrors[1])['last_change'] = 20
+        order = []
+        for mirror in mirrors:
+            mirror.pull = lambda branch=None, mirror=mirror: order.append(mirror.repo_path) or {'files': 0,
+                                                                                                'changesets': 0,
+                                                                                                'changes': 0}
+        sync.run()
+        self.assertEquals(['/new', '/old'], order)
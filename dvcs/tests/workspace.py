@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+from unittest import TestCase
+
+from dvcs.workspace import WorkspacePool
+from dvcs.wrapper import DVCSException, DVCSWrapper
+from dvcs.tests.hg import TMP, REMOTE_REPO, rmrf, touch
+
+WORKSPACE_ROOT = os.path.join(TMP, 'hgtests', 'workspaces')
+WORKSPACE_REMOTE = os.path.join(TMP, 'hgtests', 'workspace_remote')
+
+
+class WorkspaceTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rmrf(WORKSPACE_REMOTE)
+        DVCSWrapper(WORKSPACE_REMOTE).clone(REMOTE_REPO)
+        DVCSWrapper(WORKSPACE_REMOTE + '2').clone(REMOTE_REPO)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmrf(WORKSPACE_REMOTE)
+        rmrf(WORKSPACE_REMOTE + '2')
+
+    def tearDown(self):
+        rmrf(WORKSPACE_ROOT)
+
+    def test_lease_reset(self):
+        workspaces = WorkspacePool(WORKSPACE_ROOT, size=1, capacity=3)
+        workspaces.prewarm(WORKSPACE_REMOTE)
+        self.assertEquals((1, 1), (len(workspaces), workspaces.stats['clones']))
+
+        with workspaces.lease(WORKSPACE_REMOTE, branch='default') as hg:
+            path = hg.repo_path
+            self.assertTrue(os.listdir(path) != ['.hg'])
+            touch(os.path.join(path, 'untracked'))
+            tracked = [name for name in os.listdir(path) if name != '.hg' and os.path.isfile(os.path.join(path, name))]
+            with open(os.path.join(path, tracked[0]), 'a') as f:
+                f.write('changed by job\n')
+            self.assertEquals(([tracked[0]], ['untracked']), (hg.status()['modified'], hg.status()['not_versioned']))
+
+        self.assertEquals(1, workspaces.stats['hits'])
+        self.assertEquals([], sum(DVCSWrapper(path).status().values(), []))
+        with workspaces.lease(WORKSPACE_REMOTE) as hg:
+            self.assertEquals(path, hg.repo_path)
+        self.assertEquals((1, 2), (workspaces.stats['clones'], workspaces.stats['hits']))
+
+    def test_local_changesets_discarded(self):
+        workspaces = WorkspacePool(WORKSPACE_ROOT, size=1, capacity=3)
+        with workspaces.lease(WORKSPACE_REMOTE) as hg:
+            path = hg.repo_path
+            touch(os.path.join(path, 'committed'))
+            hg.commit('commit by job', user='job')
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEquals((0, 1), (len(workspaces), workspaces.stats['discarded']))
+        with workspaces.lease(WORKSPACE_REMOTE) as hg:
+            self.assertNotEquals(path, hg.repo_path)
+            self.assertEquals([], hg.log(revset='draft()')[0])
+        self.assertEquals(1, len(workspaces))
+
+    def test_capacity(self):
+        workspaces = WorkspacePool(WORKSPACE_ROOT, size=1, capacity=2, wait_timeout=0.1)
+        first, second = workspaces.acquire(WORKSPACE_REMOTE), workspaces.acquire(WORKSPACE_REMOTE)
+        self.assertRaises(DVCSException, workspaces.acquire, WORKSPACE_REMOTE + '2')
+
+        #only size idle copies are kept
+        workspaces.release(first)
+        workspaces.release(second)
+        self.assertEquals([second.repo_path], workspaces.idle.keys())
+        self.assertFalse(os.path.exists(first.repo_path))
+
+        #least recently used idle copy makes room
+        workspaces.acquire(WORKSPACE_REMOTE + '2')
+        other = workspaces.acquire(WORKSPACE_REMOTE + '2')
+        self.assertFalse(os.path.exists(second.repo_path))
+        self.assertEquals(2, workspaces.stats['evictions'])
+        self.assertEquals(os.path.realpath(WORKSPACE_REMOTE + '2'), os.path.realpath(other.get_remote()))
+
+        workspaces.release(other)
+        workspaces.clear()
+        self.assertFalse(os.path.exists(other.repo_path))
+
+    def test_unicode_remote(self):
+        workspaces = WorkspacePool(WORKSPACE_ROOT)
+        remote = u'/srv/hg/příliš'
+        self.assertEquals(workspaces._remote_dir(remote), workspaces._remote_dir(remote.encode('utf8')))
@@ -1,27 +1,202 @@
 # -*- coding: utf-8 -*-
-import os
-
-from fabric.api import settings as fab_settings
-from fabric.operations import local
+import os, pipes, select, subprocess, time
 
 try:
     from django.conf import settings
 except ImportError:
     import settings
 from wrapper import DVCSException
+import instrument
 
 logging = settings.APP_LOGGER
 
-def shell(cmd, capture=not settings.FABRIC_OUTPUT, ignore_return_code=False):
-    logging.debug('Executing shell %s' % cmd)
-    with fab_settings(warn_only=True):
-        out = local(cmd, capture)
-        if out.failed and not ignore_return_code:
-            info = {'cmd': cmd, 'code': out.return_code, 'stderr': out.stderr.decode('utf8'),
-                    'stdout': getattr(out, 'stdout', '').decode('utf8')}
-            raise DVCSException('Executing %(cmd)s failed %(code)d stderr: %(stderr)s stdout:%(stdout)s' % info,
-                **info)
-        return unicode(out, errors='ignore').decode('utf8', 'ignore')
+CHUNK_SIZE = 65536
+
+
+def command_line(argv):
+    """
+    argument list as it would be typed in shell, for logs and error messages
+    """
+    return ' '.join(pipes.quote(arg) for arg in argv)
+
+
+def environ(**variables):
+    """
+    copy of os.environ with ``variables`` set, ``None`` values are skipped
+    """
+    env = dict(os.environ)
+    env.update((k, v) for k, v in variables.items() if v is not None)
+    return env
+
+
+def check_output(cmd, code, stdout, stderr, ignore_return_code=False):
+    """
+    turns raw command results into the value returned by ``run``, raising ``DVCSException`` on failure
+    """
+    if code != 0 and not ignore_return_code:
+        info = {'cmd': cmd, 'code': code, 'stderr': stderr.decode('utf8', 'replace'),
+                'stdout': stdout.decode('utf8', 'replace')}
+        raise DVCSException('Executing %(cmd)s failed %(code)d stderr: %(stderr)s stdout:%(stdout)s' % info,
+            **info)
+    return stdout.decode('utf8', 'replace')
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except OSError: #already gone
+        pass
+    process.wait()
+
+
+def popen(argv, capture, cwd=None, env=None):
+    if isinstance(argv, basestring):
+        shell, argv = True, argv
+    else:
+        shell, argv = False, [arg.encode('utf8') if isinstance(arg, unicode) else arg for arg in argv]
+    pipe = subprocess.PIPE if capture else None
+    return subprocess.Popen(argv, shell=shell, stdout=pipe, stderr=pipe, close_fds=True, cwd=cwd, env=env)
+
+
+def _communicate(process, timeout):
+    """
+    reads stdout and stderr until the process exits, returns (stdout, stderr) or None on timeout
+    """
+    chunks = {process.stdout: [], process.stderr: []}
+    deadline = time.time() + timeout if timeout is not None else None
+    while chunks and any(not stream.closed for stream in chunks):
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+        streams = [stream for stream in chunks if not stream.closed]
+        for stream in select.select(streams, [], [], remaining)[0]:
+            data = os.read(stream.fileno(), CHUNK_SIZE)
+            if data:
+                chunks[stream].append(data)
+            else:
+                stream.close()
+    return ''.join(chunks[process.stdout]), ''.join(chunks[process.stderr])
+
+
+def _label(argv):
+    """
+    name of the command for instrumentation
+    """
+    return os.path.basename(argv.split(' ', 1)[0] if isinstance(argv, basestring) else argv[0])
+
+
+def _execute(argv, cmd, capture, timeout, cwd, env):
+    """
+    returns (exit code, stdout, stderr) of finished command
+    """
+    try:
+        process = popen(argv, capture, cwd=cwd, env=env)
+    except OSError, e:
+        raise DVCSException('Executing %s failed: %s' % (cmd, e), cmd=cmd, code=127, stdout=u'', stderr=unicode(e))
+
+    if not capture:
+        return process.wait(), '', ''
+
+    output = _communicate(process, timeout)
+    if output is None:
+        _kill(process)
+        raise DVCSException('Executing %s timed out after %ss' % (cmd, timeout), cmd=cmd, code=None, stdout=u'',
+            stderr=u'', timeout=True)
+    stdout, stderr = output
+    return process.wait(), stdout, stderr
+
+
+def run(argv, ignore_return_code=False, timeout=None, capture=None, cwd=None, env=None, label=None):
+    """
+    runs command given as argument list (string goes through shell) and returns its stdout
+    raises ``DVCSException`` if it fails or doesn't finish in ``timeout`` seconds
+    ``label`` names the command in instrumentation events (see dvcs.instrument)
+    """
+    if capture is None:
+        capture = not getattr(settings, 'COMMAND_OUTPUT', getattr(settings, 'FABRIC_OUTPUT', False))
+    cmd = argv if isinstance(argv, basestring) else command_line(argv)
+    logging.debug('Executing %s' % cmd)
+    with instrument.command(label or _label(argv), cmd) as event:
+        code, stdout, stderr = _execute(argv, cmd, capture, timeout, cwd, env)
+        event.update(code=code, bytes=len(stdout) + len(stderr))
+    return check_output(cmd, code, stdout.strip(), stderr.strip(), ignore_return_code)
+
+
+def stream(argv, ignore_return_code=False, timeout=None, cwd=None, env=None, label=None):
+    """
+    runs command and yields chunks of its stdout as they come
+    raises ``DVCSException`` after the last chunk if the command failed, when it doesn't finish in ``timeout``
+    seconds (time the consumer spends between chunks counts too) it is killed
+    """
+    cmd = argv if isinstance(argv, basestring) else command_line(argv)
+    logging.debug('Streaming %s' % cmd)
+    with instrument.command(label or _label(argv), cmd) as event:
+        process = popen(argv, True, cwd=cwd, env=env)
+        stderr, streams, size = [], [process.stdout, process.stderr], 0
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            while streams:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise DVCSException('Executing %s timed out after %ss' % (cmd, timeout), cmd=cmd, code=None,
+                            stdout=u'', stderr=u'', timeout=True)
+                for s in select.select(streams, [], [], remaining)[0]:
+                    data = os.read(s.fileno(), CHUNK_SIZE)
+                    size += len(data)
+                    if not data:
+                        streams.remove(s)
+                    elif s is process.stdout:
+                        yield data
+                    else:
+                        stderr.append(data)
+        finally:
+            if streams: #consumer gave up
+                _kill(process)
+        event.update(code=process.wait(), bytes=size)
+    check_output(cmd, process.wait(), '', ''.join(stderr).strip(), ignore_return_code)
+
+
+class StreamReader(object):
+    """
+    file like object over chunks from ``stream``, f.e. for ``ElementTree.iterparse``
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+def shell(cmd, capture=None, ignore_return_code=False, label=None):
+    return run(cmd, ignore_return_code=ignore_return_code, capture=capture, label=label)
 
 
 def touch(path):
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of working copies cloned ahead of time, so that a job doesn't pay a full clone to start.
+
+    from dvcs.workspace import WorkspacePool
+    workspaces = WorkspacePool('/srv/workspaces', size=2, capacity=16)
+    workspaces.prewarm(remote)
+    with workspaces.lease(remote, revision=node) as hg:
+        build(hg.repo_path)
+
+``acquire`` hands out an idle working copy of ``remote`` (pulled and updated to ``branch``/``revision``) or
+clones a new one. ``release`` resets it by ``update(clean=True)`` and ``purge(all=True)`` and keeps it for the
+next job, at most ``size`` idle copies per remote. There are never more than ``capacity`` copies on disk: the
+least recently used idle ones are removed to make room, when all are leased ``acquire`` waits. Working copies
+with changesets committed by the job (draft ones, pulled changesets of publishing remotes are public) are removed
+instead, the next job must not see them.
+"""
+import os, shutil, tempfile, threading, time, hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from dvcs.wrapper import DVCSException, DVCSWrapper
+
+try:
+    from django.conf import settings
+except ImportError:
+    import dvcs.settings as settings
+
+logging = settings.APP_LOGGER
+
+
+class WorkspacePool(object):
+    def __init__(self, root=None, size=None, capacity=None, wait_timeout=60, vcs='hg', **clone_kwargs):
+        """
+        ``clone_kwargs`` are passed to ``clone`` of new working copies (f.e. ``hardlink=False``)
+        """
+        self.root = root or getattr(settings, 'DVCS_WORKSPACE_ROOT', None) or os.path.join(tempfile.gettempdir(),
+                                                                                         'dvcs-workspaces')
+        self.size = size if size is not None else getattr(settings, 'DVCS_WORKSPACE_POOL_SIZE', 2)
+        self.capacity = capacity or getattr(settings, 'DVCS_WORKSPACE_CAPACITY', 16)
+        self.wait_timeout = wait_timeout
+        self.vcs = vcs
+        self.clone_kwargs = clone_kwargs
+        self.idle = OrderedDict() #path -> remote, least recently used first
+        self.leased = {} #path -> remote
+        self.cloning = 0
+        self.stats = {'hits': 0, 'clones': 0, 'evictions': 0, 'failed_resets': 0, 'discarded': 0}
+        self.cond = threading.Condition()
+
+    def _remote_dir(self, remote):
+        remote = remote.encode('utf8') if isinstance(remote, unicode) else remote
+        return os.path.join(self.root, hashlib.sha1(remote).hexdigest()[:12])
+
+    def _remove(self, paths):
+        for path in paths:
+            logging.debug('Removing workspace %s' % path)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _make_room(self):
+        """
+        reserves place for one more working copy, returns paths of evicted ones to be removed
+        """
+        evicted, started = [], time.time()
+        while len(self.idle) + len(self.leased) + self.cloning >= self.capacity:
+            if self.idle:
+                evicted.append(self.idle.popitem(last=False)[0])
+                self.stats['evictions'] += 1
+                continue
+            remaining = self.wait_timeout - (time.time() - started)
+            if remaining <= 0:
+                raise DVCSException('No workspace available, all %d are leased' % self.capacity)
+            self.cond.wait(remaining)
+        self.cloning += 1
+        return evicted
+
+    def _clone(self, remote):
+        with self.cond:
+            evicted = self._make_room()
+        self._remove(evicted)
+        path = None
+        try:
+            if not os.path.isdir(self._remote_dir(remote)):
+                os.makedirs(self._remote_dir(remote))
+            path = tempfile.mkdtemp(dir=self._remote_dir(remote))
+            wrapper = DVCSWrapper(path, self.vcs)
+            wrapper.clone(remote, **dict(self.clone_kwargs, noupdate=True))
+        except:
+            with self.cond:
+                self.cloning -= 1
+                self.cond.notify()
+            if path:
+                self._remove([path])
+            raise
+        with self.cond:
+            self.cloning -= 1
+            self.stats['clones'] += 1
+            self.leased[path] = remote
+        return wrapper
+
+    def _take_idle(self, remote):
+        with self.cond:
+            for path, idle_remote in reversed(self.idle.items()): #most recently used is warmest
+                if idle_remote == remote:
+                    del self.idle[path]
+                    self.leased[path] = remote
+                    self.stats['hits'] += 1
+                    return DVCSWrapper(path, self.vcs)
+        return None
+
+    def _give_back(self, wrapper):
+        with self.cond:
+            remote = self.leased.pop(wrapper.repo_path)
+            self.idle[wrapper.repo_path] = remote
+            #keep at most size idle copies of one remote
+            extra = [path for path, idle_remote in self.idle.items() if idle_remote == remote][:-self.size or None]
+            for path in extra:
+                del self.idle[path]
+                self.stats['evictions'] += 1
+            self.cond.notify()
+        self._remove(extra)
+
+    def _drop(self, wrapper):
+        with self.cond:
+            self.leased.pop(wrapper.repo_path, None)
+            self.cond.notify()
+        self._remove([wrapper.repo_path])
+
+    def acquire(self, remote, branch=None, revision=None, pull=True):
+        """
+        working copy of ``remote`` updated to ``branch`` or ``revision``, it has to be given back by ``release``
+        """
+        wrapper = self._take_idle(remote)
+        if wrapper is None:
+            wrapper = self._clone(remote)
+        elif pull:
+            try:
+                wrapper.pull()
+            except DVCSException:
+                self._give_back(wrapper)
+                raise
+        try:
+            wrapper.update(branch=branch, revision=revision, clean=True)
+        except DVCSException:
+            self.release(wrapper)
+            raise
+        return wrapper
+
+    def _reset(self, wrapper):
+        wrapper.update(revision='.', clean=True)
+        wrapper.purge(all=True)
+
+    def _has_local_changesets(self, wrapper):
+        return bool(wrapper.log(revset='draft()', limit=1)[0])
+
+    def release(self, wrapper):
+        """
+        resets working copy and keeps it for next ``acquire``, copies that can't be reset or have local
+        changesets are removed
+        """
+        try:
+            if self._has_local_changesets(wrapper):
+                logging.info('Workspace %s has local changesets, removing it' % wrapper.repo_path)
+                self.stats['discarded'] += 1
+                self._drop(wrapper)
+                return
+            self._reset(wrapper)
+        except DVCSException, e:
+            logging.warning('Resetting workspace %s failed, removing it: %s' % (wrapper.repo_path, e))
+            self.stats['failed_resets'] += 1
+            self._drop(wrapper)
+            return
+        self._give_back(wrapper)
+
+    @contextmanager
+    def lease(self, remote, branch=None, revision=None, pull=True):
+        wrapper = self.acquire(remote, branch, revision, pull)
+        try:
+            yield wrapper
+        finally:
+            self.release(wrapper)
+
+    def prewarm(self, remote, count=None):
+        """
+        clones idle working copies of ``remote`` up to ``count`` (``size`` by default)
+        """
+        count = self.size if count is None else count
+        with self.cond:
+            missing = count - self.idle.values().count(remote)
+        for _ in range(missing):
+            self._give_back(self._clone(remote))
+
+    def clear(self):
+        """
+        removes all idle working copies
+        """
+        with self.cond:
+            paths = self.idle.keys()
+            self.idle.clear()
+            self.cond.notify_all()
+        self._remove(paths)
+
+    def __len__(self):
+        return len(self.idle) + len(self.leased)
@@ -26,7 +26,7 @@ class DVCSWrapper(object):
         except:
             raise
 
-    def clone(self, remote_path):
+    def clone(self, remote_path, **kwargs):
         raise NotImplementedError
 
     def branch(self, name):
@@ -56,6 +56,15 @@ class DVCSWrapper(object):
     def update(self, branch=None, revision=None, clean=True, **kwargs):
         raise NotImplementedError
 
+    def purge(self, all=False):
+        raise NotImplementedError
+
+    def get_remote(self, name='default'):
+        """
+        returns url or path of the remote repository ``name``, None if not set
+        """
+        raise NotImplementedError
+
     def init_repo(self):
         raise NotImplementedError
 
@@ -71,15 +80,21 @@ class DVCSWrapper(object):
         """
         raise NotImplementedError
 
+    def iter_log(self, branch=None, since=None, limit=None):
+        """
+        yields dict(date,revhash,author,message,files) from the newest, stops at ``since`` revision
+        """
+        raise NotImplementedError
+
     def user_commits(self, user, limit=None, **kwargs):
         raise NotImplementedError
 
     def changed_between_nodes(self, start, end):
         raise NotImplementedError
 
-    def branches(self, **kwargs):
+    def branches(self, heads=False, **kwargs):
         """
-        returns {'active': [], 'inactive': [], 'closed': [], 'all':[] }
+        returns {'active': [], 'inactive': [], 'closed': [], 'all':[], 'opened': [] (, 'heads': {branch: node})}
         """
         raise NotImplementedError
 
@@ -101,6 +116,18 @@ class DVCSWrapper(object):
         """
         raise NotImplementedError
 
+    def diff_changeset(self, rev, paths=None, html=False):
+        """
+        returns [FileDiff(path,old_path,status,binary,added,removed,hunks,unified[,html]),] of changes in rev
+        """
+        raise NotImplementedError
+
+    def diff_range(self, start, end=None, paths=None, html=False):
+        """
+        returns the same as diff_changeset for changes between two revisions (end None = working copy)
+        """
+        raise NotImplementedError
+
     def has_new_changesets(self, branch=None):
         """
         returns boolean
@@ -116,8 +143,20 @@ class DVCSWrapper(object):
         """
         raise NotImplemented
 
+    def get_changed_paths(self, start_node, end_node):
+        """
+        returns {path: number of changesets changing it}
+        """
+        raise NotImplementedError
+
     def get_head(self, branch=None):
         """
         returns dict(node,rev,node_short,message,author,branch,)
         """
-        raise NotImplemented
\ No newline at end of file
+        raise NotImplemented
+
+    def get_heads(self, branches=None):
+        """
+        returns {branch: get_head(branch)} for all or given branches, unknown branches are left out
+        """
+        raise NotImplementedError
\ No newline at end of file